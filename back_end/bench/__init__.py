@@ -0,0 +1,2 @@
+# Benchmarks dos caminhos quentes do back-end.
+# Rodar a partir de back_end/, por exemplo:  python -m bench.ifc_weights modelo.ifc
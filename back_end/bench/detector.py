@@ -0,0 +1,97 @@
+# Compara um backend exportado (ONNX Runtime/OpenVINO, com ou sem INT8) com
+# o YOLOWorld em PyTorch nas mesmas fotos: latência por foto (melhor de
+# --repeat, depois do aquecimento) e concordância das contagens
+# (counts_strict, counts_lenient, generic_hits) e do progresso, se houver IFC.
+#   python -m bench.detector --backend openvino [--int8] [--ifc modelo.ifc] [foto.jpg ...]
+# Sem fotos na linha de comando, usa as guardadas (export_detector.calibration_photos).
+import argparse
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def _use_backend(backend, int8):
+    main.DETECTOR_BACKEND, main.DETECTOR_INT8 = backend, int8
+
+
+def _run(image, classes, repeat):
+    main.detect_photo_raw(main.YOLO_WEIGHTS, image, classes)   # aquece (predictor, vocabulário)
+    best, dets = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        dets, _ = main.detect_photo_raw(main.YOLO_WEIGHTS, image, classes)
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, dets
+
+
+def _count_diff(a, b):
+    return sum(abs(a.get(k, 0) - b.get(k, 0)) for k in set(a) | set(b))
+
+
+def bench_photo(path, classes, weights, repeat=3, ref_backend=("torch", False), backend=("onnx", False)):
+    image = main.load_image(path)
+    out = {"file": path}
+    runs = {}
+    for name, (b, int8) in (("ref", ref_backend), ("new", backend)):
+        _use_backend(b, int8)
+        t, dets = _run(image, classes, repeat)
+        counts = main.counts_from_detections(dets, classes)
+        runs[name] = counts
+        out[f"{name}_s"] = round(t, 4)
+        if weights:
+            out[f"{name}_progress_pct"] = main.score_detections(weights[0], weights[1], dets, classes)[0]
+    (s_ref, l_ref, g_ref), (s_new, l_new, g_new) = runs["ref"], runs["new"]
+    out.update({
+        "speedup": round(out["ref_s"] / out["new_s"], 2) if out["new_s"] else None,
+        "strict_abs_diff": _count_diff(s_ref, s_new),
+        "lenient_abs_diff": _count_diff(l_ref, l_new),
+        "generic_hits": [g_ref, g_new],
+        "identical_counts": runs["ref"] == runs["new"],
+    })
+    return out
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Detector exportado x PyTorch: latência e concordância")
+    ap.add_argument("fotos", nargs="*")
+    ap.add_argument("--backend", choices=[b for b in main.DETECTOR_BACKENDS if b != "torch"], required=True)
+    ap.add_argument("--int8", action="store_true")
+    ap.add_argument("--ifc", help="IFC para o vocabulário e o progresso (sem ele: vocabulário inteiro)")
+    ap.add_argument("--limite", type=int, default=20, help="fotos guardadas usadas quando nenhuma é passada")
+    ap.add_argument("--repeat", type=int, default=3)
+    args = ap.parse_args(argv)
+
+    photos = args.fotos
+    if not photos:
+        from export_detector import calibration_photos
+        photos = calibration_photos(args.limite)
+    weights = main.build_ifc_weights(args.ifc) if args.ifc else None
+    classes = main.vocabulary_for(weights[0]) if weights else tuple(main.YOLO_CLASSES)
+
+    results = [bench_photo(p, classes, weights, args.repeat, backend=(args.backend, args.int8)) for p in photos]
+    summary = {}
+    if results:
+        ref = sum(r["ref_s"] for r in results)
+        new = sum(r["new_s"] for r in results)
+        summary = {
+            "photos": len(results),
+            "ref_mean_s": round(ref / len(results), 4), "new_mean_s": round(new / len(results), 4),
+            "speedup": round(ref / new, 2) if new else None,
+            "identical_counts": sum(r["identical_counts"] for r in results),
+        }
+        if weights:
+            diffs = [abs(r["ref_progress_pct"] - r["new_progress_pct"]) for r in results]
+            summary["progress_mae"] = round(sum(diffs) / len(diffs), 3)
+            summary["progress_max_abs"] = round(max(diffs), 3)
+    print(json.dumps({"benchmark": "detector", "backend": args.backend, "int8": args.int8,
+                      "summary": summary, "results": results}, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
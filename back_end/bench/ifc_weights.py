@@ -0,0 +1,55 @@
+# Compara a extração de pesos em passada única (ifc_weights_from_model) com
+# a implementação por by_type (ifc_weights_by_type). O arquivo é aberto uma
+# vez; só a extração é cronometrada.
+#   python -m bench.ifc_weights modelo.ifc [modelo2.ifc ...] [--repeat 3] [--keep-mep]
+import argparse
+import json
+import os
+import sys
+import time
+
+import ifcopenshell
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import main  # noqa: E402
+
+
+def _best_of(fn, repeat):
+    best, out = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+
+def bench_file(path, repeat=3, ignore_mep=True):
+    t_open, model = _best_of(lambda: ifcopenshell.open(path), 1)
+    t_old, old = _best_of(lambda: main.ifc_weights_by_type(model, ignore_mep=ignore_mep), repeat)
+    t_new, new = _best_of(lambda: main.ifc_weights_from_model(model, ignore_mep=ignore_mep), repeat)
+    return {
+        "file": path,
+        "size_bytes": os.path.getsize(path),
+        "elements": sum(new[1].values()),
+        "open_s": round(t_open, 4),
+        "by_type_s": round(t_old, 4),
+        "single_pass_s": round(t_new, 4),
+        "speedup": round(t_old / t_new, 2) if t_new else None,
+        "identical": old == new,
+    }
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Extração de pesos IFC: passada única x by_type")
+    ap.add_argument("ifc", nargs="+")
+    ap.add_argument("--repeat", type=int, default=3)
+    ap.add_argument("--keep-mep", action="store_true", help="não ignora tipos MEP")
+    args = ap.parse_args(argv)
+    results = [bench_file(p, args.repeat, ignore_mep=not args.keep_mep) for p in args.ifc]
+    print(json.dumps({"benchmark": "ifc_weights", "results": results}, indent=2))
+    return 0 if all(r["identical"] for r in results) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
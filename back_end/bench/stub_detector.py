@@ -0,0 +1,59 @@
+# Detector determinístico no lugar do YOLO-World, para benchmarks e testes de
+# carga numa máquina só com CPU e sem pesos: DETECTOR_BACKEND=stub.
+#
+# Tem a mesma interface que main usa de um modelo exportado (names fixos,
+# predict → resultados com boxes.xyxy/conf/cls). As caixas saem de um gerador
+# semeado pelo conteúdo da imagem: a mesma foto dá sempre as mesmas caixas,
+# em qualquer processo. STUB_DETECT_MS simula o custo do forward por imagem.
+import hashlib
+import os
+import time
+
+import numpy as np
+
+STUB_DETECT_MS = float(os.getenv("STUB_DETECT_MS", "0"))
+STUB_BOXES = int(os.getenv("STUB_BOXES", "60"))   # caixas por imagem antes do piso de confiança
+
+
+class _Boxes:
+    def __init__(self, xyxy, conf, cls):
+        self.xyxy, self.conf, self.cls = xyxy, conf, cls
+
+    def __len__(self):
+        return len(self.conf)
+
+
+class _Result:
+    def __init__(self, boxes):
+        self.boxes = boxes
+
+
+class StubDetector:
+    def __init__(self, names, detect_ms=None, n_boxes=None):
+        self.names = dict(enumerate(names))
+        self.model = None   # nem WorldModel nem DetectionModel: vocabulário fixo, sem TTA
+        self.detect_ms = STUB_DETECT_MS if detect_ms is None else detect_ms
+        self.n_boxes = STUB_BOXES if n_boxes is None else n_boxes
+
+    def predict(self, source, imgsz=640, conf=0.25, augment=False, verbose=False, **kwargs):
+        images = source if isinstance(source, list) else [source]
+        if self.detect_ms > 0:
+            time.sleep(self.detect_ms * len(images) / 1000.0)
+        return [self._detect(image, conf) for image in images]
+
+    def _detect(self, image, conf):
+        h, w = image.shape[:2]
+        # Semente: uma amostra 16×16 dos pixels (barata e estável para o mesmo arquivo)
+        sample = np.ascontiguousarray(image[::max(1, h // 16), ::max(1, w // 16)])
+        seed = int.from_bytes(hashlib.blake2b(sample.tobytes(), digest_size=8).digest(), "little")
+        rng = np.random.default_rng(seed)
+        n = self.n_boxes
+        x1 = rng.uniform(0, 0.9 * w, n)
+        y1 = rng.uniform(0, 0.9 * h, n)
+        x2 = np.minimum(x1 + rng.uniform(0.02, 0.3, n) * w, w)
+        y2 = np.minimum(y1 + rng.uniform(0.02, 0.3, n) * h, h)
+        scores = rng.uniform(0, 1, n) ** 2     # maioria das caixas com confiança baixa, como no modelo real
+        cls = rng.integers(0, len(self.names), n).astype(np.float32)
+        keep = scores > conf
+        xyxy = np.stack([x1, y1, x2, y2], axis=1)[keep].astype(np.float32)
+        return _Result(_Boxes(xyxy, scores[keep].astype(np.float32), cls[keep]))
@@ -0,0 +1,335 @@
+# Suíte de regressão dos caminhos quentes, offline e só com CPU: dados
+# sintéticos (bench.synth) e o detector stub (bench.stub_detector) no lugar
+# do YOLO-World. Cada execução grava um JSON; com --base, compara com outra.
+#
+#   python -m bench.suite --saida hoje.json
+#   python -m bench.suite --escalas 1000,100000,1000000 --linhas 1000000 --saida grande.json
+#   python -m bench.suite --so list_casos,teste --base ontem.json
+#
+# Benchmarks: ifc_weights (abertura + extração, com e sem QTO, por escala),
+# elem_weight_from_qto, compute_progress_soft, list_casos (banco semeado),
+# teste (POST /teste de ponta a ponta num uvicorn com clientes concorrentes) e
+# startup (import do main num interpretador novo).
+import argparse
+import json
+import os
+import platform
+import random
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timezone
+
+import ifcopenshell
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from bench.synth import load_main, make_ifc, make_photo, seed_submissions  # noqa: E402
+
+_BACK_END = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+BENCHMARKS = ("ifc_weights", "elem_weight_from_qto", "compute_progress_soft", "list_casos", "teste", "startup")
+
+
+def _best_of(fn, repeat):
+    best, out = None, None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        dt = time.perf_counter() - t0
+        best = dt if best is None else min(best, dt)
+    return best, out
+
+
+def _percentiles(samples_s):
+    xs = sorted(samples_s)
+    pick = lambda q: xs[min(len(xs) - 1, int(q * len(xs)))]
+    return {"n": len(xs), "p50_ms": round(1000 * pick(0.5), 3), "p95_ms": round(1000 * pick(0.95), 3),
+            "max_ms": round(1000 * xs[-1], 3)}
+
+
+def _ifc(work, elements, qto):
+    # Gerado uma vez por diretório de trabalho (mesma semente → mesmo arquivo)
+    path = os.path.join(work, f"synth_{elements}_qto{int(qto * 100)}.ifc")
+    if not os.path.exists(path):
+        make_ifc(path, elements, qto)
+    return path
+
+
+# ========= IFC =========
+def bench_ifc_weights(main, work, scales, repeat):
+    results = []
+    for elements in scales:
+        for qto in (0.0, 0.6):
+            path = _ifc(work, elements, qto)
+            t_open, model = _best_of(lambda: ifcopenshell.open(path), 1)
+            t_weights, (_, totals) = _best_of(lambda: main.ifc_weights_from_model(model), repeat)
+            results.append({
+                "elements": elements, "qto_fraction": qto, "size_bytes": os.path.getsize(path),
+                "mapped": sum(totals.values()), "open_s": round(t_open, 4), "weights_s": round(t_weights, 4),
+                "elements_per_s": round(elements / t_weights) if t_weights else None,
+            })
+            del model
+    return results
+
+
+def bench_elem_weight_from_qto(main, work, elements, repeat):
+    model = ifcopenshell.open(_ifc(work, elements, 0.6))
+    elems = model.by_type("IfcElement")
+    t, _ = _best_of(lambda: [main.elem_weight_from_qto(e) for e in elems], repeat)
+    return {"elements": len(elems), "total_s": round(t, 4), "us_per_element": round(1e6 * t / len(elems), 3)}
+
+
+def bench_compute_progress_soft(main, work, calls, repeat):
+    weights, totals = main.build_ifc_weights(_ifc(work, 10_000, 0.6))
+    rng = random.Random(0)
+    inputs = []
+    for _ in range(calls):
+        strict = {c: rng.randint(0, 5) for c in weights if rng.random() < 0.6}
+        lenient = {c: k + rng.randint(0, 3) for c, k in strict.items()}
+        inputs.append((strict, lenient, rng.randint(0, 3)))
+    run = lambda: [main.compute_progress_soft(weights, totals, s, l, generic_hits=g) for s, l, g in inputs]
+    t, _ = _best_of(run, repeat)
+    return {"calls": calls, "categories": len(weights), "total_s": round(t, 4), "us_per_call": round(1e6 * t / calls, 3)}
+
+
+# ========= /casos =========
+def bench_list_casos(main, rows, repeat):
+    from fastapi.testclient import TestClient
+    seeded = seed_submissions(rows)
+    client = TestClient(main.app)
+
+    def timed(url, headers=None, expect=200):
+        samples = []
+        for _ in range(repeat):
+            t0 = time.perf_counter()
+            r = client.get(url, headers=headers or {})
+            samples.append(time.perf_counter() - t0)
+            if r.status_code != expect:
+                raise RuntimeError(f"GET {url}: {r.status_code} {r.text[:200]}")
+        return r, _percentiles(samples)
+
+    out = {"rows": rows, "seed_s": seeded["elapsed_s"]}
+    r, out["first_page"] = timed("/casos")
+    _, out["first_page_500"] = timed("/casos?limit=500")
+    _, out["projection"] = timed("/casos?limit=500&campos=id,caso,progress_pct")
+    _, out["filter_caso"] = timed("/casos?caso=" + r.json()["cases"][0]["caso"])
+    _, out["total_count"] = timed("/casos?limit=1&total=true")
+    _, out["not_modified"] = timed("/casos", headers={"If-None-Match": r.headers["etag"]}, expect=304)
+    # Paginação funda: 20 páginas seguidas pelo cursor
+    t0 = time.perf_counter()
+    cursor, pages = None, 0
+    for _ in range(20):
+        body = client.get("/casos?limit=100" + (f"&cursor={cursor}" if cursor else "")).json()
+        pages += 1
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+    out["cursor_walk"] = {"pages": pages, "ms_per_page": round(1000 * (time.perf_counter() - t0) / pages, 3)}
+    return out
+
+
+# ========= POST /teste de ponta a ponta =========
+def _free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def bench_teste(work, clients, requests_per_client, workers, detect_ms, photos, timeout):
+    try:
+        import httpx
+        import uvicorn  # noqa: F401
+    except ImportError as e:
+        return {"skipped": f"dependência ausente: {e.name}"}
+    data_dir = os.path.join(work, "e2e")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    ifc = _ifc(work, 10_000, 0.6)
+    imgs = []
+    for i in range(photos):
+        path = os.path.join(work, f"photo_{i}.jpg")
+        if not os.path.exists(path):
+            make_photo(path, 1600, 1200, seed=i)
+        imgs.append(path)
+
+    port = _free_port()
+    env = dict(os.environ, PIMETRO_DATA_DIR=data_dir, DETECTOR_BACKEND="stub", STUB_DETECT_MS=str(detect_ms),
+               ANALYSIS_WORKERS=str(workers), ANALYSIS_QUEUE_MAX=str(max(8, 2 * clients)))
+    # Log em arquivo e grupo de processos próprio: o pool de análise e o
+    # resource_tracker não ficam presos ao stdout de quem chamou a suíte
+    log = open(os.path.join(work, "e2e.log"), "w")
+    server = subprocess.Popen([sys.executable, "-m", "uvicorn", "main:app", "--port", str(port), "--log-level", "warning"],
+                              cwd=_BACK_END, env=env, stdout=log, stderr=subprocess.STDOUT, start_new_session=True)
+    base = f"http://127.0.0.1:{port}"
+    try:
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                if httpx.get(base + "/ready", timeout=5).status_code == 200:
+                    break
+            except httpx.TransportError:
+                pass
+            if server.poll() is not None or time.monotonic() > deadline:
+                raise RuntimeError("servidor não ficou pronto")
+            time.sleep(0.5)
+
+        latencies, statuses, lock = [], {}, threading.Lock()
+
+        def client(k):
+            with httpx.Client(base_url=base, timeout=timeout) as c:
+                for i in range(requests_per_client):
+                    img = imgs[(k * requests_per_client + i) % len(imgs)]
+                    with open(img, "rb") as fi, open(ifc, "rb") as ff:
+                        t0 = time.perf_counter()
+                        r = c.post("/teste", data={"caso": f"bench {k}"}, files={"img": fi, "ifc": ff})
+                        dt = time.perf_counter() - t0
+                    with lock:
+                        statuses[r.status_code] = statuses.get(r.status_code, 0) + 1
+                        if r.status_code == 200:
+                            latencies.append(dt)
+
+        t0 = time.perf_counter()
+        threads = [threading.Thread(target=client, args=(k,)) for k in range(clients)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        wall = time.perf_counter() - t0
+    finally:
+        server.terminate()
+        try:
+            server.wait(timeout=30)
+        except subprocess.TimeoutExpired:
+            server.kill()
+        try:
+            os.killpg(server.pid, signal.SIGKILL)
+        except ProcessLookupError:
+            pass
+        log.close()
+    return {
+        "clients": clients, "requests": clients * requests_per_client, "analysis_workers": workers,
+        "stub_detect_ms": detect_ms, "distinct_photos": len(imgs), "wall_s": round(wall, 3),
+        "throughput_rps": round(statuses.get(200, 0) / wall, 3) if wall else None,
+        "status": {str(k): v for k, v in sorted(statuses.items())},
+        "latency": _percentiles(latencies) if latencies else None,
+    }
+
+
+# ========= Boot =========
+def bench_startup(work, repeat):
+    # Interpretador novo a cada vez: o que um worker do uvicorn (ou um --reload) paga antes de servir
+    env = dict(os.environ, PIMETRO_DATA_DIR=os.path.join(work, "startup"), DETECTOR_BACKEND="stub")
+    code = "import json, main; print(json.dumps(main._STARTUP))"
+    walls, imports = [], []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = subprocess.run([sys.executable, "-c", code], cwd=_BACK_END, env=env, capture_output=True,
+                             text=True, check=True).stdout
+        walls.append(time.perf_counter() - t0)
+        imports.append(json.loads(out.strip().splitlines()[-1])["import_s"])
+    return {"runs": repeat, "process_s": round(min(walls), 3), "import_main_s": round(min(imports), 3)}
+
+
+# ========= Comparação =========
+def _numbers(node, prefix=""):
+    if isinstance(node, dict):
+        for k, v in node.items():
+            yield from _numbers(v, f"{prefix}.{k}" if prefix else k)
+    elif isinstance(node, list):
+        for i, v in enumerate(node):
+            yield from _numbers(v, f"{prefix}[{i}]")
+    elif isinstance(node, (int, float)) and not isinstance(node, bool):
+        yield prefix, node
+
+
+def compare(base, current):
+    # Métricas de tempo (_s, _ms, us_) lado a lado; razão > 1 = mais lento que a base
+    old = dict(_numbers(base.get("results", {})))
+    out = {}
+    for path, value in _numbers(current.get("results", {})):
+        leaf = path.rsplit(".", 1)[-1]
+        if path in old and old[path] and (leaf.endswith(("_s", "_ms")) or leaf.startswith("us_")):
+            out[path] = {"base": old[path], "atual": value, "razao": round(value / old[path], 3)}
+    return out
+
+
+def _git_revision():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=_BACK_END, capture_output=True,
+                              text=True, timeout=10).stdout.strip() or None
+    except (OSError, subprocess.SubprocessError):
+        return None
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmarks dos caminhos quentes (dados sintéticos, detector stub)")
+    ap.add_argument("--so", help=f"lista separada por vírgulas entre: {', '.join(BENCHMARKS)}")
+    ap.add_argument("--escalas", default="1000,10000,100000", help="elementos dos IFCs sintéticos")
+    ap.add_argument("--linhas", type=int, default=100_000, help="submissões semeadas para list_casos")
+    ap.add_argument("--repeat", type=int, default=5)
+    ap.add_argument("--clientes", type=int, default=4)
+    ap.add_argument("--req-por-cliente", type=int, default=5)
+    ap.add_argument("--workers", type=int, default=1, help="ANALYSIS_WORKERS do servidor do teste de ponta a ponta")
+    ap.add_argument("--detect-ms", type=float, default=150.0, help="custo simulado do forward do stub, por imagem")
+    ap.add_argument("--fotos", type=int, default=8, help="fotos sintéticas distintas no teste de ponta a ponta")
+    ap.add_argument("--timeout", type=float, default=600.0)
+    ap.add_argument("--trabalho", help="diretório dos dados gerados (reaproveitado entre execuções)")
+    ap.add_argument("--saida", help="arquivo JSON do resultado (além da saída padrão)")
+    ap.add_argument("--base", help="JSON de uma execução anterior para comparar")
+    args = ap.parse_args(argv)
+
+    selected = [b.strip() for b in args.so.split(",")] if args.so else list(BENCHMARKS)
+    unknown = [b for b in selected if b not in BENCHMARKS]
+    if unknown:
+        ap.error(f"benchmark desconhecido: {', '.join(unknown)}")
+    scales = [int(x) for x in args.escalas.split(",") if x.strip()]
+    work = args.trabalho or tempfile.mkdtemp(prefix="pimetro-bench-")
+    os.makedirs(work, exist_ok=True)
+    # Banco novo a cada execução; IFCs e fotos gerados ficam para a próxima
+    data_dir = os.path.join(work, "data")
+    shutil.rmtree(data_dir, ignore_errors=True)
+    main = load_main(data_dir)
+
+    results = {}
+    started_at = datetime.now(timezone.utc).isoformat()
+    t0 = time.perf_counter()
+    if "ifc_weights" in selected:
+        results["ifc_weights"] = bench_ifc_weights(main, work, scales, args.repeat)
+    if "elem_weight_from_qto" in selected:
+        results["elem_weight_from_qto"] = bench_elem_weight_from_qto(main, work, min(max(scales), 100_000), args.repeat)
+    if "compute_progress_soft" in selected:
+        results["compute_progress_soft"] = bench_compute_progress_soft(main, work, 20_000, args.repeat)
+    if "list_casos" in selected:
+        results["list_casos"] = bench_list_casos(main, args.linhas, max(args.repeat, 20))
+    if "teste" in selected:
+        results["teste"] = bench_teste(work, args.clientes, args.req_por_cliente, args.workers,
+                                       args.detect_ms, args.fotos, args.timeout)
+    if "startup" in selected:
+        results["startup"] = bench_startup(work, args.repeat)
+
+    report = {
+        "benchmark": "suite",
+        "meta": {
+            "started_at": started_at, "git": _git_revision(),
+            "python": platform.python_version(), "platform": platform.platform(),
+            "cpus": os.cpu_count(), "work_dir": work, "elapsed_s": round(time.perf_counter() - t0, 2),
+            "args": vars(args),
+        },
+        "results": results,
+    }
+    if args.base:
+        with open(args.base, encoding="utf-8") as f:
+            report["comparacao"] = compare(json.load(f), report)
+    text = json.dumps(report, indent=2, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, "w", encoding="utf-8") as f:
+            f.write(text + "\n")
+    print(text)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
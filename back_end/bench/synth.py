@@ -0,0 +1,230 @@
+# Dados sintéticos e reprodutíveis para os benchmarks: IFCs de 1k a 1M
+# elementos nos tipos de IFC_TO_CAT (com ou sem IfcElementQuantity), fotos
+# e um banco com quantas submissões se queira. Mesma semente → mesmo arquivo.
+#
+#   python -m bench.synth ifc modelo_100k.ifc --elementos 100000 --qto 0.6
+#   python -m bench.synth foto canteiro.jpg --largura 4000 --altura 3000
+#   python -m bench.synth banco --linhas 1000000 --dados /tmp/pimetro-bench
+#
+# O IFC é escrito direto em STEP (o ifcopenshell levaria minutos para montar
+# 1M entidades); os atributos de cada entidade vêm do schema do ifcopenshell,
+# então o arquivo abre em qualquer versão que tenha o schema pedido.
+import argparse
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import uuid
+from datetime import datetime, timedelta, timezone
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def load_main(data_dir=None, backend="stub"):
+    # main com banco e blobs num diretório descartável e, por padrão, o detector stub
+    if "main" not in sys.modules:
+        if data_dir:
+            os.environ["PIMETRO_DATA_DIR"] = data_dir
+        os.environ.setdefault("PIMETRO_DATA_DIR", tempfile.mkdtemp(prefix="pimetro-bench-"))
+        os.environ.setdefault("DETECTOR_BACKEND", backend)
+    import main
+    return main
+
+
+# ========= IFC =========
+# IFC2X3/IFC4 não têm os tipos de via (IfcRail, IfcTrackElement): ficam de fora
+IFC_SCHEMA = "IFC4X3"
+STOREYS = 8
+CONTAINMENT_CHUNK = 10_000    # elementos por IfcRelContainedInSpatialStructure
+
+
+class _Ref(int):
+    pass
+
+
+def _step(value):
+    if value is None:
+        return "$"
+    if isinstance(value, _Ref):
+        return f"#{int(value)}"
+    if isinstance(value, str):
+        return "'" + value.replace("'", "''") + "'"
+    if isinstance(value, float):
+        return f"{value:.6f}"
+    if isinstance(value, (list, tuple)):
+        return "(" + ",".join(_step(v) for v in value) + ")"
+    return str(value)
+
+
+class _StepWriter:
+    def __init__(self, f, schema):
+        from ifcopenshell import ifcopenshell_wrapper
+        self.f = f
+        self.schema = ifcopenshell_wrapper.schema_by_name(schema)
+        self.next_id = 1
+        self._attrs = {}
+
+    def has(self, entity):
+        try:
+            decl = self.schema.declaration_by_name(entity)
+        except Exception:
+            return False
+        return not decl.is_abstract()
+
+    def add(self, entity, **values):
+        names = self._attrs.get(entity)
+        if names is None:
+            names = self._attrs[entity] = [a.name() for a in self.schema.declaration_by_name(entity).all_attributes()]
+        id_ = _Ref(self.next_id)
+        self.next_id += 1
+        self.f.write(f"#{id_}={entity.upper()}({','.join(_step(values.get(n)) for n in names)});\n")
+        return id_
+
+
+def _guid(rng):
+    from ifcopenshell.guid import compress
+    return compress(uuid.UUID(int=rng.getrandbits(128)).hex)
+
+
+def make_ifc(path, elements=1000, qto=0.5, seed=0, schema=IFC_SCHEMA, storeys=STOREYS):
+    # `qto`: fração dos elementos com IfcElementQuantity (volume, área ou
+    # comprimento; alguns com volume zero, que cai para a área)
+    main = load_main()
+    rng = random.Random(seed)
+    with open(path, "w", encoding="ascii") as f:
+        w = _StepWriter(f, schema)
+        types = [t for t in main.IFC_TO_CAT if w.has(t)]
+        f.write("ISO-10303-21;\nHEADER;\nFILE_DESCRIPTION(('ViewDefinition [ReferenceView]'),'2;1');\n"
+                f"FILE_NAME('{os.path.basename(path)}','2024-01-01T00:00:00',('PiMetro bench'),(''),"
+                f"'bench.synth','bench.synth','');\nFILE_SCHEMA(('{schema}'));\nENDSEC;\nDATA;\n")
+        project = w.add("IfcProject", GlobalId=_guid(rng), Name="Projeto sintetico")
+        site = w.add("IfcSite", GlobalId=_guid(rng), Name="Canteiro")
+        building = w.add("IfcBuilding", GlobalId=_guid(rng), Name="Estacao")
+        levels = [w.add("IfcBuildingStorey", GlobalId=_guid(rng), Name=f"Nivel {i}", Elevation=float(-4 * i))
+                  for i in range(max(1, storeys))]
+        w.add("IfcRelAggregates", GlobalId=_guid(rng), RelatingObject=project, RelatedObjects=[site])
+        w.add("IfcRelAggregates", GlobalId=_guid(rng), RelatingObject=site, RelatedObjects=[building])
+        w.add("IfcRelAggregates", GlobalId=_guid(rng), RelatingObject=building, RelatedObjects=levels)
+
+        contained = [[] for _ in levels]
+        with_qto = 0
+        for i in range(elements):
+            t = rng.choice(types)
+            e = w.add(t, GlobalId=_guid(rng), Name=f"{t[3:]} {i}")
+            contained[rng.randrange(len(levels))].append(e)
+            if rng.random() < qto:
+                with_qto += 1
+                kind = rng.random()
+                if kind < 0.5:
+                    q = [w.add("IfcQuantityVolume", Name="NetVolume",
+                               VolumeValue=0.0 if kind < 0.05 else round(rng.uniform(0.1, 40.0), 3))]
+                    if kind < 0.05:
+                        q.append(w.add("IfcQuantityArea", Name="NetArea", AreaValue=round(rng.uniform(0.5, 60.0), 3)))
+                elif kind < 0.8:
+                    q = [w.add("IfcQuantityArea", Name="NetArea", AreaValue=round(rng.uniform(0.5, 60.0), 3))]
+                else:
+                    q = [w.add("IfcQuantityLength", Name="Length", LengthValue=round(rng.uniform(0.2, 25.0), 3))]
+                eq = w.add("IfcElementQuantity", GlobalId=_guid(rng), Name="Qto_Base", Quantities=q)
+                w.add("IfcRelDefinesByProperties", GlobalId=_guid(rng), RelatedObjects=[e],
+                      RelatingPropertyDefinition=eq)
+        for level, elems in zip(levels, contained):
+            for i in range(0, len(elems), CONTAINMENT_CHUNK):
+                w.add("IfcRelContainedInSpatialStructure", GlobalId=_guid(rng),
+                      RelatedElements=elems[i:i + CONTAINMENT_CHUNK], RelatingStructure=level)
+        f.write("ENDSEC;\nEND-ISO-10303-21;\n")
+    return {"path": path, "schema": schema, "elements": elements, "with_qto": with_qto,
+            "types": len(types), "storeys": len(levels), "size_bytes": os.path.getsize(path)}
+
+
+# ========= Fotos =========
+def make_photo(path, width=4000, height=3000, seed=0, quality=90):
+    # Céu em degradê, chão texturizado e "peças" (retângulos e barras) com bordas
+    # nítidas: exercita o decode, as miniaturas e o filtro de bordas dos recortes
+    import cv2
+    rng = np.random.default_rng(seed)
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    horizon = int(height * rng.uniform(0.25, 0.45))
+    sky = np.linspace(235, 170, horizon, dtype=np.float32)[:, None]
+    img[:horizon] = np.stack([sky + 10, sky, sky - 30], axis=-1).clip(0, 255).astype(np.uint8)
+    ground = rng.normal(120, 18, (height - horizon, width // 8, 3)).clip(0, 255).astype(np.uint8)
+    img[horizon:] = cv2.resize(ground, (width, height - horizon), interpolation=cv2.INTER_NEAREST)
+    for _ in range(int(rng.integers(20, 60))):
+        x, y = int(rng.integers(0, width)), int(rng.integers(horizon // 2, height))
+        w, h = int(rng.integers(width // 60, width // 6)), int(rng.integers(height // 60, height // 4))
+        color = tuple(int(c) for c in rng.integers(40, 200, 3))
+        cv2.rectangle(img, (x, y), (x + w, y + h), color, -1 if rng.random() < 0.7 else max(2, width // 500))
+    for _ in range(int(rng.integers(5, 20))):
+        p1 = (int(rng.integers(0, width)), int(rng.integers(horizon, height)))
+        p2 = (int(rng.integers(0, width)), int(rng.integers(horizon, height)))
+        cv2.line(img, p1, p2, (60, 60, 70), max(2, width // 400))
+    if not cv2.imwrite(path, img, [cv2.IMWRITE_JPEG_QUALITY, quality]):
+        raise RuntimeError(f"Falha ao gravar {path}")
+    return {"path": path, "width": width, "height": height, "size_bytes": os.path.getsize(path)}
+
+
+# ========= Banco =========
+CASOS = ["Túnel Leste", "Pátio AMV", "Estação Y", "Galeria X", "Poço Z", "Sala Técnica", "Via 2", "Subestação"]
+
+
+def seed_submissions(rows=100_000, casos=40, days=365, seed=0, chunk=50_000, img_path=None, ifc_path=None):
+    # Linhas pela mesma inserção do /seed (triggers de versão e agregados
+    # incluídos), em transações de `chunk` linhas; datas espalhadas em `days` dias
+    main = load_main()
+    rng = random.Random(seed)
+    names = [f"{CASOS[i % len(CASOS)]} {i // len(CASOS) + 1}" for i in range(max(1, casos))]
+    now = datetime.now(timezone.utc)
+    t0 = time.perf_counter()
+    done = 0
+    while done < rows:
+        n = min(chunk, rows - done)
+        batch = []
+        for _ in range(n):
+            at = now - timedelta(seconds=rng.uniform(0, days * 86400))
+            batch.append((rng.choice(names), f"Inspeção {done + len(batch)}", round(rng.uniform(0, 100), 1),
+                          img_path, ifc_path, at.isoformat()))
+        main.save_submissions(batch)
+        done += n
+    return {"rows": rows, "casos": len(names), "days": days, "elapsed_s": round(time.perf_counter() - t0, 2),
+            "db_path": main.DB_PATH}
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Dados sintéticos para os benchmarks")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    a = sub.add_parser("ifc", help="IFC sintético")
+    a.add_argument("saida")
+    a.add_argument("--elementos", type=int, default=1000)
+    a.add_argument("--qto", type=float, default=0.5, help="fração dos elementos com IfcElementQuantity")
+    a.add_argument("--schema", default=IFC_SCHEMA)
+    a.add_argument("--andares", type=int, default=STOREYS)
+    a.add_argument("--semente", type=int, default=0)
+    a = sub.add_parser("foto", help="foto sintética (JPEG)")
+    a.add_argument("saida")
+    a.add_argument("--largura", type=int, default=4000)
+    a.add_argument("--altura", type=int, default=3000)
+    a.add_argument("--semente", type=int, default=0)
+    a = sub.add_parser("banco", help="submissões sintéticas no banco de PIMETRO_DATA_DIR (ou --dados)")
+    a.add_argument("--linhas", type=int, default=100_000)
+    a.add_argument("--casos", type=int, default=40)
+    a.add_argument("--dias", type=int, default=365)
+    a.add_argument("--dados", help="diretório de dados (padrão: PIMETRO_DATA_DIR ou um temporário)")
+    a.add_argument("--semente", type=int, default=0)
+    args = ap.parse_args(argv)
+
+    if args.cmd == "ifc":
+        out = make_ifc(args.saida, args.elementos, args.qto, args.semente, args.schema, args.andares)
+    elif args.cmd == "foto":
+        out = make_photo(args.saida, args.largura, args.altura, args.semente)
+    else:
+        load_main(args.dados)
+        out = seed_submissions(args.linhas, args.casos, args.dias, args.semente)
+    print(json.dumps(out, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -0,0 +1,258 @@
+# Recalibração em lote: pontua todos os casos guardados para uma grade de
+# (beta_lenient, eps_fallback, rail_boost) de uma vez, com NumPy.
+#
+# Os casos viram matrizes casos × categorias (pesos, totais do IFC e
+# contagens strict/lenient tiradas do detection_store), e a grade inteira é
+# avaliada sem voltar ao loop por dicionário de compute_progress_soft.
+#
+#   python calibration.py --betas 0.5:0.9:0.05 --eps 0.05:0.2:0.01 \
+#       --referencias levantamento.csv [--saida progresso.npy]
+#
+# O CSV de referência tem as colunas id,progress_pct (levantamento manual).
+import argparse
+import csv
+import json
+import sys
+import time
+
+import numpy as np
+
+# Mesmo layout de main._DET_RECORD ("<5fHB")
+DET_DTYPE = np.dtype([("box", "<f4", (4,)), ("conf", "<f4"), ("alias", "<u2"), ("pass", "u1")])
+
+
+class CaseMatrices:
+    # ids: (n,) ids das submissões; categories: nomes das colunas.
+    # W/T: pesos e totais do IFC; S/L: contagens strict/lenient; G: generic_hits.
+    # unindexed: ids com zona deixados de fora (IFC ainda sem índice de zonas).
+    def __init__(self, ids, categories, W, T, S, L, G, unindexed=()):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.categories = list(categories)
+        self.W, self.T, self.S, self.L = W, T, S, L
+        self.G = G
+        self.unindexed = list(unindexed)
+
+    def __len__(self):
+        return len(self.ids)
+
+
+def load_cases(conf_strict=0.22, conf_lenient=0.03, ids=None):
+    # Lê pesos (ifc_weights_cache) e detecções (detection_store) de todas as
+    # submissões que têm ambos; casos sem detecção guardada ficam de fora.
+    # Submissão com zona usa os pesos da zona (ifc_zone_index), como no serviço;
+    # o IFC nunca é aberto aqui: sem índice gravado, o caso fica de fora
+    # (`python reprocess.py --indexar` monta os que faltam).
+    import main
+
+    categories = list(main.CATEGORY_ALIASES)
+    col = {c: i for i, c in enumerate(categories)}
+    generic = np.array([c in main.GENERIC_CUE_CANONS for c in categories])
+    thr_s = np.float32(conf_strict)
+    thr_l = np.float32(conf_lenient)
+
+    with main._db.read() as conn:
+        rows = conn.execute("""
+            SELECT s.id, w.weights_by_cat, w.totals_by_cat, d.vocab_sha, d.aliases, d.records,
+                   s.zone, s.ifc_path, s.ifc_sha256, COALESCE(s.ignore_mep, 1)
+            FROM submissions s
+            JOIN ifc_weights_cache w
+              ON w.ifc_sha256 = s.ifc_sha256 AND w.ignore_mep = COALESCE(s.ignore_mep, 1)
+             AND w.mapping_version = ?
+            JOIN detection_store d
+              ON d.img_sha256 = s.img_sha256 AND d.weights = ? AND d.imgsz = ?
+            WHERE s.views_combine IS NULL    -- casos de várias vistas: só pelo rescore
+            ORDER BY s.id
+        """, (main.MAPPING_VERSION, main.detector_key(main.YOLO_WEIGHTS), main.DETECT_IMGSZ)).fetchall()
+    main.metrics.inc("pimetro_db_rows_total", len(rows), query="calibracao")
+
+    wanted = set(ids) if ids is not None else None
+    out_ids, W, T, S, L, unindexed = [], [], [], [], [], []
+    vocab_cols = {}
+    for id_, w_json, t_json, vocab_sha, aliases_json, records, zone, ifc_path, ifc_sha256, ignore_mep in rows:
+        if wanted is not None and id_ not in wanted:
+            continue
+        weights = json.loads(w_json)
+        # Mesma foto pode ter detecções de outros vocabulários; vale a do IFC do caso
+        if vocab_sha != main.vocabulary_sha(main.vocabulary_for(weights)):
+            continue
+        totals = json.loads(t_json)
+        if zone:
+            try:
+                weights, totals, _ = main.zone_weights(ifc_path, bool(ignore_mep), ifc_sha256, zone, parse=False)
+            except main.IfcNotIndexed:
+                unindexed.append(id_)
+                continue
+            except ValueError:
+                continue
+        alias_cols = vocab_cols.get(vocab_sha)
+        if alias_cols is None:
+            alias_cols = vocab_cols[vocab_sha] = np.array(
+                [col[main.ALIAS_TO_CANON[a]] for a in json.loads(aliases_json)], dtype=np.int64)
+        rec = np.frombuffer(records, dtype=DET_DTYPE)
+        cats = alias_cols[rec["alias"]] if len(rec) else np.zeros(0, dtype=np.int64)
+        strict = (rec["pass"] == main.PASS_STRICT) & (rec["conf"] > thr_s)
+        lenient = (rec["pass"] == main.PASS_LENIENT) & (rec["conf"] > thr_l)
+
+        w_row = np.zeros(len(categories))
+        t_row = np.zeros(len(categories))
+        for c, v in weights.items():
+            w_row[col[c]] = v
+        for c, v in totals.items():
+            t_row[col[c]] = v
+        out_ids.append(id_)
+        W.append(w_row)
+        T.append(t_row)
+        S.append(np.bincount(cats[strict], minlength=len(categories)))
+        L.append(np.bincount(cats[lenient], minlength=len(categories)))
+
+    n, C = len(out_ids), len(categories)
+    stack = lambda rows: np.vstack(rows).astype(np.float64) if rows else np.zeros((0, C))
+    L_m = stack(L)
+    G = L_m[:, generic].sum(1)
+    return CaseMatrices(out_ids, categories, stack(W), stack(T), stack(S), L_m, G, unindexed)
+
+
+def score_grid(m, betas, eps_values, boosts=(0.08,), rail_in_progress=False,
+               rail_cues=(), rail_related=(), max_cells=2e7):
+    # Progresso (%) para cada caso e combinação: array (n, B, E, K).
+    #
+    # Mesmo cálculo de compute_progress_soft (sem o arredondamento a 0.1):
+    # ratio = clip((S + beta·L) / max(T, 1)), e ε onde ratio == 0 e há pistas
+    # genéricas. Como no serviço, apply_rail_prior só mexe nos ratios
+    # devolvidos, então o eixo K só varia com rail_in_progress=True, que
+    # aplica o reforço de via antes de ponderar (para calibrar essa opção).
+    betas = np.asarray(betas, dtype=np.float64)
+    eps = np.clip(np.asarray(eps_values, dtype=np.float64), 0.0, 1.0)
+    boosts = np.asarray(boosts, dtype=np.float64)
+    n, C = m.W.shape
+    B, E, K = len(betas), len(eps), len(boosts)
+    out = np.empty((n, B, E, K), dtype=np.float32)
+    if n == 0:
+        return out
+
+    wsum = m.W.sum(1)
+    inv = np.where(wsum > 0, 100.0 / np.where(wsum > 0, wsum, 1.0), 0.0)
+    T1 = np.maximum(m.T, 1.0)
+    has_generic = m.G > 0
+    col = {c: i for i, c in enumerate(m.categories)}
+    rel = [col[c] for c in rail_related if c in col]
+    cue = [col[c] for c in rail_cues if c in col]
+    per_case = B * C + (B * E * K * max(len(rel), 1) if rail_in_progress else 0)
+    chunk = max(1, int(max_cells // per_case))
+
+    for a in range(0, n, chunk):
+        sl = slice(a, min(a + chunk, n))
+        W, S, L = m.W[sl], m.S[sl], m.L[sl]
+        R = (S[None] + betas[:, None, None] * L[None]) / T1[sl][None]      # B×n×C
+        Z = (R == 0) & has_generic[sl][None, :, None]
+        base = np.einsum("bnc,nc->nb", np.minimum(R, 1.0), W)
+        zw = np.einsum("bnc,nc->nb", Z, W)
+        prog = base[:, :, None] + zw[:, :, None] * eps[None, None, :]     # n×B×E
+        prog = np.repeat(prog[..., None], K, axis=3)
+        if rail_in_progress and rel:
+            saw = (S[:, cue] + L[:, cue]).sum(1) > 0 if cue else np.zeros(len(W), bool)
+            Rr = np.minimum(R[:, :, rel], 1.0)                                 # B×n×r
+            Zr = Z[:, :, rel]
+            ratio = np.where(Zr[..., None], eps[None, None, None, :], Rr[..., None])  # B×n×r×E
+            Wr = W[:, rel] * ((W[:, rel] > 0) & saw[:, None])                # só categorias do caso
+            lift = np.maximum(boosts[None, None, None, None, :] - ratio[..., None], 0.0)
+            extra = np.einsum("bnrek,nr->nbek", lift, Wr)
+            prog = prog + extra
+        out[sl] = prog * inv[sl, None, None, None]
+    return out
+
+
+def grid_errors(progress, ids, references):
+    # MAE, RMSE e viés por combinação contra os valores de referência
+    idx = {int(i): k for k, i in enumerate(ids)}
+    pairs = [(idx[int(i)], v) for i, v in references.items() if int(i) in idx]
+    if not pairs:
+        return None
+    rows = np.array([p[0] for p in pairs])
+    ref = np.array([p[1] for p in pairs], dtype=np.float64)
+    diff = progress[rows].astype(np.float64) - ref.reshape(-1, *([1] * (progress.ndim - 1)))
+    return {
+        "n": len(pairs),
+        "mae": np.abs(diff).mean(0),
+        "rmse": np.sqrt((diff ** 2).mean(0)),
+        "bias": diff.mean(0),
+    }
+
+
+def calibrate(betas, eps_values, boosts=(0.08,), references=None, conf_strict=0.22,
+              conf_lenient=0.03, rail_in_progress=False, top=10):
+    import main
+
+    t0 = time.perf_counter()
+    m = load_cases(conf_strict=conf_strict, conf_lenient=conf_lenient)
+    t1 = time.perf_counter()
+    progress = score_grid(m, betas, eps_values, boosts, rail_in_progress=rail_in_progress,
+                          rail_cues=sorted(main.RAIL_CUE_CANONS), rail_related=main.RAIL_PRIOR_RELATED)
+    t2 = time.perf_counter()
+    summary = {
+        "cases": len(m), "combos": int(np.prod(progress.shape[1:])),
+        "grid": {"beta_lenient": list(map(float, betas)), "eps_fallback": list(map(float, eps_values)),
+                 "rail_boost": list(map(float, boosts))},
+        "load_s": round(t1 - t0, 4), "score_s": round(t2 - t1, 4),
+    }
+    if m.unindexed:
+        summary["unindexed"] = len(m.unindexed)
+        summary["hint"] = (f"{len(m.unindexed)} submissões com zona ficaram de fora: o IFC ainda não tem "
+                           "índice de zonas. Rode `python reprocess.py --indexar` e calibre de novo.")
+    errs = grid_errors(progress, m.ids, references or {})
+    if errs is not None:
+        order = np.argsort(errs["mae"], axis=None)[:top]
+        ranking = []
+        for flat in order:
+            b, e, k = np.unravel_index(flat, errs["mae"].shape)
+            ranking.append({
+                "beta_lenient": float(betas[b]), "eps_fallback": float(eps_values[e]),
+                "rail_boost": float(boosts[k]),
+                "mae": float(errs["mae"][b, e, k]), "rmse": float(errs["rmse"][b, e, k]),
+                "bias": float(errs["bias"][b, e, k]),
+            })
+        summary["references"] = errs["n"]
+        summary["ranking"] = ranking
+    return summary, m, progress
+
+
+def _grid_arg(text):
+    # "0.5:0.9:0.05" (início:fim:passo, fim incluso) ou "0.6,0.7,0.8"
+    if ":" in text:
+        start, stop, step = (float(x) for x in text.split(":"))
+        return list(np.round(np.arange(start, stop + step / 2, step), 10))
+    return [float(x) for x in text.split(",")]
+
+
+def _read_references(path):
+    with open(path, newline="", encoding="utf-8") as f:
+        return {int(r["id"]): float(r["progress_pct"]) for r in csv.DictReader(f)}
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Recalibração em lote dos casos guardados")
+    ap.add_argument("--betas", type=_grid_arg, default=[0.70])
+    ap.add_argument("--eps", type=_grid_arg, default=[0.12])
+    ap.add_argument("--boosts", type=_grid_arg, default=[0.08])
+    ap.add_argument("--conf-strict", type=float, default=0.22)
+    ap.add_argument("--conf-lenient", type=float, default=0.03)
+    ap.add_argument("--rail-in-progress", action="store_true",
+                    help="aplica o reforço de via antes de ponderar o progresso")
+    ap.add_argument("--referencias", help="CSV com id,progress_pct")
+    ap.add_argument("--saida", help="grava a matriz de progresso (casos × combinações) em .npy")
+    ap.add_argument("--top", type=int, default=10)
+    args = ap.parse_args(argv)
+
+    refs = _read_references(args.referencias) if args.referencias else None
+    summary, m, progress = calibrate(args.betas, args.eps, args.boosts, refs, args.conf_strict,
+                                     args.conf_lenient, args.rail_in_progress, args.top)
+    if args.saida:
+        np.save(args.saida, progress.reshape(len(m), -1))
+        np.save(args.saida.replace(".npy", "") + "_ids.npy", m.ids)
+        summary["matrix"] = args.saida
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
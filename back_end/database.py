@@ -0,0 +1,128 @@
+# Acesso ao SQLite: pool de conexões por processo, WAL e migrações.
+#
+# Cada conexão é usada por uma thread de cada vez (pega do pool, devolvida
+# no fim do bloco `with`). Escritas rodam em BEGIN IMMEDIATE: o lock de
+# escrita é pego logo no início e o busy_timeout espera a vez, em vez de
+# falhar com "database is locked" no meio de um ler-e-depois-gravar.
+#
+#   pool = SQLitePool(DB_PATH)
+#   pool.on_first_use(lambda p: migrate(p, MIGRATIONS))   # adiado até a 1ª conexão
+#   with pool.read() as conn: ...
+#   with pool.transaction() as conn: ...   # commit no fim, rollback em erro
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+
+PRAGMAS = (
+    "PRAGMA synchronous=NORMAL",     # seguro com WAL; fsync só no checkpoint
+    "PRAGMA busy_timeout=15000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",      # ~16 MB por conexão
+    "PRAGMA mmap_size=268435456",
+)
+
+
+class SQLitePool:
+    def __init__(self, path: str, size: int = 8, timeout: float = 15.0):
+        self.path = path
+        self.size = size
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._setup = None
+        self._setup_lock = threading.RLock()
+        self._setup_running = False
+        self._reset()
+
+    def on_first_use(self, setup):
+        # setup(pool) roda uma vez, antes da primeira conexão entregue: importar
+        # o módulo não abre o banco nem disputa o lock de escrita das migrações
+        self._setup = setup
+
+    def _run_setup(self):
+        # RLock: o próprio setup usa o pool; as outras threads esperam ele acabar
+        with self._setup_lock:
+            if self._setup is None or self._setup_running:
+                return
+            self._setup_running = True
+            try:
+                self._setup(self)
+                self._setup = None
+            finally:
+                self._setup_running = False
+
+    def _reset(self):
+        # Conexões não atravessam fork/spawn: cada processo monta o seu pool
+        self._pid = os.getpid()
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None, check_same_thread=False)
+        conn.execute("PRAGMA journal_mode=WAL")
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        return conn
+
+    def _acquire(self):
+        if self._setup is not None:
+            self._run_setup()
+        with self._lock:
+            if self._pid != os.getpid():
+                self._reset()
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def _release(self, conn):
+        # Acima do tamanho do pool a conexão extra é fechada
+        if self._pid == os.getpid() and self._idle.qsize() < self.size and not conn.in_transaction:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+    @contextmanager
+    def read(self):
+        conn = self._acquire()
+        try:
+            yield conn
+        finally:
+            self._release(conn)
+
+    @contextmanager
+    def transaction(self):
+        conn = self._acquire()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield conn
+            except BaseException:
+                conn.execute("ROLLBACK")
+                raise
+            conn.execute("COMMIT")
+        finally:
+            self._release(conn)
+
+    def close(self):
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+def migrate(pool: SQLitePool, migrations):
+    # migrations: lista de funções f(conn); a posição + 1 é a versão gravada
+    # em PRAGMA user_version. As pendentes rodam juntas numa transação; banco
+    # em dia é só uma leitura, sem o lock de escrita (boot de vários workers)
+    with pool.read() as conn:
+        if conn.execute("PRAGMA user_version").fetchone()[0] >= len(migrations):
+            return len(migrations)
+    with pool.transaction() as conn:
+        version = conn.execute("PRAGMA user_version").fetchone()[0]
+        for i, step in enumerate(migrations[version:], start=version + 1):
+            step(conn)
+            conn.execute(f"PRAGMA user_version={i}")
+    return len(migrations)
@@ -0,0 +1,135 @@
+# Exporta o YOLO-World para um runtime de CPU (ONNX Runtime ou OpenVINO) com
+# o vocabulário inteiro (YOLO_CLASSES) fixo na cabeça: os embeddings de texto
+# viram constantes e o CLIP sai do caminho da inferência. Cada IFC continua
+# usando só os seus aliases; main.apply_vocabulary filtra as classes.
+#
+#   python export_detector.py --backend openvino [--int8 --fotos 300]
+#   python export_detector.py --backend onnx [--int8]
+#
+# INT8: quantização pós-treino calibrada nas fotos já guardadas (blobs das
+# submissões). OpenVINO usa o NNCF do próprio exportador do ultralytics;
+# ONNX usa onnxruntime.quantization (QDQ, por canal).
+# O arquivo sai em main.exported_model_path(); DETECTOR_BACKEND/DETECTOR_INT8
+# escolhem qual o servidor carrega.
+import argparse
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import main
+
+
+def calibration_photos(limit=300):
+    # Fotos das submissões (e das vistas), as mais recentes primeiro; vídeos ficam de fora
+    with main._db.read() as conn:
+        rows = conn.execute("""
+            SELECT img_path FROM submissions WHERE img_exists = 1 AND views_combine IS NULL
+            UNION
+            SELECT media_path FROM submission_views WHERE frame_ms IS NULL
+        """).fetchall()
+    paths = [p for (p,) in rows
+             if os.path.splitext(p)[1].lower() not in main.VIDEO_EXTS and os.path.exists(p)]
+    paths.sort(key=os.path.getmtime, reverse=True)
+    return paths[:limit]
+
+
+def _calibration_dataset(photos, workdir):
+    # Dataset no formato do ultralytics (só imagens; rótulos não são usados na calibração)
+    img_dir = os.path.join(workdir, "images")
+    os.makedirs(img_dir)
+    for i, src in enumerate(photos):
+        dst = os.path.join(img_dir, f"{i:05d}{os.path.splitext(src)[1].lower()}")
+        try:
+            os.symlink(src, dst)
+        except OSError:
+            shutil.copy(src, dst)
+    data = os.path.join(workdir, "data.yaml")
+    with open(data, "w", encoding="utf-8") as f:
+        json.dump({"path": workdir, "train": "images", "val": "images",
+                   "names": dict(enumerate(main.YOLO_CLASSES))}, f, ensure_ascii=False)
+    return data
+
+
+class _PhotoReader:
+    # CalibrationDataReader do onnxruntime: mesmo letterbox/normalização do predictor
+    def __init__(self, photos, input_name, imgsz):
+        from ultralytics.data.augment import LetterBox
+        self._photos = iter(photos)
+        self._input = input_name
+        self._letterbox = LetterBox(new_shape=(imgsz, imgsz), auto=False)
+
+    def get_next(self):
+        from ultralytics.utils.patches import imread
+        for path in self._photos:
+            image = imread(path)
+            if image is None:
+                continue
+            x = self._letterbox(image=image)[..., ::-1].transpose(2, 0, 1)
+            return {self._input: np.ascontiguousarray(x[None], dtype=np.float32) / 255.0}
+        return None
+
+
+def _quantize_onnx(fp32_path, out_path, photos, imgsz):
+    import onnx
+    from onnxruntime.quantization import QuantFormat, QuantType, quantize_static
+    input_name = onnx.load(fp32_path, load_external_data=False).graph.input[0].name
+    quantize_static(fp32_path, out_path, _PhotoReader(photos, input_name, imgsz),
+                    quant_format=QuantFormat.QDQ, per_channel=True,
+                    activation_type=QuantType.QUInt8, weight_type=QuantType.QInt8)
+
+
+def export(yolo_weights, backend, int8=False, photos=None, imgsz=None):
+    imgsz = imgsz or main.DETECT_IMGSZ
+    out = main.exported_model_path(yolo_weights, backend, int8)
+    if int8 and not photos:
+        raise RuntimeError("INT8 precisa de fotos guardadas para a calibração")
+    os.makedirs(main._EXPORT_DIR, exist_ok=True)
+
+    from ultralytics import YOLOWorld
+    model = YOLOWorld(yolo_weights)
+    model.set_classes(list(main.YOLO_CLASSES))
+    with tempfile.TemporaryDirectory(dir=main._EXPORT_DIR) as work:
+        # Entrada dinâmica: o mesmo arquivo atende DETECT_IMGSZ, recortes e lotes
+        kwargs = {"format": backend, "imgsz": imgsz, "dynamic": True}
+        if backend == "openvino" and int8:
+            kwargs.update(int8=True, data=_calibration_dataset(photos, work), fraction=1.0)
+        exported = model.export(**kwargs)
+        if backend == "onnx" and int8:
+            quantized = os.path.join(work, "int8.onnx")
+            _quantize_onnx(exported, quantized, photos, imgsz)
+            os.remove(exported)
+            exported = quantized
+        if os.path.isdir(out):
+            shutil.rmtree(out)
+        shutil.move(exported, out)
+    return out
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Exporta o detector para ONNX Runtime/OpenVINO")
+    ap.add_argument("--backend", choices=[b for b in main.DETECTOR_BACKENDS if b != "torch"], required=True)
+    ap.add_argument("--weights", default=main.YOLO_WEIGHTS)
+    ap.add_argument("--int8", action="store_true", help="quantização INT8 calibrada nas fotos guardadas")
+    ap.add_argument("--fotos", type=int, default=300, help="máximo de fotos usadas na calibração INT8")
+    ap.add_argument("--imgsz", type=int, default=main.DETECT_IMGSZ)
+    args = ap.parse_args(argv)
+
+    photos = calibration_photos(args.fotos) if args.int8 else None
+    t0 = time.perf_counter()
+    out = export(args.weights, args.backend, args.int8, photos, args.imgsz)
+    print(json.dumps({
+        "backend": args.backend, "int8": args.int8, "weights": args.weights,
+        "classes": len(main.YOLO_CLASSES), "calibration_photos": len(photos or ()),
+        "path": out, "elapsed_s": round(time.perf_counter() - t0, 1),
+        "env": {"DETECTOR_BACKEND": args.backend, "DETECTOR_INT8": "1" if args.int8 else "0"},
+    }, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
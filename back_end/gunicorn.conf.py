@@ -0,0 +1,24 @@
+# Várias réplicas da API no mesmo nó com uma só cópia dos pesos na memória
+# (a partir de back_end/):
+#
+#   ANALYSIS_WORKERS=0 WEB_CONCURRENCY=4 gunicorn -c gunicorn.conf.py main:app
+#
+# preload_app importa o main no master; when_ready carrega o modelo ali
+# (main.preload_model) e congela o heap do GC antes do fork, para que os
+# workers herdem pesos e objetos copy-on-write sem tocá-los a cada coleta.
+# Cada worker roda o próprio forward de aquecimento no startup do app.
+# Com ANALYSIS_WORKERS > 0 ou INFERENCE_SOCKET o modelo vive em outro
+# processo e a pré-carga não se aplica (o master só importa o main).
+import gc
+import os
+
+bind = os.getenv("GUNICORN_BIND", "0.0.0.0:8000")
+workers = int(os.getenv("WEB_CONCURRENCY", "2"))
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+
+
+def when_ready(server):
+    import main
+    main.preload_model()
+    gc.freeze()
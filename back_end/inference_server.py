@@ -0,0 +1,286 @@
+# Servidor de inferência: um processo por nó é dono dos modelos; os workers da
+# API (uvicorn --workers N) e do pool de análise falam com ele por um socket
+# Unix em vez de cada um carregar o próprio YOLO-World.
+#
+#   INFERENCE_SOCKET=/run/pimetro/infer.sock python inference_server.py
+#   INFERENCE_SOCKET=/run/pimetro/infer.sock uvicorn main:app --workers 4
+#
+# Os pedidos de todos os clientes entram numa fila. Um lote sai quando junta
+# INFERENCE_MAX_BATCH imagens ou quando o primeiro pedido já esperou
+# INFERENCE_MAX_WAIT_MS. Só dividem um forward pedidos com os mesmos pesos,
+# vocabulário, imgsz, piso de confiança, passada e tamanho de imagem; as
+# caixas saem iguais às de um forward local.
+#
+# Protocolo: cada mensagem é <u32 tamanho do cabeçalho><cabeçalho JSON>
+# seguido das imagens (arrays C-contíguos) descritas em "arrays".
+import argparse
+import json
+import logging
+import os
+import queue
+import socket
+import socketserver
+import struct
+import sys
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import Future
+
+import numpy as np
+
+MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "8"))
+MAX_WAIT_MS = float(os.getenv("INFERENCE_MAX_WAIT_MS", "10"))
+CONNECT_TIMEOUT = float(os.getenv("INFERENCE_CONNECT_TIMEOUT", "300"))
+_HEADER = struct.Struct("<I")
+
+
+def _recv_exact(sock, n):
+    buf = bytearray(n)
+    view = memoryview(buf)
+    got = 0
+    while got < n:
+        k = sock.recv_into(view[got:], n - got)
+        if not k:
+            raise ConnectionError("Conexão com o servidor de inferência encerrada")
+        got += k
+    return buf
+
+
+def send_message(sock, header, arrays=()):
+    arrays = [np.ascontiguousarray(a) for a in arrays]
+    header = dict(header, arrays=[{"shape": a.shape, "dtype": str(a.dtype)} for a in arrays])
+    raw = json.dumps(header).encode()
+    sock.sendall(_HEADER.pack(len(raw)) + raw)
+    for a in arrays:
+        sock.sendall(memoryview(a).cast("B"))
+
+
+def recv_message(sock):
+    (n,) = _HEADER.unpack(_recv_exact(sock, _HEADER.size))
+    header = json.loads(_recv_exact(sock, n))
+    arrays = []
+    for spec in header.pop("arrays", ()):
+        dtype, shape = np.dtype(spec["dtype"]), tuple(spec["shape"])
+        buf = _recv_exact(sock, int(np.prod(shape)) * dtype.itemsize)
+        arrays.append(np.frombuffer(buf, dtype=dtype).reshape(shape))
+    return header, arrays
+
+
+# ========= Cliente (processos da API) =========
+class InferenceClient:
+    # Uma conexão por thread: os pedidos de uma thread são sequenciais e os
+    # de threads diferentes chegam juntos ao servidor, que os agrupa
+    def __init__(self, path):
+        self.path = path
+        self._local = threading.local()
+        self._info = {}
+
+    def _conn(self):
+        sock = getattr(self._local, "sock", None)
+        if sock is None or self._local.pid != os.getpid():
+            sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            sock.connect(self.path)
+            self._local.sock, self._local.pid = sock, os.getpid()
+        return sock
+
+    def _drop(self):
+        sock = getattr(self._local, "sock", None)
+        self._local.sock = None
+        if sock is not None:
+            try:
+                sock.close()
+            except OSError:
+                pass
+
+    def call(self, header, arrays=()):
+        # Uma nova tentativa se a conexão caiu (servidor reiniciado); inferência é idempotente
+        for attempt in (0, 1):
+            try:
+                sock = self._conn()
+                send_message(sock, header, arrays)
+                reply, _ = recv_message(sock)
+                break
+            except OSError:
+                self._drop()
+                if attempt:
+                    raise
+        if not reply.get("ok"):
+            raise RuntimeError(reply.get("error") or "Falha no servidor de inferência")
+        return reply
+
+    def info(self, yolo_weights):
+        info = self._info.get(yolo_weights)
+        if info is None:
+            reply = self.call({"op": "info", "weights": yolo_weights})
+            info = self._info[yolo_weights] = {"backend": reply["backend"],
+                                               "honours_augment": reply["honours_augment"]}
+        return info
+
+    def wait_ready(self, yolo_weights, timeout=CONNECT_TIMEOUT):
+        deadline = time.monotonic() + timeout
+        while True:
+            try:
+                return self.info(yolo_weights)
+            except (FileNotFoundError, ConnectionRefusedError):
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"Servidor de inferência não respondeu em {self.path}")
+                time.sleep(0.5)
+
+    def predict(self, yolo_weights, images, classes, imgsz, conf_floor, augment, pass_id):
+        reply = self.call({"op": "predict", "weights": yolo_weights, "classes": list(classes),
+                           "imgsz": imgsz, "conf": conf_floor, "augment": bool(augment),
+                           "pass_id": pass_id}, images)
+        return [[tuple(d) for d in dets] for dets in reply["dets"]]
+
+    def stats(self):
+        return self.call({"op": "stats"})["stats"]
+
+
+# ========= Servidor =========
+class _Request:
+    __slots__ = ("header", "images", "future")
+
+    def __init__(self, header, images):
+        self.header, self.images, self.future = header, images, Future()
+
+    @property
+    def key(self):
+        h = self.header
+        return (h["weights"], tuple(h["classes"]), h["imgsz"], h["conf"], h["augment"], h["pass_id"],
+                self.images[0].shape)
+
+
+class Batcher:
+    def __init__(self, predict, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self._predict = predict
+        self.max_batch = max(1, max_batch)
+        self.max_wait = max_wait_ms / 1000.0
+        self._queue = queue.Queue()
+        self.stats = {"requests": 0, "images": 0, "forwards": 0, "largest_batch": 0}
+        threading.Thread(target=self._loop, name="inference-batcher", daemon=True).start()
+
+    def submit(self, header, images):
+        req = _Request(header, images)
+        self._queue.put(req)
+        return req.future
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        size = len(batch[0].images)
+        deadline = time.monotonic() + self.max_wait
+        while size < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                req = self._queue.get(timeout=remaining)
+            except queue.Empty:
+                break
+            batch.append(req)
+            size += len(req.images)
+        return batch
+
+    def _loop(self):
+        while True:
+            groups = defaultdict(list)
+            for req in self._collect():
+                if not req.images:
+                    req.future.set_result([])
+                    continue
+                groups[req.key].append(req)
+            for reqs in groups.values():
+                self._run(reqs)
+
+    def _run(self, reqs):
+        h = reqs[0].header
+        images = [im for req in reqs for im in req.images]
+        try:
+            dets = []
+            for i in range(0, len(images), self.max_batch):
+                chunk = images[i:i + self.max_batch]
+                dets += self._predict(h["weights"], chunk, h["classes"], h["imgsz"], h["conf"],
+                                      h["augment"], h["pass_id"])
+                self.stats["forwards"] += 1
+                self.stats["largest_batch"] = max(self.stats["largest_batch"], len(chunk))
+        except Exception as e:
+            logging.getLogger("pimetro.inference").exception("Lote de %d imagem(ns) falhou", len(images))
+            for req in reqs:
+                req.future.set_exception(e)
+            return
+        self.stats["requests"] += len(reqs)
+        self.stats["images"] += len(images)
+        start = 0
+        for req in reqs:
+            req.future.set_result(dets[start:start + len(req.images)])
+            start += len(req.images)
+
+
+class _Handler(socketserver.BaseRequestHandler):
+    def handle(self):
+        server = self.server
+        while True:
+            try:
+                header, arrays = recv_message(self.request)
+            except (ConnectionError, OSError):
+                return
+            try:
+                op = header.get("op")
+                if op == "predict":
+                    reply = {"ok": True, "dets": server.batcher.submit(header, arrays).result()}
+                elif op == "info":
+                    reply = {"ok": True, **server.info(header["weights"])}
+                elif op == "stats":
+                    reply = {"ok": True, "stats": dict(server.batcher.stats)}
+                else:
+                    reply = {"ok": False, "error": f"Operação desconhecida: {op}"}
+            except Exception as e:
+                reply = {"ok": False, "error": str(e) or type(e).__name__}
+            send_message(self.request, reply)
+
+
+class InferenceServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, main_module, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.main = main_module
+        self.batcher = Batcher(main_module.predict_boxes, max_batch, max_wait_ms)
+        if os.path.exists(path):
+            os.unlink(path)  # socket de uma execução anterior
+        super().__init__(path, _Handler)
+        os.chmod(path, 0o660)
+
+    def info(self, yolo_weights):
+        model, _ = self.main.get_model(yolo_weights)
+        return {"backend": self.main.backend_key(yolo_weights),
+                "honours_augment": self.main.honours_augment(model)}
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Servidor de inferência compartilhado (socket Unix)")
+    ap.add_argument("--socket", default=os.getenv("INFERENCE_SOCKET"), required=not os.getenv("INFERENCE_SOCKET"))
+    ap.add_argument("--max-batch", type=int, default=MAX_BATCH)
+    ap.add_argument("--max-wait-ms", type=float, default=MAX_WAIT_MS)
+    args = ap.parse_args(argv)
+
+    import main
+    main.INFERENCE_SOCKET = None   # este processo é o dono dos modelos
+    main.warmup_models()
+    if main._WARMUP["status"] != "ready":
+        print(f"Falha ao carregar o modelo: {main._WARMUP['error']}", file=sys.stderr)
+        return 1
+    with InferenceServer(args.socket, main, args.max_batch, args.max_wait_ms) as server:
+        print(f"Servidor de inferência em {args.socket} (lote até {args.max_batch}, "
+              f"espera até {args.max_wait_ms:g} ms)", flush=True)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            if os.path.exists(args.socket):
+                os.unlink(args.socket)
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
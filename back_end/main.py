@@ -1,20 +1,61 @@
 # main.py (com editar/deletar + seed)
-from fastapi import FastAPI, UploadFile, File, Form, Request, HTTPException
+import time
+_IMPORT_T0 = time.perf_counter()   # tempo de boot reportado no log e no /ready
+
+from fastapi import FastAPI, Request, HTTPException, Query, Response
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.responses import JSONResponse
 from fastapi.staticfiles import StaticFiles
+from pydantic import BaseModel
 
 from tempfile import NamedTemporaryFile
-from typing import Optional, Dict
-from collections import defaultdict
+from typing import Optional, Dict, List
+from collections import defaultdict, OrderedDict
 from datetime import datetime, timezone, timedelta
-import sqlite3
-import shutil
+from email.utils import format_datetime, parsedate_to_datetime
+from urllib.parse import parse_qsl
 import os
 import base64
+import threading
+import asyncio
+import json
+import uuid
+import hashlib
+import struct
+import random
+import cProfile
+import contextvars
+import logging
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from contextlib import asynccontextmanager, contextmanager
+try:
+    import fcntl
+except ImportError:  # Windows: limites de etapa valem por processo
+    fcntl = None
+
+# ========= Log =========
+# Falhas de jobs, do pool e dos workers vão para o log do servidor com nível
+# e pid (uvicorn e gunicorn só configuram os próprios loggers). LOG_LEVEL
+# ajusta o nível; um handler já configurado pela aplicação é respeitado.
+logger = logging.getLogger("pimetro")
+if not logger.handlers:
+    _log_handler = logging.StreamHandler()
+    _log_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s [pid %(process)d] %(name)s: %(message)s"))
+    logger.addHandler(_log_handler)
+    logger.setLevel(os.getenv("LOG_LEVEL", "INFO").upper())
+    logger.propagate = False
 
 # ========= App & Paths =========
-app = FastAPI(title="IFC x Foto — Andamento de Obra (Metrô/Obras Civis)")
+@asynccontextmanager
+async def _lifespan(app):
+    # Aquecimento e retomada dos jobs na subida; métricas e pool na descida (ver Jobs)
+    _start_analysis()
+    yield
+    _stop_analysis()
+
+app = FastAPI(title="IFC x Foto — Andamento de Obra (Metrô/Obras Civis)", lifespan=_lifespan)
 app.add_middleware(
     CORSMiddleware,
     allow_origins=["*"],
@@ -24,19 +65,54 @@ app.add_middleware(
 )
 
 _BASE_DIR = os.path.dirname(__file__)
-_DB_DIR = os.path.join(_BASE_DIR, "db")
+# Banco, blobs e derivados; os benchmarks apontam para um diretório descartável
+_DB_DIR = os.getenv("PIMETRO_DATA_DIR") or os.path.join(_BASE_DIR, "db")
 os.makedirs(_DB_DIR, exist_ok=True)
 
-# Static: serve tudo que estiver dentro de /db
-app.mount("/files", StaticFiles(directory=_DB_DIR), name="files")
+# Static: só os arquivos dos casos. Banco, perfis, métricas, vagas e modelos
+# exportados também moram em /db e ficam de fora.
+_BLOB_DIR = os.path.abspath(os.path.join(_DB_DIR, "blobs"))
+# Blob store, fotos do /seed e pastas case_<nome> de antes do blob store
+_PUBLIC_DIRS = ("blobs", "seed")
+_PUBLIC_DIR_PREFIX = "case_"
+
+def _is_public_file(full_path: str) -> bool:
+    parts = os.path.relpath(full_path, os.path.realpath(_DB_DIR)).split(os.sep)
+    return len(parts) > 1 and (parts[0] in _PUBLIC_DIRS or parts[0].startswith(_PUBLIC_DIR_PREFIX))
+
+class _FilesWithBlobCache(StaticFiles):
+    def lookup_path(self, path):
+        full_path, stat_result = super().lookup_path(path)
+        if stat_result is None or not _is_public_file(full_path):
+            return "", None
+        return full_path, stat_result
+
+    # Blobs (originais e derivados) são endereçados pelo conteúdo: nunca mudam
+    def file_response(self, full_path, stat_result, scope, status_code=200):
+        response = super().file_response(full_path, stat_result, scope, status_code)
+        if os.path.commonpath([os.path.abspath(full_path), _BLOB_DIR]) == _BLOB_DIR:
+            response.headers["Cache-Control"] = "public, max-age=31536000, immutable"
+        return response
+
+app.mount("/files", _FilesWithBlobCache(directory=_DB_DIR), name="files")
 
 DB_PATH = os.path.join(_DB_DIR, "database.db")
 
 # ========= YOLO / IFC deps =========
-from ultralytics import YOLOWorld
-import ifcopenshell
+# ultralytics (torch), ifcopenshell, cv2 e numpy são importados na primeira
+# análise, foto ou aquecimento: listar casos, /ready, o próprio boot e os CLIs
+# que importam o main não pagam esse tempo
+from database import SQLitePool, migrate
+import metrics
 
 YOLO_WEIGHTS = os.getenv("YOLOWORLD_WEIGHTS", "yolov8x-worldv2.pt")
+# torch (YOLOWorld em PyTorch), onnx (ONNX Runtime) ou openvino; os dois
+# últimos usam o modelo exportado por export_detector.py, com o vocabulário
+# inteiro (YOLO_CLASSES) fixo na cabeça. "stub" (fora de DETECTOR_BACKENDS)
+# é o detector determinístico dos benchmarks, bench/stub_detector.py
+DETECTOR_BACKEND = os.getenv("DETECTOR_BACKEND", "torch").lower()
+DETECTOR_INT8 = os.getenv("DETECTOR_INT8", "0").lower() in {"1", "true", "yes", "on"}
+DETECTOR_BACKENDS = ("torch", "onnx", "openvino")
 
 # =========== Categorias & Aliases (PT/EN) ===========
 CATEGORY_ALIASES = {
@@ -110,6 +186,147 @@ for canon, aliases in CATEGORY_ALIASES.items():
         YOLO_CLASSES.append(a)
         ALIAS_TO_CANON[a] = canon
 
+# ========= Registro de modelos (vida do processo) =========
+# Um modelo por (pesos, backend), carregado uma única vez e já com as
+# classes definidas (embeddings CLIP calculados no carregamento). O lock
+# serializa o uso do modelo entre as requisições.
+_MODELS: Dict[str, "YOLOWorld"] = {}
+_MODEL_LOCKS: Dict[str, threading.Lock] = {}
+_REGISTRY_LOCK = threading.Lock()
+# startup: modelo carregado e aquecido numa thread logo no boot (/ready em 503
+# até terminar); lazy: só na primeira análise, e a réplica fica pronta no
+# tempo do import — a primeira análise paga a carga
+MODEL_WARMUP = os.getenv("MODEL_WARMUP", "startup").lower()
+_WARMUP = {"status": "lazy" if MODEL_WARMUP == "lazy" else "pending",
+           "error": None, "started_at": None, "finished_at": None}
+_STARTUP = {"pid": os.getpid(), "import_s": None, "serving_s": None, "model_s": None}
+_EXPORT_DIR = os.path.abspath(os.path.join(_DB_DIR, "exports"))
+
+def backend_key(yolo_weights: str, backend: Optional[str] = None, int8: Optional[bool] = None) -> str:
+    backend = DETECTOR_BACKEND if backend is None else backend
+    int8 = DETECTOR_INT8 if int8 is None else int8
+    if backend == "torch":
+        return yolo_weights
+    return f"{yolo_weights}#{backend}{'-int8' if int8 else ''}"
+
+def exported_model_path(yolo_weights: str, backend: Optional[str] = None, int8: Optional[bool] = None) -> str:
+    # db/exports/<pesos>-<vocabulário>[-int8].onnx ou ..._openvino_model/
+    backend = DETECTOR_BACKEND if backend is None else backend
+    int8 = DETECTOR_INT8 if int8 is None else int8
+    stem = os.path.splitext(os.path.basename(yolo_weights))[0]
+    name = f"{stem}-{vocabulary_sha(YOLO_CLASSES)}{'-int8' if int8 else ''}"
+    if backend == "onnx":
+        return os.path.join(_EXPORT_DIR, name + ".onnx")
+    return os.path.join(_EXPORT_DIR, name + "_openvino_model")
+
+def get_model(yolo_weights: str = YOLO_WEIGHTS):
+    key = backend_key(yolo_weights)
+    with _REGISTRY_LOCK:
+        model = _MODELS.get(key)
+        if model is None:
+            with metrics.timer("model_load"):
+                if DETECTOR_BACKEND == "torch":
+                    from ultralytics import YOLOWorld
+                    model = YOLOWorld(yolo_weights)
+                    model.set_classes(YOLO_CLASSES)
+                elif DETECTOR_BACKEND == "stub":
+                    from bench.stub_detector import StubDetector
+                    model = StubDetector(YOLO_CLASSES)
+                elif DETECTOR_BACKEND in DETECTOR_BACKENDS:
+                    path = exported_model_path(yolo_weights)
+                    if not os.path.exists(path):
+                        raise RuntimeError(f"Modelo exportado não encontrado em {path} "
+                                           f"(gere com: python export_detector.py --backend {DETECTOR_BACKEND}"
+                                           f"{' --int8' if DETECTOR_INT8 else ''})")
+                    from ultralytics import YOLO
+                    model = YOLO(path, task="detect")
+                else:
+                    raise RuntimeError(f"DETECTOR_BACKEND inválido: {DETECTOR_BACKEND}")
+            metrics.inc("pimetro_model_loads_total", backend=DETECTOR_BACKEND)
+            _MODELS[key] = model
+            _MODEL_LOCKS[key] = threading.Lock()
+        return model, _MODEL_LOCKS[key]
+
+# Servidor de inferência compartilhado (inference_server.py): com
+# INFERENCE_SOCKET, este processo não carrega modelo; os forwards vão pelo
+# socket Unix e o servidor junta em lotes os pedidos de todos os workers
+INFERENCE_SOCKET = os.getenv("INFERENCE_SOCKET") or None
+_INFERENCE_CLIENT = None
+
+def inference_client():
+    global _INFERENCE_CLIENT
+    with _REGISTRY_LOCK:
+        if _INFERENCE_CLIENT is None:
+            from inference_server import InferenceClient
+            _INFERENCE_CLIENT = InferenceClient(INFERENCE_SOCKET)
+        return _INFERENCE_CLIENT
+
+def warmup_models():
+    import numpy as np
+    _WARMUP.update(status="loading", started_at=datetime.now(timezone.utc).isoformat())
+    t0 = time.perf_counter()
+    try:
+        if INFERENCE_SOCKET:
+            # O modelo é do servidor: só espera ele responder já aquecido
+            inference_client().wait_ready(YOLO_WEIGHTS)
+        else:
+            import ifcopenshell  # noqa: F401  (o primeiro IFC não paga o import)
+            model, lock = get_model(YOLO_WEIGHTS)
+            # Uma inferência vazia já monta o predictor (fuse, letterbox no imgsz usado)
+            with lock:
+                model.predict(source=np.zeros((64, 64, 3), dtype=np.uint8), imgsz=1920, verbose=False)
+        _WARMUP.update(status="ready", finished_at=datetime.now(timezone.utc).isoformat())
+        _STARTUP["model_s"] = round(time.perf_counter() - t0, 3)
+        logger.info("Modelo %s pronto em %.2fs", backend_key(YOLO_WEIGHTS), _STARTUP["model_s"])
+    except Exception as e:
+        logger.exception("Falha ao carregar o modelo %s", YOLO_WEIGHTS)
+        _WARMUP.update(status="error", error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+
+def preload_model() -> bool:
+    # Chamado no master do gunicorn (gunicorn.conf.py), antes do fork: pesos e
+    # embeddings do vocabulário ficam em páginas copy-on-write compartilhadas
+    # pelos workers. Só a carga, com o torch em uma thread (o pool de threads
+    # do OpenMP não sobrevive ao fork); o forward de aquecimento roda em cada
+    # worker. Sessões do ONNX Runtime/OpenVINO já sobem threads: não pré-carregam.
+    if INFERENCE_SOCKET or ANALYSIS_WORKERS > 0:
+        logger.info("Pré-carga ignorada: o modelo roda no servidor de inferência ou nos processos de análise")
+        return False
+    if DETECTOR_BACKEND not in ("torch", "stub"):
+        logger.info("Pré-carga ignorada: backend %s não é seguro entre forks", DETECTOR_BACKEND)
+        return False
+    t0 = time.perf_counter()
+    import ifcopenshell  # noqa: F401
+    if DETECTOR_BACKEND == "torch":
+        import torch
+        threads = torch.get_num_threads()
+        torch.set_num_threads(1)
+        try:
+            get_model(YOLO_WEIGHTS)
+        finally:
+            torch.set_num_threads(threads)
+    else:
+        get_model(YOLO_WEIGHTS)
+    logger.info("Modelo %s pré-carregado no master em %.2fs", backend_key(YOLO_WEIGHTS), time.perf_counter() - t0)
+    return True
+
+def _after_fork():
+    # Worker criado por fork (gunicorn com preload): o import foi no master e o
+    # boot do worker conta a partir daqui
+    global _IMPORT_T0
+    _IMPORT_T0 = time.perf_counter()
+    _STARTUP.update(pid=os.getpid(), import_s=0.0, serving_s=None, model_s=None)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+@app.get("/ready")
+async def ready():
+    # lazy: pronto assim que o app sobe; o modelo carrega na primeira análise
+    body = {"ready": _WARMUP["status"] in ("ready", "lazy"), "weights": YOLO_WEIGHTS,
+            "backend": None if INFERENCE_SOCKET else backend_key(YOLO_WEIGHTS),
+            "inference_socket": INFERENCE_SOCKET, **_WARMUP, "startup": _STARTUP}
+    return JSONResponse(body, status_code=200 if body["ready"] else 503)
+
 # ========= IFC → categoria canônica =========
 IFC_TO_CAT = {
     # Civil/estrutura
@@ -146,18 +363,94 @@ MEP_IFC_TYPES = {
     "IfcPipeSegment", "IfcDuctSegment", "IfcPipeFitting", "IfcDuctFitting",
     "IfcCableCarrierSegment", "IfcDistributionChamberElement"
 }
+# Muda sempre que o mapeamento IFC → categoria muda; invalida o cache de pesos
+MAPPING_VERSION = hashlib.sha256(
+    json.dumps([IFC_TO_CAT, sorted(MEP_IFC_TYPES)], sort_keys=True).encode()
+).hexdigest()[:12]
 GENERIC_CUE_CANONS = {
     "generic construction cues",
     "formwork system",
     "scaffold structure",
     "excavator construction machine",
 }
+# Pistas usadas por apply_rail_prior e as categorias que ela reforça
+RAIL_CUE_CANONS = {"rail track", "steel rail bar"}
+RAIL_PRIOR_RELATED = ["track sleeper / tie","rail fastening / clip","turnout / switch","third rail / power rail","ballast"]
+
+# ========= Vocabulário por IFC + cache de embeddings =========
+# O detector é consultado só com os aliases das categorias presentes no IFC
+# (mais as pistas genéricas e de via). Os embeddings de texto de cada
+# vocabulário ficam num LRU por (pesos, lista de aliases).
+VOCAB_CACHE_SIZE = int(os.getenv("YOLO_VOCAB_CACHE_SIZE", "32"))
+_VOCAB_CACHE: "OrderedDict[tuple, object]" = OrderedDict()
+_VOCAB_CACHE_LOCK = threading.Lock()
+
+def vocabulary_for(weights_by_cat) -> tuple:
+    canons = set(weights_by_cat or ()) | GENERIC_CUE_CANONS | RAIL_CUE_CANONS
+    # Ordem estável (a de YOLO_CLASSES): o mesmo conjunto gera sempre a mesma lista
+    return tuple(a for a in YOLO_CLASSES if ALIAS_TO_CANON[a] in canons)
+
+def retarget_predictor(model, txt_feats, classes):
+    # O predictor roda uma cópia fundida do modelo: troca o vocabulário nela
+    # também, em vez de remontá-lo (fusão + aquecimento) a cada troca
+    predictor = model.predictor
+    if predictor is None:
+        return
+    backend = getattr(predictor.model, "backend", predictor.model)
+    fused = getattr(backend, "model", None)
+    if fused is None or not hasattr(fused, "txt_feats"):
+        model.predictor = None
+        return
+    param = next(fused.parameters())
+    fused.txt_feats = txt_feats.to(device=param.device, dtype=param.dtype)
+    fused.model[-1].nc = len(classes)
+    fused.names = list(classes)
+    predictor.model.names = dict(enumerate(classes))
+
+def apply_vocabulary(model, yolo_weights: str, classes):
+    # None: o modelo passa a responder exatamente com `classes`. Modelo
+    # exportado (vocabulário fixo): mapa índice do modelo → índice em
+    # `classes`, -1 para aliases fora do vocabulário do IFC
+    classes = list(classes)
+    if not is_world_model(model):
+        pos = {a: i for i, a in enumerate(classes)}
+        return [pos.get(n, -1) for n in model.names.values()]
+    names = model.model.names
+    names = list(names.values()) if isinstance(names, dict) else list(names)
+    if names == classes:
+        return None
+    # txt_feats e names seguem a ordem de `classes`: a chave também
+    key = (yolo_weights, tuple(classes))
+    with _VOCAB_CACHE_LOCK:
+        txt_feats = _VOCAB_CACHE.get(key)
+        if txt_feats is not None:
+            _VOCAB_CACHE.move_to_end(key)
+    metrics.inc("pimetro_cache_total", cache="vocab", result="miss" if txt_feats is None else "hit")
+    if txt_feats is None:
+        # set_classes descarta o predictor; ele é reaproveitado logo abaixo
+        predictor = model.predictor
+        model.set_classes(classes)
+        model.predictor = predictor
+        txt_feats = model.model.txt_feats
+    else:
+        model.model.txt_feats = txt_feats
+        model.model.model[-1].nc = len(classes)
+        model.model.names = classes
+    retarget_predictor(model, txt_feats, classes)
+    with _VOCAB_CACHE_LOCK:
+        _VOCAB_CACHE[key] = txt_feats
+        _VOCAB_CACHE.move_to_end(key)
+        while len(_VOCAB_CACHE) > VOCAB_CACHE_SIZE:
+            _VOCAB_CACHE.popitem(last=False)
+    return None
 
 # ========= DB helpers =========
-def init_db():
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
+# Pool de conexões do processo (WAL, BEGIN IMMEDIATE nas escritas); ver database.py
+DB_POOL_SIZE = int(os.getenv("SQLITE_POOL_SIZE", "8"))
+_db = SQLitePool(DB_PATH, size=DB_POOL_SIZE)
+
+def _migration_base_schema(conn):
+    conn.execute("""
     CREATE TABLE IF NOT EXISTS submissions (
         id INTEGER PRIMARY KEY AUTOINCREMENT,
         caso TEXT,
@@ -168,61 +461,830 @@ def init_db():
         uploaded_at TEXT
     )
     """)
-    conn.commit()
-    conn.close()
-init_db()
-
-def save_submission(caso: Optional[str], descricao: Optional[str],
-                    progress_pct: float, img_path: str, ifc_path: str):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        INSERT INTO submissions (caso, descricao, progress_pct, img_path, ifc_path, uploaded_at)
-        VALUES (?, ?, ?, ?, ?, ?)
-    """, (caso, descricao, progress_pct, img_path, ifc_path,
-          datetime.now(timezone.utc).isoformat()))
-    conn.commit()
-    conn.close()
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS ifc_weights_cache (
+        ifc_sha256 TEXT,
+        ignore_mep INTEGER,
+        mapping_version TEXT,
+        weights_by_cat TEXT,
+        totals_by_cat TEXT,
+        created_at TEXT,
+        PRIMARY KEY (ifc_sha256, ignore_mep, mapping_version)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS detection_store (
+        img_sha256 TEXT,
+        weights TEXT,
+        vocab_sha TEXT,
+        imgsz INTEGER,
+        aliases TEXT,
+        records BLOB,
+        created_at TEXT,
+        PRIMARY KEY (img_sha256, weights, vocab_sha, imgsz)
+    )
+    """)
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS jobs (
+        id TEXT PRIMARY KEY,
+        kind TEXT,
+        status TEXT,
+        stage TEXT,
+        params TEXT,
+        result TEXT,
+        error TEXT,
+        submission_id INTEGER,
+        created_at TEXT,
+        updated_at TEXT
+    )
+    """)
+    # Colunas novas em bancos criados antes das migrações
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    for col, decl in (("ifc_sha256", "TEXT"), ("img_sha256", "TEXT"), ("ignore_mep", "INTEGER DEFAULT 1")):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE submissions ADD COLUMN {col} {decl}")
+
+def _migration_indexes(conn):
+    # /casos ordena por uploaded_at; id desempata linhas do mesmo instante
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_uploaded_at ON submissions (uploaded_at DESC, id DESC)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_caso ON submissions (caso)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status, created_at)")
+
+def _migration_list_support(conn):
+    # Existência dos arquivos vira coluna (gravada junto com o caminho) e a
+    # versão da tabela, mantida por triggers, dá o ETag de /casos
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    for col in ("img_exists", "ifc_exists"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE submissions ADD COLUMN {col} INTEGER")
+    # Filtro por caso segue a mesma ordem da lista: índice composto
+    conn.execute("DROP INDEX IF EXISTS idx_submissions_caso")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_submissions_caso_uploaded_at ON submissions (caso, uploaded_at DESC, id DESC)")
+    rows = conn.execute("SELECT id, img_path, ifc_path FROM submissions").fetchall()
+    conn.executemany("UPDATE submissions SET img_exists=?, ifc_exists=? WHERE id=?",
+                     [(_file_exists(img), _file_exists(ifc), id_) for id_, img, ifc in rows])
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS table_versions (
+        name TEXT PRIMARY KEY,
+        version INTEGER,
+        updated_at TEXT
+    )
+    """)
+    conn.execute("INSERT OR IGNORE INTO table_versions VALUES ('submissions', 0, ?)",
+                 (datetime.now(timezone.utc).isoformat(),))
+    for event in ("INSERT", "UPDATE", "DELETE"):
+        conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_submissions_{event.lower()} AFTER {event} ON submissions
+        BEGIN
+            UPDATE table_versions SET version = version + 1,
+                updated_at = strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now')
+            WHERE name = 'submissions';
+        END
+        """)
+
+# Agregados do dashboard: contagem e soma de progresso por caso em baldes de
+# hora ("AAAA-MM-DDTHH"), dia ("AAAA-MM-DD") e total (""), recortados do
+# uploaded_at em UTC. Triggers mantêm os baldes na mesma transação da escrita.
+BUCKET_GRAINS = (("hour", "substr({row}.uploaded_at, 1, 13)"),
+                 ("day", "substr({row}.uploaded_at, 1, 10)"),
+                 ("all", "''"))
+
+def _bucket_add_sql(row: str, sign: str) -> str:
+    stmts = []
+    for grain, key in BUCKET_GRAINS:
+        key = key.format(row=row)
+        stmts.append(f"""
+            INSERT INTO submission_buckets (grain, bucket, caso, n, progress_sum)
+            VALUES ('{grain}', {key}, COALESCE({row}.caso, ''), {sign}1, {sign}COALESCE({row}.progress_pct, 0))
+            ON CONFLICT (grain, bucket, caso) DO UPDATE SET
+                n = n + excluded.n, progress_sum = progress_sum + excluded.progress_sum;""")
+        if sign == "-":
+            stmts.append(f"""
+            DELETE FROM submission_buckets
+            WHERE grain = '{grain}' AND bucket = {key} AND caso = COALESCE({row}.caso, '') AND n <= 0;""")
+    return "".join(stmts)
+
+def _migration_dashboard_buckets(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS submission_buckets (
+        grain TEXT,
+        bucket TEXT,
+        caso TEXT,
+        n INTEGER,
+        progress_sum REAL,
+        PRIMARY KEY (grain, bucket, caso)
+    )
+    """)
+    conn.execute("DELETE FROM submission_buckets")
+    for grain, key in BUCKET_GRAINS:
+        conn.execute(f"""
+            INSERT INTO submission_buckets (grain, bucket, caso, n, progress_sum)
+            SELECT '{grain}', {key.format(row="submissions")}, COALESCE(caso, ''), COUNT(*), SUM(COALESCE(progress_pct, 0))
+            FROM submissions GROUP BY 2, 3
+        """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_buckets_insert AFTER INSERT ON submissions
+    BEGIN {_bucket_add_sql("NEW", "+")}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_buckets_delete AFTER DELETE ON submissions
+    BEGIN {_bucket_add_sql("OLD", "-")}
+    END
+    """)
+    conn.execute(f"""
+    CREATE TRIGGER IF NOT EXISTS trg_buckets_update AFTER UPDATE OF caso, progress_pct, uploaded_at ON submissions
+    BEGIN {_bucket_add_sql("OLD", "-")} {_bucket_add_sql("NEW", "+")}
+    END
+    """)
+
+def _migration_blobs(conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        path TEXT UNIQUE,
+        size INTEGER,
+        refcount INTEGER,
+        created_at TEXT
+    )
+    """)
+
+def _migration_renditions(conn):
+    # 1 quando a miniatura/prévia da foto atual já foi gerada
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    if "img_renditions" not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN img_renditions INTEGER DEFAULT 0")
+
+def _migration_lenient_pass(conn):
+    # Como a passada lenient foi obtida: "run" (forward com TTA), "shared"
+    # (modelo sem TTA, mesma saída da strict) ou "skipped" (dispensada)
+    for table in ("detection_store", "submissions"):
+        cols = {r[1] for r in conn.execute(f"PRAGMA table_info({table})")}
+        if "lenient_pass" not in cols:
+            conn.execute(f"ALTER TABLE {table} ADD COLUMN lenient_pass TEXT")
+
+def _migration_views(conn):
+    # Casos com várias fotos ou vídeo: uma linha por vista analisada. A foto
+    # (ou o vídeo) da primeira vista é o img_path da submissão; as demais
+    # mídias têm a referência do blob presa às vistas.
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS submission_views (
+            submission_id INTEGER NOT NULL,
+            position INTEGER NOT NULL,
+            img_sha256 TEXT NOT NULL,      -- sha da foto ou "<sha do vídeo>@<ms>"
+            media_path TEXT NOT NULL,
+            frame_ms INTEGER,              -- NULL para foto
+            PRIMARY KEY (submission_id, position)
+        )
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    if "views_combine" not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN views_combine TEXT")
+
+def _migration_job_timings(conn):
+    # Etapas do job medidas no worker ([[etapa, segundos]]), para o Server-Timing
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(jobs)")}
+    if "timings" not in cols:
+        conn.execute("ALTER TABLE jobs ADD COLUMN timings TEXT")
+
+def _migration_analysis_versions(conn):
+    # Etiqueta de cada análise (detector e mapeamento usados) e o andamento do
+    # reprocessamento do acervo (reprocess.py), que refaz as etiquetas antigas
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    for col in ("model_version", "mapping_version"):
+        if col not in cols:
+            conn.execute(f"ALTER TABLE submissions ADD COLUMN {col} TEXT")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reprocess_runs (
+            id TEXT PRIMARY KEY,
+            status TEXT,                   -- running, paused, interrupted, done, superseded
+            model_version TEXT,
+            mapping_version TEXT,
+            total INTEGER,
+            done INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            skipped INTEGER DEFAULT 0,     -- caso alterado (PUT) durante o reprocessamento
+            workers INTEGER,
+            pid INTEGER,
+            error TEXT,
+            created_at TEXT,
+            updated_at TEXT
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS reprocess_failures (
+            run_id TEXT NOT NULL,
+            submission_id INTEGER NOT NULL,
+            error TEXT,
+            PRIMARY KEY (run_id, submission_id)
+        )
+    """)
+
+def _migration_zones(conn):
+    # Índice espacial do IFC (ver ZoneIndex), gravado junto com os pesos, e a
+    # zona (GlobalId do andar/espaço/trecho) a que a submissão se refere
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS ifc_zone_index (
+            ifc_sha256 TEXT,
+            ignore_mep INTEGER,
+            mapping_version TEXT,
+            zones TEXT,                    -- JSON [[GlobalId, nome, tipo IFC, índice do pai ou -1]]
+            categories TEXT,               -- JSON [categoria], colunas de cat
+            offsets BLOB,                  -- int64: linhas da zona i em [offsets[i], offsets[i+1])
+            cat BLOB,                      -- uint16 por linha
+            weight BLOB,                   -- float64 por linha
+            total BLOB,                    -- int64 por linha
+            created_at TEXT,
+            PRIMARY KEY (ifc_sha256, ignore_mep, mapping_version)
+        )
+    """)
+    cols = {r[1] for r in conn.execute("PRAGMA table_info(submissions)")}
+    if "zone" not in cols:
+        conn.execute("ALTER TABLE submissions ADD COLUMN zone TEXT")
+    # Painel por zona (/dashboard/zonas) filtra por caso e agrupa por zona
+    conn.execute("""
+        CREATE INDEX IF NOT EXISTS idx_submissions_caso_zone ON submissions (caso, zone, uploaded_at)
+        WHERE zone IS NOT NULL
+    """)
+
+# Histórico de progresso: cada análise (ou troca de caso/zona) acrescenta uma
+# medição; nada é reescrito. Uma observação é (submissão, observed_at — a hora
+# da foto); reanalisá-la (reprocessamento, IFC ou zona novos) acrescenta uma
+# revisão, e vale a mais recente. measurement_daily guarda, por caso e dia UTC,
+# os agregados das observações vigentes, mantidos por triggers.
+def _measurement_daily_rebuild_sql(casos: str, day: str) -> str:
+    # Refaz os dias `day` dos casos em `casos` (subconsultas SQL) a partir das revisões vigentes
+    return f"""
+        DELETE FROM measurement_daily WHERE day = {day} AND caso IN ({casos});
+        INSERT INTO measurement_daily (caso, day, n, progress_sum, progress_min, progress_max, last_at)
+        SELECT m.caso, {day}, COUNT(*), SUM(m.progress_pct), MIN(m.progress_pct), MAX(m.progress_pct),
+               MAX(m.observed_at)
+        FROM measurements m
+        WHERE m.caso IN ({casos}) AND m.observed_at >= {day} AND m.observed_at < date({day}, '+1 day')
+          AND NOT EXISTS (SELECT 1 FROM measurements r WHERE r.submission_id = m.submission_id
+                          AND r.observed_at = m.observed_at AND r.id > m.id)
+        GROUP BY m.caso;
+        UPDATE measurement_daily SET last_progress = (
+            SELECT m.progress_pct FROM measurements m
+            WHERE m.caso = measurement_daily.caso AND m.observed_at = measurement_daily.last_at
+            ORDER BY m.id DESC LIMIT 1)
+        WHERE day = {day} AND caso IN ({casos});"""
+
+def _migration_measurements(conn):
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS measurements (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            submission_id INTEGER NOT NULL,    -- sem FK: o histórico sobrevive ao DELETE do caso
+            caso TEXT NOT NULL,                -- '' para caso sem nome
+            zone TEXT,
+            observed_at TEXT NOT NULL,         -- hora da foto (UTC, ISO)
+            recorded_at TEXT NOT NULL,         -- hora da análise
+            progress_pct REAL NOT NULL,
+            ratios BLOB,                       -- registros _RATIO_RECORD (categoria, razão)
+            model_version TEXT,
+            mapping_version TEXT,
+            source TEXT                        -- create, update, reprocess, seed, migration
+        )
+    """)
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_caso_observed ON measurements (caso, observed_at)")
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_measurements_submission ON measurements (submission_id, observed_at)")
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS measurement_categories (
+            id INTEGER PRIMARY KEY,
+            name TEXT UNIQUE NOT NULL
+        )
+    """)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS measurement_daily (
+            caso TEXT,
+            day TEXT,                          -- AAAA-MM-DD (UTC)
+            n INTEGER,
+            progress_sum REAL,
+            progress_min REAL,
+            progress_max REAL,
+            last_at TEXT,
+            last_progress REAL,
+            PRIMARY KEY (caso, day)
+        ) WITHOUT ROWID
+    """)
+    # Uma medição por submissão existente, na hora do upload
+    now = datetime.now(timezone.utc).isoformat()
+    conn.execute("""
+        INSERT INTO measurements (submission_id, caso, zone, observed_at, recorded_at, progress_pct,
+                                  model_version, mapping_version, source)
+        SELECT id, COALESCE(caso, ''), zone, uploaded_at, ?, COALESCE(progress_pct, 0),
+               model_version, mapping_version, 'migration'
+        FROM submissions WHERE uploaded_at IS NOT NULL ORDER BY id
+    """, (now,))
+    conn.execute("DELETE FROM measurement_daily")
+    conn.execute("""
+        INSERT INTO measurement_daily (caso, day, n, progress_sum, progress_min, progress_max, last_at)
+        SELECT caso, substr(observed_at, 1, 10), COUNT(*), SUM(progress_pct), MIN(progress_pct),
+               MAX(progress_pct), MAX(observed_at)
+        FROM measurements GROUP BY 1, 2
+    """)
+    conn.execute("""
+        UPDATE measurement_daily SET last_progress = (
+            SELECT m.progress_pct FROM measurements m
+            WHERE m.caso = measurement_daily.caso AND m.observed_at = measurement_daily.last_at
+            ORDER BY m.id DESC LIMIT 1)
+    """)
+    for event in ("UPDATE", "DELETE"):
+        conn.execute(f"""
+            CREATE TRIGGER IF NOT EXISTS trg_measurements_no_{event.lower()} BEFORE {event} ON measurements
+            BEGIN SELECT RAISE(ABORT, 'measurements só aceita inserção'); END
+        """)
+    same_observation = """
+        SELECT 1 FROM measurements r WHERE r.submission_id = NEW.submission_id
+        AND r.observed_at = NEW.observed_at AND r.id < NEW.id"""
+    # Observação nova: soma no dia. Revisão: refaz o dia dela nos casos envolvidos
+    # (o caso pode ter sido renomeado entre uma revisão e outra)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_measurements_new AFTER INSERT ON measurements
+        WHEN NOT EXISTS ({same_observation})
+        BEGIN
+            INSERT INTO measurement_daily (caso, day, n, progress_sum, progress_min, progress_max, last_at,
+                                           last_progress)
+            VALUES (NEW.caso, substr(NEW.observed_at, 1, 10), 1, NEW.progress_pct, NEW.progress_pct,
+                    NEW.progress_pct, NEW.observed_at, NEW.progress_pct)
+            ON CONFLICT (caso, day) DO UPDATE SET
+                n = n + 1, progress_sum = progress_sum + excluded.progress_sum,
+                progress_min = MIN(progress_min, excluded.progress_min),
+                progress_max = MAX(progress_max, excluded.progress_max),
+                last_progress = CASE WHEN excluded.last_at >= last_at THEN excluded.last_progress
+                                     ELSE last_progress END,
+                last_at = MAX(last_at, excluded.last_at);
+        END
+    """)
+    conn.execute(f"""
+        CREATE TRIGGER IF NOT EXISTS trg_measurements_revision AFTER INSERT ON measurements
+        WHEN EXISTS ({same_observation})
+        BEGIN {_measurement_daily_rebuild_sql(
+            "SELECT caso FROM measurements WHERE submission_id = NEW.submission_id "
+            "AND observed_at = NEW.observed_at", "substr(NEW.observed_at, 1, 10)")}
+        END
+    """)
+
+# Só acrescentar no fim: a posição é a versão gravada em PRAGMA user_version
+MIGRATIONS = [
+    _migration_base_schema,
+    _migration_indexes,
+    _migration_list_support,
+    _migration_dashboard_buckets,
+    _migration_blobs,
+    _migration_renditions,
+    _migration_lenient_pass,
+    _migration_views,
+    _migration_job_timings,
+    _migration_analysis_versions,
+    _migration_zones,
+    _migration_measurements,
+]
+
+def _file_exists(path: Optional[str]) -> int:
+    return int(bool(path) and os.path.exists(path))
+
+def init_db(pool=_db):
+    migrate(pool, MIGRATIONS)
+# Migrações na primeira conexão, não no import
+_db.on_first_use(init_db)
+
+SUBMISSION_INSERT = """
+    INSERT INTO submissions (caso, descricao, progress_pct, img_path, ifc_path, uploaded_at,
+                             ifc_sha256, img_sha256, ignore_mep, img_exists, ifc_exists, img_renditions,
+                             lenient_pass, views_combine, model_version, mapping_version, zone)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+"""
+
+def _submission_values(caso, descricao, progress_pct, img_path, ifc_path, uploaded_at,
+                       ifc_sha256=None, img_sha256=None, ignore_mep=True, img_renditions=False,
+                       lenient_pass=None, views_combine=None, model_version=None, mapping_version=None,
+                       zone=None):
+    # Parâmetros de SUBMISSION_INSERT; os arquivos já estão no lugar final
+    return (caso, descricao, progress_pct, img_path, ifc_path, uploaded_at,
+            ifc_sha256, img_sha256, int(ignore_mep), _file_exists(img_path), _file_exists(ifc_path),
+            int(img_renditions), lenient_pass, views_combine, model_version, mapping_version, zone)
+
+def save_submissions(rows):
+    # Inserção em lote numa única transação; cada linha segue os argumentos
+    # de _submission_values (uploaded_at já em ISO). Os ids de uma transação
+    # de escrita são contíguos: as medições saem de um INSERT ... SELECT só.
+    rows = [_submission_values(*r) for r in rows]
+    if not rows:
+        return
+    with _db.transaction() as conn:
+        conn.executemany(SUBMISSION_INSERT, rows)
+        last = conn.execute("SELECT last_insert_rowid()").fetchone()[0]
+        conn.execute(_measurement_insert_sql("s.id BETWEEN ? AND ? ORDER BY s.id"),
+                     (None, None, "seed", last - len(rows) + 1, last))
 
 def get_case_row(id_: int):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("SELECT id, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at FROM submissions WHERE id=?", (id_,))
-    row = cur.fetchone()
-    conn.close()
-    return row
+    with _db.read() as conn:
+        return conn.execute(
+            "SELECT id, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at FROM submissions WHERE id=?",
+            (id_,)).fetchone()
 
 def update_case_row(id_: int, caso: Optional[str], desc: Optional[str],
                     img_path: Optional[str], ifc_path: Optional[str],
-                    progress_pct: Optional[float] = None): # <-- Novo parâmetro
-    row = get_case_row(id_)
-    if not row: return False
-    _, old_caso, old_desc, old_prog, old_img, old_ifc, up = row # Renomeado prog para old_prog
-    new_caso = caso if caso is not None else old_caso
-    new_desc = desc if desc is not None else old_desc
-    new_img = img_path if img_path is not None else old_img
-    new_ifc = ifc_path if ifc_path is not None else old_ifc
-    new_prog = progress_pct if progress_pct is not None else old_prog # Usa novo progresso ou mantém o antigo
-
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("""
-        UPDATE submissions SET caso=?, descricao=?, progress_pct=?, img_path=?, ifc_path=? WHERE id=?
-    """, (new_caso, new_desc, new_prog, new_img, new_ifc, id_)) # <-- SQL Atualizado
-    conn.commit()
-    conn.close()
-    return True
+                    progress_pct: Optional[float] = None, # <-- Novo parâmetro
+                    ifc_sha256: Optional[str] = None, img_sha256: Optional[str] = None,
+                    ignore_mep: Optional[bool] = None, img_renditions: Optional[bool] = None,
+                    lenient_pass: Optional[str] = None, views: Optional[list] = None,
+                    model_version: Optional[str] = None, mapping_version: Optional[str] = None,
+                    zone: Optional[str] = None, ratios: Optional[dict] = None):
+    # Campos None mantêm o valor atual; arquivos substituídos perdem a
+    # referência desta linha na mesma transação. Foto nova → caso de uma foto
+    # só; `views` regrava as vistas de um caso com várias. zone "" tira a zona.
+    # Progresso novo ou caso renomeado acrescentam uma medição ao histórico;
+    # foto nova analisada é uma observação nova.
+    with _db.transaction() as conn:
+        old = conn.execute("SELECT img_path, ifc_path, caso FROM submissions WHERE id=?", (id_,)).fetchone()
+        if not old:
+            return False
+        old, old_caso = old[:2], old[2]
+        if img_path is not None:
+            _drop_views(conn, id_, keep=old)
+            conn.execute("UPDATE submissions SET views_combine=NULL WHERE id=?", (id_,))
+        elif views is not None:
+            _drop_views(conn, id_, keep={*old, *(v["media_path"] for v in views)})
+            _insert_views(conn, id_, views)
+        cur = conn.execute("""
+            UPDATE submissions SET
+                caso=COALESCE(?, caso), descricao=COALESCE(?, descricao),
+                progress_pct=COALESCE(?, progress_pct),
+                img_path=COALESCE(?, img_path), ifc_path=COALESCE(?, ifc_path),
+                img_exists=COALESCE(?, img_exists), ifc_exists=COALESCE(?, ifc_exists),
+                ifc_sha256=COALESCE(?, ifc_sha256), img_sha256=COALESCE(?, img_sha256),
+                ignore_mep=COALESCE(?, ignore_mep), img_renditions=COALESCE(?, img_renditions),
+                lenient_pass=COALESCE(?, lenient_pass),
+                model_version=COALESCE(?, model_version), mapping_version=COALESCE(?, mapping_version),
+                zone=NULLIF(COALESCE(?, zone), '')
+            WHERE id=?
+        """, (caso, desc, progress_pct, img_path, ifc_path,
+              None if img_path is None else _file_exists(img_path),
+              None if ifc_path is None else _file_exists(ifc_path),
+              ifc_sha256, img_sha256, None if ignore_mep is None else int(ignore_mep),
+              None if img_renditions is None else int(img_renditions), lenient_pass,
+              model_version, mapping_version, zone, id_))
+        if cur.rowcount and (progress_pct is not None or (caso is not None and caso != old_caso)):
+            new_photo = img_path is not None and progress_pct is not None
+            record_measurement(conn, id_, "update", ratios,
+                               datetime.now(timezone.utc).isoformat() if new_photo else None)
+        release_blobs(conn, [o for o, n in zip(old, (img_path, ifc_path)) if n is not None])
+        return cur.rowcount > 0
+
+def get_case_hashes(id_: int):
+    # (img_sha256, ifc_sha256, ignore_mep) — hashes podem ser None em linhas antigas
+    with _db.read() as conn:
+        row = conn.execute("SELECT img_sha256, ifc_sha256, ignore_mep FROM submissions WHERE id=?",
+                           (id_,)).fetchone()
+    if not row:
+        return None
+    img_sha256, ifc_sha256, ignore_mep = row
+    return img_sha256, ifc_sha256, bool(1 if ignore_mep is None else ignore_mep)
+
+def get_case_zone(id_: int) -> Optional[str]:
+    with _db.read() as conn:
+        row = conn.execute("SELECT zone FROM submissions WHERE id=?", (id_,)).fetchone()
+    return row[0] if row else None
+
+def get_cached_ifc_weights(ifc_sha256: str, ignore_mep: bool):
+    with _db.read() as conn:
+        row = conn.execute("""
+            SELECT weights_by_cat, totals_by_cat FROM ifc_weights_cache
+            WHERE ifc_sha256=? AND ignore_mep=? AND mapping_version=?
+        """, (ifc_sha256, int(ignore_mep), MAPPING_VERSION)).fetchone()
+    return (json.loads(row[0]), json.loads(row[1])) if row else None
+
+def put_cached_ifc_weights(ifc_sha256: str, ignore_mep: bool, weights_by_cat, totals_by_cat):
+    with _db.transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO ifc_weights_cache
+                (ifc_sha256, ignore_mep, mapping_version, weights_by_cat, totals_by_cat, created_at)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (ifc_sha256, int(ignore_mep), MAPPING_VERSION, json.dumps(weights_by_cat),
+              json.dumps(totals_by_cat), datetime.now(timezone.utc).isoformat()))
+
+def get_stored_zone_index(ifc_sha256: str, ignore_mep: bool):
+    with _db.read() as conn:
+        row = conn.execute("""
+            SELECT zones, categories, offsets, cat, weight, total FROM ifc_zone_index
+            WHERE ifc_sha256=? AND ignore_mep=? AND mapping_version=?
+        """, (ifc_sha256, int(ignore_mep), MAPPING_VERSION)).fetchone()
+    return ZoneIndex.from_row(row) if row else None
+
+def put_stored_zone_index(ifc_sha256: str, ignore_mep: bool, index):
+    with _db.transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO ifc_zone_index
+                (ifc_sha256, ignore_mep, mapping_version, zones, categories, offsets, cat, weight, total,
+                 created_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+        """, (ifc_sha256, int(ignore_mep), MAPPING_VERSION, *index.to_row(),
+              datetime.now(timezone.utc).isoformat()))
+
+# Razões por categoria de uma medição: 6 bytes por categoria (id em
+# measurement_categories, razão em float32)
+_RATIO_RECORD = struct.Struct("<Hf")
+_CATEGORY_IDS: Dict[str, int] = {}
+
+def _encode_ratios(conn, ratios) -> Optional[bytes]:
+    if not ratios:
+        return None
+    ids = _CATEGORY_IDS
+    missing = [c for c in ratios if c not in ids]
+    if missing:
+        before = conn.total_changes
+        conn.executemany("INSERT OR IGNORE INTO measurement_categories (name) VALUES (?)", [(c,) for c in missing])
+        ids = dict(conn.execute("SELECT name, id FROM measurement_categories").fetchall())
+        # Id criado nesta transação só entra no cache do processo se ela não for desfeita
+        if conn.total_changes == before:
+            _CATEGORY_IDS.update(ids)
+    return b"".join(_RATIO_RECORD.pack(ids[c], r) for c, r in ratios.items())
+
+def _decode_ratios(blob, names) -> dict:
+    # names: id → categoria (measurement_categories)
+    return {names[c]: round(r, 4) for c, r in _RATIO_RECORD.iter_unpack(blob)} if blob else {}
+
+def _measurement_insert_sql(where: str) -> str:
+    # Medições a partir das linhas de submissions já gravadas. Parâmetros:
+    # observed_at (None = a observação atual da submissão, ou o upload),
+    # ratios (None = as da medição anterior), source e os de `where`.
+    return f"""
+        INSERT INTO measurements (submission_id, caso, zone, observed_at, recorded_at, progress_pct, ratios,
+                                  model_version, mapping_version, source)
+        SELECT s.id, COALESCE(s.caso, ''), s.zone,
+               COALESCE(?, (SELECT m.observed_at FROM measurements m WHERE m.submission_id = s.id
+                            ORDER BY m.id DESC LIMIT 1), s.uploaded_at),
+               strftime('%Y-%m-%dT%H:%M:%f+00:00', 'now'), COALESCE(s.progress_pct, 0),
+               COALESCE(?, (SELECT m.ratios FROM measurements m WHERE m.submission_id = s.id
+                            ORDER BY m.id DESC LIMIT 1)),
+               s.model_version, s.mapping_version, ?
+        FROM submissions s WHERE {where}
+    """
+
+def record_measurement(conn, submission_id: int, source: str, ratios=None, observed_at: Optional[str] = None):
+    conn.execute(_measurement_insert_sql("s.id = ?"),
+                 (observed_at, _encode_ratios(conn, ratios), source, submission_id))
 
 def delete_case_row(id_: int):
-    row = get_case_row(id_)
-    if not row: return None
-    _, _, _, _, img_path, ifc_path, _ = row
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
-    cur.execute("DELETE FROM submissions WHERE id=?", (id_,))
-    conn.commit()
-    conn.close()
-    return img_path, ifc_path
+    with _db.transaction() as conn:
+        row = conn.execute("SELECT img_path, ifc_path FROM submissions WHERE id=?", (id_,)).fetchone()
+        if not row: return None
+        conn.execute("DELETE FROM submissions WHERE id=?", (id_,))
+        _drop_views(conn, id_, keep=row)
+        release_blobs(conn, row)
+    return row
+
+def _insert_views(conn, submission_id: int, views):
+    conn.executemany("""
+        INSERT INTO submission_views (submission_id, position, img_sha256, media_path, frame_ms)
+        VALUES (?, ?, ?, ?, ?)
+    """, [(submission_id, i, v["img_sha256"], v["media_path"], v.get("frame_ms"))
+          for i, v in enumerate(views)])
+
+def _drop_views(conn, id_: int, keep=()):
+    # Cada mídia extra tem uma referência, solta junto com as vistas; `keep`
+    # são caminhos que a submissão continua usando
+    paths = [r[0] for r in conn.execute(
+        "SELECT DISTINCT media_path FROM submission_views WHERE submission_id=?", (id_,))]
+    conn.execute("DELETE FROM submission_views WHERE submission_id=?", (id_,))
+    release_blobs(conn, [p for p in paths if p not in keep])
+
+def get_case_views(id_: int):
+    # (combinação, vistas em ordem); (None, []) para caso de uma foto
+    with _db.read() as conn:
+        row = conn.execute("SELECT views_combine FROM submissions WHERE id=?", (id_,)).fetchone()
+        if not row or row[0] is None:
+            return None, []
+        views = conn.execute("""
+            SELECT img_sha256, media_path, frame_ms FROM submission_views
+            WHERE submission_id=? ORDER BY position
+        """, (id_,)).fetchall()
+    return row[0], [{"img_sha256": sha, "media_path": path, "frame_ms": ms} for sha, path, ms in views]
+
+def media_of_views(views):
+    # Mídias na ordem em que aparecem nas vistas: [{"path", "sha256", "video"}]
+    media = {}
+    for v in views:
+        media.setdefault(v["media_path"], {"path": v["media_path"], "sha256": v["img_sha256"].split("@")[0],
+                                           "video": v["frame_ms"] is not None})
+    return list(media.values())
+
+# Detecções brutas: um registro de 23 bytes por caixa (x1, y1, x2, y2, conf,
+# índice do alias no vocabulário, passada)
+_DET_RECORD = struct.Struct("<5fHB")
+
+def get_detections(img_sha256: str, weights: str, vocab_sha: str, imgsz: int):
+    # (detecções, lenient_pass) ou None
+    with _db.read() as conn:
+        row = conn.execute("""
+            SELECT records, lenient_pass FROM detection_store
+            WHERE img_sha256=? AND weights=? AND vocab_sha=? AND imgsz=?
+        """, (img_sha256, weights, vocab_sha, imgsz)).fetchone()
+    return (list(_DET_RECORD.iter_unpack(row[0])), row[1]) if row else None
+
+def put_detections(img_sha256: str, weights: str, vocab_sha: str, imgsz: int, classes, dets,
+                   lenient_pass: Optional[str] = None):
+    records = b"".join(_DET_RECORD.pack(*d) for d in dets)
+    with _db.transaction() as conn:
+        conn.execute("""
+            INSERT OR REPLACE INTO detection_store
+                (img_sha256, weights, vocab_sha, imgsz, aliases, records, created_at, lenient_pass)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (img_sha256, weights, vocab_sha, imgsz, json.dumps(list(classes)),
+              records, datetime.now(timezone.utc).isoformat(), lenient_pass))
+
+JOB_COLUMNS = ("id", "kind", "status", "stage", "params", "result", "error",
+               "submission_id", "created_at", "updated_at", "timings")
+
+def create_job(kind: str, params: dict, limit: int = 0) -> str:
+    # limit > 0: recusa (429) se o nó já tem `limit` análises na fila ou rodando
+    job_id = uuid.uuid4().hex
+    now = datetime.now(timezone.utc).isoformat()
+    with _db.transaction() as conn:
+        if limit > 0:
+            backlog = analysis_backlog(conn)
+            if backlog >= limit:
+                raise _analysis_busy(conn, backlog)
+        conn.execute("""
+            INSERT INTO jobs (id, kind, status, stage, params, created_at, updated_at)
+            VALUES (?, ?, 'queued', 'queued', ?, ?, ?)
+        """, (job_id, kind, json.dumps(params), now, now))
+    return job_id
+
+def get_job(job_id: str):
+    with _db.read() as conn:
+        row = conn.execute(f"SELECT {', '.join(JOB_COLUMNS)} FROM jobs WHERE id=?", (job_id,)).fetchone()
+    return dict(zip(JOB_COLUMNS, row)) if row else None
+
+def set_job(job_id: str, **fields):
+    fields["updated_at"] = datetime.now(timezone.utc).isoformat()
+    with _db.transaction() as conn:
+        conn.execute(f"UPDATE jobs SET {', '.join(f'{k}=?' for k in fields)} WHERE id=?",
+                     (*fields.values(), job_id))
+
+def pending_job_ids():
+    with _db.read() as conn:
+        rows = conn.execute("SELECT id FROM jobs WHERE status IN ('queued','running') ORDER BY created_at").fetchall()
+    return [r[0] for r in rows]
+
+# ========= Blob store =========
+# Uploads endereçados pelo conteúdo: db/blobs/<2 hex>/<sha256><ext>, gravados
+# uma única vez. A tabela blobs conta as referências (upload → job →
+# submissão); o arquivo sai do disco quando a contagem chega a zero.
+UPLOAD_MAX_MB = {
+    "img": int(os.getenv("UPLOAD_MAX_IMG_MB", "50")),
+    "ifc": int(os.getenv("UPLOAD_MAX_IFC_MB", "1024")),
+    "video": int(os.getenv("UPLOAD_MAX_VIDEO_MB", "2048")),
+}
+_UPLOAD_CHUNK = 1 << 20
+# Arquivos ainda chegando; fora de /files e no mesmo disco dos blobs (os.replace)
+_PART_DIR = os.path.join(_DB_DIR, "partial")
+
+class BlobUpload:
+    # Um arquivo do multipart gravado direto num .part enquanto chega, com o
+    # SHA-256 e o limite de tamanho conferidos a cada pedaço (sem spool antes)
+    def __init__(self, kind: str, filename: str):
+        self.kind, self.filename = kind, filename
+        self.max_bytes = UPLOAD_MAX_MB[kind] << 20
+        self.size = 0
+        self._hash = hashlib.sha256()
+        self._elapsed = 0.0
+        os.makedirs(_PART_DIR, exist_ok=True)
+        self._file = NamedTemporaryFile(dir=_PART_DIR, suffix=".part", delete=False)
+
+    def write(self, data: bytes):
+        t0 = time.perf_counter()
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise HTTPException(413, f"Arquivo excede o limite de {self.max_bytes >> 20} MB")
+        self._hash.update(data)
+        self._file.write(data)
+        self._elapsed += time.perf_counter() - t0
+
+    def discard(self):
+        self._file.close()
+        try:
+            os.remove(self._file.name)
+        except FileNotFoundError:
+            pass
+
+    def commit(self):
+        # (sha256, caminho) do blob, já com uma referência para quem enviou.
+        # Conteúdo já guardado só ganha a referência; o .part é descartado.
+        t0 = time.perf_counter()
+        self._file.close()
+        sha = self._hash.hexdigest()
+        metrics.inc("pimetro_upload_bytes_total", self.size, kind=self.kind)
+        try:
+            return sha, self._store(sha)
+        finally:
+            metrics.record_stage("upload", self._elapsed + time.perf_counter() - t0, kind=self.kind)
+
+    def _store(self, sha: str) -> str:
+        with _db.transaction() as conn:
+            row = conn.execute("SELECT path FROM blobs WHERE sha256=?", (sha,)).fetchone()
+            if row and os.path.exists(row[0]):
+                conn.execute("UPDATE blobs SET refcount = refcount + 1 WHERE sha256=?", (sha,))
+                metrics.inc("pimetro_cache_total", cache="blob", result="hit")
+                self.discard()
+                return row[0]
+        metrics.inc("pimetro_cache_total", cache="blob", result="miss")
+
+        ext = os.path.splitext(self.filename or "")[1].lower()
+        blob_dir = os.path.join(_BLOB_DIR, sha[:2])
+        os.makedirs(blob_dir, exist_ok=True)
+        path = os.path.join(blob_dir, sha + ext)
+        os.replace(self._file.name, path)
+        with _db.transaction() as conn:
+            stored = conn.execute("""
+                INSERT INTO blobs (sha256, path, size, refcount, created_at) VALUES (?, ?, ?, 1, ?)
+                ON CONFLICT (sha256) DO UPDATE SET refcount = refcount + 1
+                RETURNING path
+            """, (sha, path, self.size, datetime.now(timezone.utc).isoformat())).fetchone()[0]
+        if stored != path:
+            # Outro upload do mesmo conteúdo (com outra extensão) chegou antes
+            os.remove(path)
+        return stored
+
+def release_blobs(conn, paths):
+    # Dentro da transação de quem solta a referência; o unlink acontece com o
+    # lock de escrita, então um upload concorrente nunca vê um blob sumindo
+    for path in paths:
+        if not path:
+            continue
+        row = conn.execute("UPDATE blobs SET refcount = refcount - 1 WHERE path=? RETURNING refcount, sha256",
+                           (path,)).fetchone()
+        if row is None:
+            # Arquivo de antes do blob store: sai só se nenhuma linha ainda o usa
+            if conn.execute("SELECT 1 FROM submissions WHERE img_path=? OR ifc_path=? LIMIT 1",
+                            (path, path)).fetchone():
+                continue
+            targets = [path]
+        elif row[0] > 0:
+            continue
+        else:
+            conn.execute("DELETE FROM blobs WHERE path=?", (path,))
+            targets = [path, *(rendition_path(row[1], name) for name in RENDITIONS)]
+        for target in targets:
+            try:
+                if os.path.exists(target):
+                    os.remove(target)
+            except OSError as e:
+                logger.warning("Falha ao remover %s: %s", target, e)
+
+def release_upload_blobs(paths):
+    with _db.transaction() as conn:
+        release_blobs(conn, paths)
+
+# ========= Derivados da foto =========
+# Miniatura e prévia em WebP gravadas ao lado do blob da foto
+# (db/blobs/<2 hex>/<sha256>.<nome>.webp). A foto é decodificada uma vez e o
+# array segue para o detector.
+RENDITIONS = {"thumb": 480, "preview": 1600}   # lado maior, em px
+RENDITION_WEBP_QUALITY = 80
+
+def rendition_path(img_sha256: str, name: str) -> str:
+    return os.path.join(_BLOB_DIR, img_sha256[:2], f"{img_sha256}.{name}.webp")
+
+def load_image(path: str):
+    # Mesma leitura do imread do ultralytics (aceita caminhos não-ASCII), sem
+    # importar o ultralytics/torch no cliente do servidor de inferência
+    import cv2
+    import numpy as np
+    image = cv2.imdecode(np.fromfile(path, np.uint8), cv2.IMREAD_COLOR)
+    if image is None:
+        raise ValueError(f"Não foi possível ler a imagem {os.path.basename(path)}")
+    return image
+
+def make_renditions(img_sha256: str, image) -> bool:
+    import cv2
+    h, w = image.shape[:2]
+    for name, side in RENDITIONS.items():
+        dst = rendition_path(img_sha256, name)
+        if os.path.exists(dst):
+            continue
+        scale = side / max(h, w)
+        out = image if scale >= 1 else cv2.resize(
+            image, (max(1, round(w * scale)), max(1, round(h * scale))), interpolation=cv2.INTER_AREA)
+        ok, buf = cv2.imencode(".webp", out, [cv2.IMWRITE_WEBP_QUALITY, RENDITION_WEBP_QUALITY])
+        if not ok:
+            raise ValueError(f"Falha ao gerar a versão {name} da foto")
+        os.makedirs(os.path.dirname(dst), exist_ok=True)
+        with NamedTemporaryFile(dir=os.path.dirname(dst), suffix=".part", delete=False) as tf:
+            tf.write(buf.tobytes())
+        os.replace(tf.name, dst)
+    return True
+
+def has_renditions(img_sha256: Optional[str]) -> bool:
+    return bool(img_sha256) and all(os.path.exists(rendition_path(img_sha256, n)) for n in RENDITIONS)
+
+def _rendition_urls(request: Request, img_sha256: Optional[str], available) -> dict:
+    if not (img_sha256 and available):
+        return {f"{name}_url": None for name in RENDITIONS}
+    base = str(request.base_url)
+    return {f"{name}_url": f"{base}files/blobs/{img_sha256[:2]}/{img_sha256}.{name}.webp" for name in RENDITIONS}
 
 # ========= IFC utils =========
 def elem_weight_from_qto(elem):
@@ -254,8 +1316,9 @@ def elem_weight_from_qto(elem):
         return None
     return None
 
-def build_ifc_weights(ifc_path: str, ignore_mep: bool = True):
-    model = ifcopenshell.open(ifc_path)
+def ifc_weights_by_type(model, ignore_mep: bool = True):
+    # Implementação original (by_type por entrada + IsDefinedBy por elemento);
+    # mantida como referência para o benchmark de bench.ifc_weights
     weights_by_cat = defaultdict(float)
     totals_by_cat  = defaultdict(int)
 
@@ -277,35 +1340,624 @@ def build_ifc_weights(ifc_path: str, ignore_mep: bool = True):
 
     return dict(weights_by_cat), dict(totals_by_cat)
 
+# Posições fixas nos schemas IFC2X3/IFC4/IFC4X3; acesso por índice evita a
+# busca do atributo por nome, que domina o custo em modelos grandes
+_REL_RELATED_OBJECTS = 4        # IfcRelDefinesByProperties.RelatedObjects
+_REL_PROPERTY_DEFINITION = 5    # IfcRelDefinesByProperties.RelatingPropertyDefinition
+_QTO_QUANTITIES = 5             # IfcElementQuantity.Quantities
+_QUANTITY_VALUE = 3             # IfcQuantityVolume/Area/Length.*Value
+
+def _qto_weight(prop):
+    # Mesmo critério de elem_weight_from_qto para um IfcElementQuantity
+    qs = prop[_QTO_QUANTITIES]
+    if not qs:
+        return None
+    vol = area = length = None
+    for q in qs:
+        t = q.is_a()
+        if t == "IfcQuantityVolume" and vol is None:
+            vol = float(q[_QUANTITY_VALUE])
+        elif t == "IfcQuantityArea" and area is None:
+            area = float(q[_QUANTITY_VALUE])
+        elif t == "IfcQuantityLength" and length is None:
+            length = float(q[_QUANTITY_VALUE])
+    if vol and vol > 0:   return vol
+    if area and area > 0: return area
+    if length and length > 0: return length
+    return None
+
+_QTO_FAILED = object()
+
+def qto_weights_by_element(model) -> Dict[int, Optional[float]]:
+    # Uma passada em IfcRelDefinesByProperties: id do elemento → peso da QTO.
+    # Vale a primeira relação (em ordem de id, a mesma de IsDefinedBy) que dá
+    # peso positivo ou falha; falha vira None, como em elem_weight_from_qto.
+    weights: Dict[int, Optional[float]] = {}
+    for rel in model.by_type("IfcRelDefinesByProperties"):
+        try:
+            prop = rel[_REL_PROPERTY_DEFINITION]
+            if not prop or not prop.is_a("IfcElementQuantity"):
+                continue
+            w = _qto_weight(prop)
+        except Exception:
+            w = _QTO_FAILED
+        if w is None:
+            continue
+        for obj in rel[_REL_RELATED_OBJECTS] or ():
+            if obj.id() not in weights:
+                weights[obj.id()] = None if w is _QTO_FAILED else w
+    return weights
+
+def build_ifc_weights(ifc_path: str, ignore_mep: bool = True):
+    import ifcopenshell
+    with metrics.timer("ifc_open"):
+        model = ifcopenshell.open(ifc_path)
+    with metrics.timer("ifc_weights"):
+        return ifc_weights_from_model(model, ignore_mep=ignore_mep)
+
+def ifc_weights_from_model(model, ignore_mep: bool = True, qto=None):
+    # qto: resultado de qto_weights_by_element, quando o chamador já o tem
+    qto = qto_weights_by_element(model) if qto is None else qto
+
+    # Uma passada em IfcElement, agrupando os pesos por tipo concreto. O
+    # lookup tipo concreto → entradas de IFC_TO_CAT é montado uma vez por
+    # tipo (is_a inclui supertipos, como by_type).
+    ent_names = [e for e in IFC_TO_CAT if not (ignore_mep and e in MEP_IFC_TYPES)]
+    type_ents: Dict[str, set] = {}
+    by_type: Dict[str, list] = {}
+    for e in model.by_type("IfcElement"):
+        t = e.is_a()
+        ents = type_ents.get(t)
+        if ents is None:
+            ents = type_ents[t] = {n for n in ent_names if e.is_a(n)}
+        if not ents:
+            continue
+        w = qto.get(e.id())
+        by_type.setdefault(t, []).append(1.0 if w is None else float(w))
+
+    # Soma na mesma ordem da versão por by_type (entrada de IFC_TO_CAT, tipo
+    # concreto, elemento) para o resultado ser idêntico, bit a bit
+    weights_by_cat = defaultdict(float)
+    totals_by_cat  = defaultdict(int)
+    for ent_name in ent_names:
+        canon = IFC_TO_CAT[ent_name]
+        for t, ws in by_type.items():
+            if ent_name not in type_ents[t]:
+                continue
+            for w in ws:
+                weights_by_cat[canon] += w
+            totals_by_cat[canon] += len(ws)
+
+    return dict(weights_by_cat), dict(totals_by_cat)
+
+def file_sha256(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def build_ifc_index(ifc_path: str, ignore_mep: bool = True):
+    # Pesos globais e índice de zonas numa abertura só do IFC
+    import ifcopenshell
+    with metrics.timer("ifc_open"):
+        model = ifcopenshell.open(ifc_path)
+    with metrics.timer("ifc_weights"):
+        qto = qto_weights_by_element(model)
+        weights_by_cat, totals_by_cat = ifc_weights_from_model(model, ignore_mep=ignore_mep, qto=qto)
+    with metrics.timer("ifc_zones"):
+        zones = ZoneIndex.from_model(model, ignore_mep=ignore_mep, qto=qto)
+    return weights_by_cat, totals_by_cat, zones
+
+def _ingest_ifc(ifc_path: str, ignore_mep: bool, ifc_sha256: str):
+    with IFC_SLOTS.hold():
+        weights_by_cat, totals_by_cat, zones = build_ifc_index(ifc_path, ignore_mep=ignore_mep)
+    put_cached_ifc_weights(ifc_sha256, ignore_mep, weights_by_cat, totals_by_cat)
+    put_stored_zone_index(ifc_sha256, ignore_mep, zones)
+    _remember_zone_index(ifc_sha256, ignore_mep, zones)
+    return weights_by_cat, totals_by_cat, zones
+
+def _ingest_ifc_task(ifc_path: str, ignore_mep: bool, ifc_sha256: str):
+    # No pool de análise: o resultado fica no banco, nada volta pelo pickle
+    _ingest_ifc(ifc_path, ignore_mep, ifc_sha256)
+
+class IfcNotIndexed(Exception):
+    # Pesos/índice de zonas ainda não extraídos de um IFC que está no disco.
+    # args = (ifc_path, ignore_mep, ifc_sha256), prontos para _ingest_ifc_task
+    pass
+
+def build_ifc_weights_cached(ifc_path: str, ignore_mep: bool = True, ifc_sha256: Optional[str] = None):
+    # Mesmo modelo BIM (mesmo hash) → mesmos pesos; só parseia no primeiro uso,
+    # que já grava também o índice de zonas
+    ifc_sha256 = ifc_sha256 or file_sha256(ifc_path)
+    cached = get_cached_ifc_weights(ifc_sha256, ignore_mep)
+    metrics.inc("pimetro_cache_total", cache="ifc_weights", result="miss" if cached is None else "hit")
+    if cached is not None:
+        return cached
+    weights_by_cat, totals_by_cat, _ = _ingest_ifc(ifc_path, ignore_mep, ifc_sha256)
+    return weights_by_cat, totals_by_cat
+
+# ========= Índice espacial (zonas) =========
+# Pesos e totais por categoria de cada contêiner espacial do IFC (andar,
+# espaço, trecho/IfcFacilityPart...), montados na mesma abertura que os pesos
+# globais e gravados em ifc_zone_index como colunas de arrays. Uma submissão
+# com zona é pontuada só contra os elementos dela, sem reabrir o IFC.
+ZONE_INDEX_CACHE_SIZE = int(os.getenv("ZONE_INDEX_CACHE_SIZE", "16"))
+_ZONE_CACHE: "OrderedDict[tuple, ZoneIndex]" = OrderedDict()
+_ZONE_CACHE_LOCK = threading.Lock()
+
+# Posições fixas nos schemas IFC2X3/IFC4/IFC4X3 (ver _REL_RELATED_OBJECTS)
+_REL_RELATING_OBJECT = 4        # IfcRelAggregates.RelatingObject
+_REL_AGGREGATED_OBJECTS = 5     # IfcRelAggregates.RelatedObjects
+_REL_CONTAINED_ELEMENTS = 4     # IfcRelContainedInSpatialStructure.RelatedElements
+_REL_RELATING_STRUCTURE = 5     # IfcRelContainedInSpatialStructure.RelatingStructure
+
+class ZoneIndex:
+    # Layout CSR: as linhas da zona i são [offsets[i], offsets[i+1]) de
+    # cat/weight/total, em ordem de categoria. Cada zona soma os elementos
+    # contidos nela e nas zonas abaixo (o andar inclui os seus espaços).
+    def __init__(self, zones, categories, offsets, cat, weight, total):
+        self.zones = zones              # [[GlobalId, nome, tipo IFC, índice do pai ou -1]]
+        self.categories = categories
+        self.offsets, self.cat, self.weight, self.total = offsets, cat, weight, total
+        self._by_id = {z[0]: i for i, z in enumerate(zones)}
+        # Nome repetido (dois "Plataforma" em andares diferentes) → -1: só pelo GlobalId
+        self._by_name = {}
+        for i, z in enumerate(zones):
+            if z[1]:
+                key = z[1].strip().casefold()
+                self._by_name[key] = -1 if key in self._by_name else i
+
+    def __len__(self):
+        return len(self.zones)
+
+    def find(self, zone: str) -> int:
+        # GlobalId ou nome (sem diferenciar maiúsculas); ValueError se não achar
+        i = self._by_id.get(zone)
+        if i is None:
+            i = self._by_name.get(zone.strip().casefold())
+        if i is None:
+            raise ValueError(f"Zona '{zone}' não encontrada no IFC")
+        if i < 0:
+            raise ValueError(f"Há mais de uma zona chamada '{zone}' no IFC; use o GlobalId")
+        return i
+
+    def weights(self, i: int):
+        # (weights_by_cat, totals_by_cat) da zona i, no formato de build_ifc_weights
+        lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+        cats = [self.categories[c] for c in self.cat[lo:hi].tolist()]
+        return dict(zip(cats, self.weight[lo:hi].tolist())), dict(zip(cats, self.total[lo:hi].tolist()))
+
+    def summary(self, i: int) -> dict:
+        lo, hi = int(self.offsets[i]), int(self.offsets[i + 1])
+        gid, name, kind, parent = self.zones[i]
+        return {"zona": gid, "nome": name, "tipo": kind,
+                "pai": self.zones[parent][0] if parent >= 0 else None,
+                "peso_planejado": round(float(self.weight[lo:hi].sum()), 3),
+                "elementos": int(self.total[lo:hi].sum())}
+
+    def to_row(self):
+        return (json.dumps(self.zones), json.dumps(self.categories),
+                self.offsets.astype("<i8").tobytes(), self.cat.astype("<u2").tobytes(),
+                self.weight.astype("<f8").tobytes(), self.total.astype("<i8").tobytes())
+
+    @classmethod
+    def from_row(cls, row):
+        import numpy as np
+        zones, categories, offsets, cat, weight, total = row
+        return cls(json.loads(zones), json.loads(categories), np.frombuffer(offsets, dtype="<i8"),
+                   np.frombuffer(cat, dtype="<u2"), np.frombuffer(weight, dtype="<f8"),
+                   np.frombuffer(total, dtype="<i8"))
+
+    @classmethod
+    def from_model(cls, model, ignore_mep: bool = True, qto=None):
+        # Mesmos elementos e pesos de ifc_weights_from_model, atribuídos ao
+        # contêiner de ContainedInStructure (peças de um agregado, como os
+        # lances de uma escada, herdam o contêiner do todo)
+        import numpy as np
+        qto = qto_weights_by_element(model) if qto is None else qto
+        whole_of = {}
+        for rel in model.by_type("IfcRelAggregates"):
+            for part in rel[_REL_AGGREGATED_OBJECTS] or ():
+                whole_of.setdefault(part.id(), rel[_REL_RELATING_OBJECT])
+
+        zones, zone_pos = [], {}
+        def zone_of(ent):
+            # Registra a zona e, antes dela, a cadeia de pais espaciais; o pai
+            # sempre tem índice menor que o filho
+            chain, seen = [], set()
+            while (ent is not None and ent.id() not in zone_pos and ent.id() not in seen
+                   and ent.is_a("IfcSpatialStructureElement")):
+                chain.append(ent)
+                seen.add(ent.id())
+                ent = whole_of.get(ent.id())
+            i = zone_pos.get(ent.id(), -1) if ent is not None else -1
+            for z in reversed(chain):
+                zones.append([z.GlobalId, z.Name or "", z.is_a(), i])
+                i = zone_pos[z.id()] = len(zones) - 1
+            return i
+
+        container = {}
+        for rel in model.by_type("IfcRelContainedInSpatialStructure"):
+            z = zone_of(rel[_REL_RELATING_STRUCTURE])
+            if z < 0:
+                continue
+            for e in rel[_REL_CONTAINED_ELEMENTS] or ():
+                container.setdefault(e.id(), z)
+
+        categories = sorted(set(IFC_TO_CAT.values()))
+        col = {c: i for i, c in enumerate(categories)}
+        ent_names = [e for e in IFC_TO_CAT if not (ignore_mep and e in MEP_IFC_TYPES)]
+        type_cols: Dict[str, list] = {}
+        el_zone, el_cat, el_weight = [], [], []
+        for e in model.by_type("IfcElement"):
+            t = e.is_a()
+            cols = type_cols.get(t)
+            if cols is None:
+                cols = type_cols[t] = [col[IFC_TO_CAT[n]] for n in ent_names if e.is_a(n)]
+            if not cols:
+                continue
+            z, part = container.get(e.id()), e
+            for _ in range(32):
+                if z is not None:
+                    break
+                part = whole_of.get(part.id())
+                if part is None:
+                    break
+                z = container.get(part.id())
+            if z is None:
+                continue   # fora de qualquer contêiner: só nos pesos globais
+            w = qto.get(e.id())
+            w = 1.0 if w is None else float(w)
+            for c in cols:
+                el_zone.append(z)
+                el_cat.append(c)
+                el_weight.append(w)
+
+        # Soma em cada zona e sobe um nível por volta até a raiz
+        Z, C = len(zones), len(categories)
+        parent = np.array([z[3] for z in zones], dtype=np.int64)
+        zi, ci = np.array(el_zone, dtype=np.int64), np.array(el_cat, dtype=np.int64)
+        wi = np.array(el_weight, dtype=np.float64)
+        weight, total = np.zeros(Z * C), np.zeros(Z * C, dtype=np.int64)
+        while len(zi):
+            key = zi * C + ci
+            weight += np.bincount(key, weights=wi, minlength=Z * C)
+            total += np.bincount(key, minlength=Z * C)
+            zi = parent[zi]
+            keep = zi >= 0
+            zi, ci, wi = zi[keep], ci[keep], wi[keep]
+
+        rows = np.flatnonzero(total)
+        offsets = np.searchsorted(rows // max(C, 1), np.arange(Z + 1)).astype(np.int64)
+        return cls(zones, categories, offsets, (rows % max(C, 1)).astype(np.uint16),
+                   weight[rows], total[rows])
+
+def _remember_zone_index(ifc_sha256: str, ignore_mep: bool, index):
+    key = (ifc_sha256, bool(ignore_mep))
+    with _ZONE_CACHE_LOCK:
+        _ZONE_CACHE[key] = index
+        _ZONE_CACHE.move_to_end(key)
+        while len(_ZONE_CACHE) > ZONE_INDEX_CACHE_SIZE:
+            _ZONE_CACHE.popitem(last=False)
+
+def zone_index_cached(ifc_path: Optional[str], ignore_mep: bool = True, ifc_sha256: Optional[str] = None,
+                      parse: bool = True):
+    # LRU do processo → ifc_zone_index → parse (IFCs gravados antes do índice);
+    # None se o índice não existe e o IFC não está mais no disco. parse=False
+    # (caminho de requisição): IfcNotIndexed no lugar do parse
+    ifc_sha256 = ifc_sha256 or (file_sha256(ifc_path) if ifc_path and os.path.exists(ifc_path) else None)
+    if ifc_sha256 is None:
+        return None
+    key = (ifc_sha256, bool(ignore_mep))
+    with _ZONE_CACHE_LOCK:
+        index = _ZONE_CACHE.get(key)
+        if index is not None:
+            _ZONE_CACHE.move_to_end(key)
+    if index is None:
+        index = get_stored_zone_index(ifc_sha256, ignore_mep)
+        if index is not None:
+            _remember_zone_index(ifc_sha256, ignore_mep, index)
+    metrics.inc("pimetro_cache_total", cache="zone_index", result="miss" if index is None else "hit")
+    if index is None and ifc_path and os.path.exists(ifc_path):
+        if not parse:
+            raise IfcNotIndexed(ifc_path, bool(ignore_mep), ifc_sha256)
+        _, _, index = _ingest_ifc(ifc_path, ignore_mep, ifc_sha256)
+    return index
+
+def zone_weights(ifc_path: Optional[str], ignore_mep: bool, ifc_sha256: Optional[str], zone: str,
+                 parse: bool = True):
+    # (weights_by_cat, totals_by_cat, GlobalId) da zona; ValueError se não houver
+    index = zone_index_cached(ifc_path, ignore_mep, ifc_sha256, parse=parse)
+    if index is None:
+        raise ValueError("IFC indisponível para localizar a zona")
+    i = index.find(zone)
+    return (*index.weights(i), index.zones[i][0])
+
 # ========= YOLO detect (dual pass) =========
-def detect_photo_dual(yolo_weights, image_path, classes,
-                      conf_strict=0.22, conf_lenient=0.03, imgsz=1920):
-    def run_pass(conf, augment):
-        model = YOLOWorld(yolo_weights)
-        model.set_classes(classes)
-        res = model.predict(source=image_path, imgsz=imgsz, conf=conf, augment=augment, verbose=False)
-        r = res[0]
-        names = r.names
-        cls = r.boxes.cls.tolist() if r.boxes and r.boxes.cls is not None else []
-        cnt = defaultdict(int)
-        for c in cls:
-            alias = names.get(int(c), str(c))
-            canon = ALIAS_TO_CANON.get(alias, alias)
-            cnt[canon] += 1
-        return dict(cnt)
-
-    counts_strict  = run_pass(conf_strict,  augment=False)
-    counts_lenient = run_pass(conf_lenient, augment=True)
+DETECT_IMGSZ = 1920
+# Piso de confiança das detecções guardadas: qualquer limiar acima dele
+# (strict 0.22, lenient 0.03) sai das mesmas caixas, sem rodar o modelo
+DETECTION_CONF_FLOOR = 0.03
+PASS_STRICT, PASS_LENIENT = 0, 1   # sem TTA / com TTA (augment=True)
+
+def is_world_model(model) -> bool:
+    # Sem nn.Module (stub, exportado ainda não montado) não há o que importar
+    if getattr(model, "model", None) is None:
+        return False
+    from ultralytics.nn.tasks import WorldModel
+    return isinstance(model.model, WorldModel)
+
+def honours_augment(model) -> bool:
+    # WorldModel.predict aceita augment e o ignora: a passada "TTA" do
+    # YOLO-World é o mesmo forward, com as mesmas caixas. Modelos exportados
+    # também não aplicam TTA.
+    if getattr(model, "model", None) is None:
+        return False
+    from ultralytics.nn.tasks import DetectionModel
+    return isinstance(model.model, DetectionModel) and not is_world_model(model)
+
+def vocabulary_sha(classes) -> str:
+    return hashlib.sha256("\n".join(classes).encode()).hexdigest()[:16]
+
+# Inferência fatiada: além da foto inteira em DETECT_IMGSZ, recortes de
+# DETECT_TILE px na resolução nativa (grampos, vergalhões e dormentes somem
+# no letterbox de uma foto de 48 MP). 0 desliga.
+DETECT_TILE = int(os.getenv("DETECT_TILE", "0"))
+DETECT_TILE_OVERLAP = float(os.getenv("DETECT_TILE_OVERLAP", "0.2"))
+DETECT_TILE_BATCH = int(os.getenv("DETECT_TILE_BATCH", "8"))
+# Fração mínima de bordas (Canny) para um recorte ir ao modelo; 0 = todos
+DETECT_TILE_MIN_EDGES = float(os.getenv("DETECT_TILE_MIN_EDGES", "0"))
+# Caixas da mesma classe que se sobrepõem mais que isso (interseção sobre a
+# menor) são a mesma peça vista em recortes vizinhos
+TILE_MERGE_IOS = 0.6
+
+def analysis_versions(yolo_weights: str = YOLO_WEIGHTS):
+    # (model_version, mapping_version) gravados em cada submissão analisada:
+    # detector (pesos, backend, fatiamento) e mapeamento IFC → categoria + aliases.
+    # reprocess.py refaz as submissões com outra etiqueta.
+    return detector_key(yolo_weights), f"{MAPPING_VERSION}.{vocabulary_sha(YOLO_CLASSES)}"
+
+def detector_key(yolo_weights: str) -> str:
+    # Chave das detecções guardadas: backend e fatiamento mudam as caixas
+    key = inference_client().info(yolo_weights)["backend"] if INFERENCE_SOCKET else backend_key(yolo_weights)
+    if DETECT_TILE <= 0:
+        return key
+    return f"{key}#tiles={DETECT_TILE}:{DETECT_TILE_OVERLAP:g}:{DETECT_TILE_MIN_EDGES:g}"
+
+def _tile_starts(length: int, tile: int, step: int):
+    starts = list(range(0, length - tile, step))
+    return starts + [length - tile]
+
+def image_tiles(image, tile=None, overlap=None, min_edges=None):
+    # (x0, y0) de cada recorte tile×tile que cobre a foto; vazio se ela já cabe num só
+    import cv2
+    import numpy as np
+    tile = DETECT_TILE if tile is None else tile
+    overlap = DETECT_TILE_OVERLAP if overlap is None else overlap
+    min_edges = DETECT_TILE_MIN_EDGES if min_edges is None else min_edges
+    h, w = image.shape[:2]
+    if tile <= 0 or (h <= tile and w <= tile):
+        return []
+    step = max(1, int(tile * (1.0 - overlap)))
+    xs = _tile_starts(w, tile, step) if w > tile else [0]
+    ys = _tile_starts(h, tile, step) if h > tile else [0]
+    origins = [(x, y) for y in ys for x in xs]
+    if min_edges > 0:
+        # Recortes de céu, parede lisa ou chão liso não têm o que contar
+        edges = cv2.Canny(cv2.cvtColor(image, cv2.COLOR_BGR2GRAY), 100, 200)
+        origins = [(x, y) for x, y in origins
+                   if np.count_nonzero(edges[y:y + tile, x:x + tile]) >= min_edges * edges[y:y + tile, x:x + tile].size]
+    return origins
+
+def merge_tile_detections(dets, ios=TILE_MERGE_IOS):
+    # NMS guloso por classe entre foto inteira e recortes; conf decrescente
+    import numpy as np
+    if not dets:
+        return []
+    arr = np.asarray([d[:6] for d in dets], dtype=np.float64)
+    order = np.argsort(-arr[:, 4], kind="stable")
+    keep = []
+    for cls in np.unique(arr[order, 5]):
+        idx = order[arr[order, 5] == cls]
+        boxes = arr[idx, :4]
+        areas = np.maximum(boxes[:, 2] - boxes[:, 0], 0) * np.maximum(boxes[:, 3] - boxes[:, 1], 0)
+        alive = np.ones(len(idx), dtype=bool)
+        for i in range(len(idx)):
+            if not alive[i]:
+                continue
+            keep.append(idx[i])
+            rest = np.nonzero(alive[i + 1:])[0] + i + 1
+            if not len(rest):
+                continue
+            iw = np.minimum(boxes[i, 2], boxes[rest, 2]) - np.maximum(boxes[i, 0], boxes[rest, 0])
+            ih = np.minimum(boxes[i, 3], boxes[rest, 3]) - np.maximum(boxes[i, 1], boxes[rest, 1])
+            inter = np.clip(iw, 0, None) * np.clip(ih, 0, None)
+            smaller = np.maximum(np.minimum(areas[i], areas[rest]), 1e-9)
+            alive[rest[inter / smaller > ios]] = False
+    return [dets[i] for i in sorted(keep, key=lambda i: -arr[i, 4])]
+
+def _boxes_of(result, pass_id, remap=None):
+    b = result.boxes
+    if not b or b.cls is None:
+        return []
+    # índice da classe == índice do alias em `classes` (vocabulário aplicado
+    # antes do predict); com vocabulário fixo, traduzido por `remap`
+    out = []
+    for box, conf, c in zip(b.xyxy.tolist(), b.conf.tolist(), b.cls.tolist()):
+        c = int(c) if remap is None else remap[int(c)]
+        if c >= 0:
+            out.append((*box, conf, c, pass_id))
+    return out
+
+class _NMSTimeLimit(logging.Handler):
+    # O NMS do ultralytics desiste das imagens que faltam no lote quando
+    # estoura o limite de tempo (2 s + 50 ms por imagem) e só avisa no log
+    def __init__(self):
+        super().__init__(logging.WARNING)
+        self.hit = False
+
+    def emit(self, record):
+        if "NMS time limit" in record.getMessage():
+            self.hit = True
+
+def predict_boxes(yolo_weights, images, classes, imgsz, conf_floor, augment, pass_id):
+    # Um forward para o lote (imagens do mesmo tamanho); [detecções] por imagem.
+    # Com INFERENCE_SOCKET, o forward roda no servidor de inferência.
+    if INFERENCE_SOCKET:
+        return inference_client().predict(yolo_weights, images, classes, imgsz, conf_floor, augment, pass_id)
+    from ultralytics.utils import LOGGER as ULTRALYTICS_LOGGER
+    model, lock = get_model(yolo_weights)
+    watch = _NMSTimeLimit()
+    with DETECT_SLOTS.hold(), lock:
+        ULTRALYTICS_LOGGER.addHandler(watch)
+        try:
+            remap = apply_vocabulary(model, yolo_weights, classes)
+            res = model.predict(source=images[0] if len(images) == 1 else list(images), imgsz=imgsz,
+                                conf=conf_floor, augment=augment, verbose=False)
+        finally:
+            ULTRALYTICS_LOGGER.removeHandler(watch)
+    if watch.hit and len(images) > 1:
+        # Lote truncado: refaz uma a uma, com o limite inteiro para cada imagem
+        return [predict_boxes(yolo_weights, [image], classes, imgsz, conf_floor, augment, pass_id)[0]
+                for image in images]
+    return [_boxes_of(r, pass_id, remap) for r in res]
+
+def model_honours_augment(yolo_weights) -> bool:
+    if INFERENCE_SOCKET:
+        return inference_client().info(yolo_weights)["honours_augment"]
+    return honours_augment(get_model(yolo_weights)[0])
+
+def detect_photo_raw(yolo_weights, image, classes,
+                     conf_floor=DETECTION_CONF_FLOOR, imgsz=DETECT_IMGSZ, lenient_needed=None):
+    # image: caminho ou array BGR já decodificado (as duas passadas usam o mesmo).
+    # lenient_needed(plain) → False dispensa o forward com TTA.
+    # Retorna (detecções, lenient_pass).
+    if isinstance(image, str):
+        image = load_image(image)
+    origins = image_tiles(image)
+
+    def run_pass(augment, pass_id):
+        with metrics.timer("detect_lenient" if augment else "detect_strict"):
+            return _run_pass(augment, pass_id)
+
+    def _run_pass(augment, pass_id):
+        dets = predict_boxes(yolo_weights, [image], classes, imgsz, conf_floor, augment, pass_id)[0]
+        if not origins:
+            return dets
+        # Recortes em lotes de DETECT_TILE_BATCH: memória limitada por lote
+        for i in range(0, len(origins), DETECT_TILE_BATCH):
+            batch = origins[i:i + DETECT_TILE_BATCH]
+            crops = [image[y:y + DETECT_TILE, x:x + DETECT_TILE] for x, y in batch]
+            found = predict_boxes(yolo_weights, crops, classes, DETECT_TILE, conf_floor, augment, pass_id)
+            for (x, y), boxes in zip(batch, found):
+                dets += [(x1 + x, y1 + y, x2 + x, y2 + y, *rest) for x1, y1, x2, y2, *rest in boxes]
+        return merge_tile_detections(dets)
+
+    # Uma saída do NMS no piso serve aos dois limiares; só roda outro forward
+    # se o modelo de fato aplica TTA
+    plain = run_pass(False, PASS_STRICT)
+    if not model_honours_augment(yolo_weights):
+        metrics.inc("pimetro_lenient_pass_total", decision="shared")
+        return plain + [(*d[:-1], PASS_LENIENT) for d in plain], "shared"
+    if lenient_needed is not None and not lenient_needed(plain):
+        metrics.inc("pimetro_lenient_pass_total", decision="skipped")
+        return plain, "skipped"
+    metrics.inc("pimetro_lenient_pass_total", decision="run")
+    return plain + run_pass(True, PASS_LENIENT), "run"
+
+def detect_batch_raw(yolo_weights, images, classes,
+                     conf_floor=DETECTION_CONF_FLOOR, imgsz=DETECT_IMGSZ):
+    # Várias fotos por forward; só junta fotos do mesmo tamanho (o letterbox
+    # de um lote misto muda o padding e, com ele, as caixas). Com fatiamento,
+    # uma a uma. Retorna [(detecções, lenient_pass)] na ordem de `images`.
+    if DETECT_TILE > 0:
+        return [detect_photo_raw(yolo_weights, image, classes, conf_floor, imgsz) for image in images]
+    groups = defaultdict(list)
+    for i, image in enumerate(images):
+        groups[image.shape].append(i)
+    honours = model_honours_augment(yolo_weights)
+
+    out = [None] * len(images)
+    for idx in groups.values():
+        group = [images[i] for i in idx]
+        with metrics.timer("detect_strict"):
+            plain = predict_boxes(yolo_weights, group, classes, imgsz, conf_floor, False, PASS_STRICT)
+        if not honours:
+            merged = [(d + [(*x[:-1], PASS_LENIENT) for x in d], "shared") for d in plain]
+        else:
+            with metrics.timer("detect_lenient"):
+                lenient = predict_boxes(yolo_weights, group, classes, imgsz, conf_floor, True, PASS_LENIENT)
+            merged = [(d + l, "run") for d, l in zip(plain, lenient)]
+        metrics.inc("pimetro_lenient_pass_total", len(group), decision=merged[0][1])
+        for i, m in zip(idx, merged):
+            out[i] = m
+    return out
+
+def counts_from_detections(dets, classes, conf_strict=0.22, conf_lenient=0.03):
+    # Mesmo critério do NMS do ultralytics: conf > limiar, comparado em float32
+    import numpy as np
+    thr = {PASS_STRICT: float(np.float32(conf_strict)), PASS_LENIENT: float(np.float32(conf_lenient))}
+    counts = {PASS_STRICT: defaultdict(int), PASS_LENIENT: defaultdict(int)}
+    for *_, conf, alias_idx, pass_id in dets:
+        if conf > thr[pass_id]:
+            alias = classes[alias_idx]
+            counts[pass_id][ALIAS_TO_CANON.get(alias, alias)] += 1
+    counts_strict, counts_lenient = dict(counts[PASS_STRICT]), dict(counts[PASS_LENIENT])
     generic_hits = sum(k for canon, k in counts_lenient.items() if canon in GENERIC_CUE_CANONS)
     return counts_strict, counts_lenient, generic_hits
 
+def detect_photo_dual(yolo_weights, image_path, classes,
+                      conf_strict=0.22, conf_lenient=0.03, imgsz=1920):
+    dets, _ = detect_photo_raw(yolo_weights, image_path, classes,
+                               conf_floor=min(conf_strict, conf_lenient), imgsz=imgsz)
+    return counts_from_detections(dets, classes, conf_strict, conf_lenient)
+
+def detections_for_image(yolo_weights, image, img_sha256, classes, imgsz=DETECT_IMGSZ,
+                         lenient_needed=None):
+    # Foto já analisada com o mesmo vocabulário: reaproveita as caixas guardadas.
+    # Uma entrada sem a passada lenient só vale se este IFC também a dispensa.
+    vocab_sha, key = vocabulary_sha(classes), detector_key(yolo_weights)
+    stored = get_detections(img_sha256, key, vocab_sha, imgsz)
+    if stored is not None:
+        dets, lenient_pass = stored
+        if lenient_pass != "skipped" or (lenient_needed is not None and not lenient_needed(dets)):
+            metrics.inc("pimetro_cache_total", cache="detections", result="hit")
+            return dets, lenient_pass
+    metrics.inc("pimetro_cache_total", cache="detections", result="miss")
+    dets, lenient_pass = detect_photo_raw(yolo_weights, image, classes, imgsz=imgsz,
+                                          lenient_needed=lenient_needed)
+    put_detections(img_sha256, key, vocab_sha, imgsz, classes, dets, lenient_pass)
+    return dets, lenient_pass
+
+# Dispensa da passada lenient (modelos com TTA): pula quando ela não pode mover
+# o progresso mais que a tolerância, em pontos percentuais. Negativo desliga.
+LENIENT_SKIP_TOLERANCE = float(os.getenv("LENIENT_SKIP_TOLERANCE", "0"))
+
+def lenient_gain_bound(weights_by_cat, totals_by_cat, counts_strict) -> float:
+    # Teto de quanto a lenient pode mover o progresso: com s > 0 a razão só
+    # sobe de s/T até 1; com s = 0 vai de 0 (ou eps) a no máximo 1
+    planned = sum(weights_by_cat.values())
+    if planned <= 0:
+        return 0.0
+    gap = sum(w * (1.0 - min(1.0, counts_strict.get(cat, 0) / max(totals_by_cat.get(cat, 0), 1)))
+              for cat, w in weights_by_cat.items())
+    return 100.0 * gap / planned
+
+def lenient_gate(weights_by_cat, totals_by_cat, classes, tolerance=None):
+    tolerance = LENIENT_SKIP_TOLERANCE if tolerance is None else tolerance
+    def lenient_needed(plain):
+        if tolerance < 0:
+            return True
+        counts_strict, _, _ = counts_from_detections(plain, classes)
+        return lenient_gain_bound(weights_by_cat, totals_by_cat, counts_strict) > tolerance
+    return lenient_needed
+
 def apply_rail_prior(ratios, counts_strict, counts_lenient, boost=0.08):
-    saw_track = (counts_strict.get("rail track",0)+counts_lenient.get("rail track",0) +
-                 counts_strict.get("steel rail bar",0)+counts_lenient.get("steel rail bar",0)) > 0
+    saw_track = sum(counts_strict.get(k, 0) + counts_lenient.get(k, 0) for k in RAIL_CUE_CANONS) > 0
     if not saw_track:
         return ratios
-    related = ["track sleeper / tie","rail fastening / clip","turnout / switch","third rail / power rail","ballast"]
-    for k in related:
+    for k in RAIL_PRIOR_RELATED:
         if k in ratios and ratios[k] < boost:
             ratios[k] = boost
     return ratios
@@ -334,265 +1986,1557 @@ def compute_progress_soft(weights_by_cat, totals_by_cat,
     progress = 100.0 * observed_weight / planned_weight
     return progress, ratios
 
-# ========= Helpers =========
-def slugify(text: str) -> str:
-    s = "".join(ch if ch.isalnum() else "_" for ch in (text or "case")).strip("_")
-    return s.lower() or "case"
+SCORING_DEFAULTS = {
+    "conf_strict": 0.22, "conf_lenient": 0.03,
+    "beta_lenient": 0.70, "eps_fallback": 0.12, "rail_boost": 0.08,
+}
+
+def score_detections(weights_by_cat, totals_by_cat, dets, classes, **params):
+    p = {**SCORING_DEFAULTS, **params}
+    counts = counts_from_detections(dets, classes, conf_strict=p["conf_strict"], conf_lenient=p["conf_lenient"])
+    return score_counts(weights_by_cat, totals_by_cat, *counts, **p)
+
+def score_counts(weights_by_cat, totals_by_cat, counts_strict, counts_lenient, generic_hits, **params):
+    p = {**SCORING_DEFAULTS, **params}
+    with metrics.timer("scoring"):
+        progress_pct, ratios = compute_progress_soft(
+            weights_by_cat, totals_by_cat, counts_strict, counts_lenient,
+            beta_lenient=p["beta_lenient"], eps_fallback=p["eps_fallback"], generic_hits=generic_hits
+        )
+        ratios = apply_rail_prior(ratios, counts_strict, counts_lenient, boost=p["rail_boost"])
+    return round(progress_pct, 1), ratios, counts_strict, counts_lenient
+
+def scoped_weights(weights_by_cat, totals_by_cat, ifc_path, ignore_mep, ifc_sha256, zone, parse=True):
+    # Pesos contra os quais a foto é pontuada: os da zona ou os do modelo
+    # inteiro. O vocabulário do detector segue o IFC todo, então as detecções
+    # guardadas servem a qualquer zona.
+    if not zone:
+        return weights_by_cat, totals_by_cat, None
+    return zone_weights(ifc_path, ignore_mep, ifc_sha256, zone, parse=parse)
+
+def run_analysis(img_path: str, ifc_path: str, ignore_mep: bool = True, on_stage=None,
+                 ifc_sha256: Optional[str] = None, img_sha256: Optional[str] = None, ifc_weights=None,
+                 zone: Optional[str] = None):
+    # ifc_weights: (pesos, totais) já extraídos — o reprocessamento abre cada IFC uma vez por lote.
+    # zone: GlobalId ou nome do contêiner espacial; a foto é pontuada só contra ele.
+    on_stage = on_stage or (lambda stage: None)
+    img_sha256 = img_sha256 or file_sha256(img_path)
+    model_version, mapping_version = analysis_versions(YOLO_WEIGHTS)
+
+    # Miniatura/prévia; a foto decodificada aqui é a mesma que vai ao detector
+    image = img_path
+    if not has_renditions(img_sha256):
+        on_stage("renditions")
+        image = load_image(img_path)
+        make_renditions(img_sha256, image)
+
+    # IFC
+    on_stage("parsing_ifc")
+    ifc_sha256 = ifc_sha256 or file_sha256(ifc_path)
+    model_weights = ifc_weights or build_ifc_weights_cached(ifc_path, ignore_mep, ifc_sha256)
+    weights_by_cat, totals_by_cat, zone = scoped_weights(*model_weights, ifc_path, ignore_mep, ifc_sha256, zone)
+    if not weights_by_cat:
+        return {
+            "progress_pct": 0.0,
+            "message": "Nenhum elemento do IFC mapeado às categorias.",
+            "weights_by_cat": {}, "totals_by_cat": {}, "ratios": {}, "counts": {},
+            "model_version": model_version, "mapping_version": mapping_version, "zone": zone,
+        }
+
+    # YOLO dual (ou detecções já guardadas para esta foto)
+    on_stage("detecting")
+    classes = vocabulary_for(model_weights[0])
+    dets, lenient_pass = detections_for_image(YOLO_WEIGHTS, image, img_sha256, classes,
+                                              lenient_needed=lenient_gate(weights_by_cat, totals_by_cat, classes))
+    on_stage("scoring")
+    progress_pct, ratios, _, _ = score_detections(weights_by_cat, totals_by_cat, dets, classes)
+    return {
+        "progress_pct": progress_pct,
+        "weights_by_cat": weights_by_cat,
+        "totals_by_cat": totals_by_cat,
+        "ratios": ratios,
+        "lenient_pass": lenient_pass,
+        "model_version": model_version, "mapping_version": mapping_version,
+        "zone": zone,
+    }
+
+# ========= Várias vistas (fotos / vídeo) =========
+# Um caso pode vir de várias fotos ou de um vídeo do percurso. Os quadros são
+# lidos um a um (vídeo: só os amostrados são convertidos), quase-duplicatas
+# saem pelo dHash e as vistas restantes vão ao detector em lotes; as
+# contagens por categoria se combinam antes do compute_progress_soft.
+VIDEO_SAMPLE_SECONDS = float(os.getenv("VIDEO_SAMPLE_SECONDS", "1.0"))
+VIEW_DEDUP_BITS = int(os.getenv("VIEW_DEDUP_BITS", "6"))      # distância de Hamming (de 64 bits)
+VIEW_BATCH = int(os.getenv("VIEW_BATCH", "8"))
+VIEW_MAX = int(os.getenv("VIEW_MAX", "600"))
+VIDEO_EXTS = {".mp4", ".m4v", ".mov", ".avi", ".mkv", ".webm"}
+# max: as vistas mostram os mesmos elementos (vale a que mais viu);
+# soma: cada vista cobre um trecho diferente do canteiro
+VIEW_COMBINE_MODES = ("max", "soma")
+
+def dhash(image) -> int:
+    import cv2
+    import numpy as np
+    gray = cv2.cvtColor(image, cv2.COLOR_BGR2GRAY) if image.ndim == 3 else image
+    small = cv2.resize(gray, (9, 8), interpolation=cv2.INTER_AREA)
+    return int.from_bytes(np.packbits(small[:, 1:] > small[:, :-1]).tobytes(), "big")
+
+def iter_media_frames(media):
+    # (chave, imagem, mídia, ms) na ordem das mídias; a chave de um quadro é
+    # "<sha do vídeo>@<ms>", estável entre reanálises do mesmo arquivo
+    import cv2
+    for m in media:
+        if not m["video"]:
+            yield m["sha256"], load_image(m["path"]), m["path"], None
+            continue
+        cap = cv2.VideoCapture(m["path"])
+        if not cap.isOpened():
+            raise ValueError(f"Não foi possível ler o vídeo {os.path.basename(m['path'])}")
+        try:
+            fps = cap.get(cv2.CAP_PROP_FPS) or 30.0
+            step = max(1, round(fps * VIDEO_SAMPLE_SECONDS))
+            idx = 0
+            while cap.grab():
+                if idx % step == 0:
+                    ok, frame = cap.retrieve()
+                    if ok:
+                        ms = round(idx * 1000 / fps)
+                        yield f"{m['sha256']}@{ms}", frame, m["path"], ms
+                idx += 1
+        finally:
+            cap.release()
+
+def sample_views(media, stats=None, max_bits=None):
+    # Descarta quadros a até max_bits de uma vista já mantida
+    max_bits = VIEW_DEDUP_BITS if max_bits is None else max_bits
+    stats = {} if stats is None else stats
+    stats.update(sampled=0, kept=0)
+    kept = []
+    for key, image, path, ms in iter_media_frames(media):
+        stats["sampled"] += 1
+        h = dhash(image)
+        if any((h ^ k).bit_count() <= max_bits for k in kept):
+            continue
+        kept.append(h)
+        stats["kept"] += 1
+        yield key, image, path, ms
+        if len(kept) >= VIEW_MAX:
+            return
+
+def detections_for_views(yolo_weights, batch, classes, imgsz=DETECT_IMGSZ):
+    # batch: [(chave, imagem)]; vistas já analisadas saem do detection_store
+    vocab_sha, key = vocabulary_sha(classes), detector_key(yolo_weights)
+    out = [None] * len(batch)
+    for i, (view_key, _) in enumerate(batch):
+        stored = get_detections(view_key, key, vocab_sha, imgsz)
+        if stored is not None and stored[1] != "skipped":
+            out[i] = stored
+    todo = [i for i, o in enumerate(out) if o is None]
+    metrics.inc("pimetro_cache_total", len(batch) - len(todo), cache="detections", result="hit")
+    metrics.inc("pimetro_cache_total", len(todo), cache="detections", result="miss")
+    if todo:
+        found = detect_batch_raw(yolo_weights, [batch[i][1] for i in todo], classes, imgsz=imgsz)
+        for i, (dets, lenient_pass) in zip(todo, found):
+            put_detections(batch[i][0], key, vocab_sha, imgsz, classes, dets, lenient_pass)
+            out[i] = (dets, lenient_pass)
+    return out
+
+def combine_counts(per_view, mode="max"):
+    # per_view: [(counts_strict, counts_lenient, generic_hits)] de counts_from_detections
+    strict, lenient = defaultdict(int), defaultdict(int)
+    for counts_strict, counts_lenient, _ in per_view:
+        for out, counts in ((strict, counts_strict), (lenient, counts_lenient)):
+            for cat, k in counts.items():
+                out[cat] = max(out[cat], k) if mode == "max" else out[cat] + k
+    strict, lenient = dict(strict), dict(lenient)
+    generic_hits = sum(k for canon, k in lenient.items() if canon in GENERIC_CUE_CANONS)
+    return strict, lenient, generic_hits
+
+def score_views(weights_by_cat, totals_by_cat, dets_per_view, classes, combine="max", **params):
+    p = {**SCORING_DEFAULTS, **params}
+    per_view = [counts_from_detections(dets, classes, conf_strict=p["conf_strict"], conf_lenient=p["conf_lenient"])
+                for dets in dets_per_view]
+    return score_counts(weights_by_cat, totals_by_cat, *combine_counts(per_view, combine), **p)
+
+def run_views_analysis(media, ifc_path: str, ignore_mep: bool = True, on_stage=None,
+                       ifc_sha256: Optional[str] = None, combine: str = "max", ifc_weights=None,
+                       zone: Optional[str] = None):
+    on_stage = on_stage or (lambda stage: None)
+    model_version, mapping_version = analysis_versions(YOLO_WEIGHTS)
+
+    on_stage("parsing_ifc")
+    ifc_sha256 = ifc_sha256 or file_sha256(ifc_path)
+    model_weights = ifc_weights or build_ifc_weights_cached(ifc_path, ignore_mep, ifc_sha256)
+    weights_by_cat, totals_by_cat, zone = scoped_weights(*model_weights, ifc_path, ignore_mep, ifc_sha256, zone)
+    if not weights_by_cat:
+        return {
+            "progress_pct": 0.0,
+            "message": "Nenhum elemento do IFC mapeado às categorias.",
+            "weights_by_cat": {}, "totals_by_cat": {}, "ratios": {}, "counts": {},
+            "combine": combine, "views": [],
+            "model_version": model_version, "mapping_version": mapping_version, "zone": zone,
+        }
+
+    # Só as contagens de cada vista ficam na memória; as caixas vão para o
+    # detection_store, de onde o rescore as relê
+    on_stage("detecting")
+    classes = vocabulary_for(model_weights[0])
+    p = SCORING_DEFAULTS
+    views, per_view, passes, stats, batch = [], [], set(), {}, []
+
+    def flush():
+        for (view_key, _, path, ms), (dets, lenient_pass) in zip(
+                batch, detections_for_views(YOLO_WEIGHTS, [(b[0], b[1]) for b in batch], classes)):
+            views.append({"img_sha256": view_key, "media_path": path, "frame_ms": ms})
+            per_view.append(counts_from_detections(dets, classes, p["conf_strict"], p["conf_lenient"]))
+            passes.add(lenient_pass)
+        batch.clear()
+
+    for view in sample_views(media, stats):
+        if not views and not batch and not has_renditions(media[0]["sha256"]):
+            # Miniatura/prévia do caso: a primeira vista, com o hash da primeira mídia
+            make_renditions(media[0]["sha256"], view[1])
+        batch.append(view)
+        if len(batch) >= VIEW_BATCH:
+            flush()
+    if batch:
+        flush()
+    if not views:
+        raise ValueError("Nenhuma vista legível nas mídias enviadas")
+
+    on_stage("scoring")
+    progress_pct, ratios, _, _ = score_counts(weights_by_cat, totals_by_cat, *combine_counts(per_view, combine))
+    return {
+        "progress_pct": progress_pct,
+        "weights_by_cat": weights_by_cat,
+        "totals_by_cat": totals_by_cat,
+        "ratios": ratios,
+        "lenient_pass": "run" if "run" in passes else "shared",
+        "combine": combine,
+        "views_sampled": stats["sampled"], "views_kept": stats["kept"],
+        "views": views,
+        "model_version": model_version, "mapping_version": mapping_version,
+        "zone": zone,
+    }
 
-def _public_urls(request: Request, img_path: Optional[str], ifc_path: Optional[str]):
+# ========= Helpers =========
+def _public_urls(request: Request, img_path: Optional[str], ifc_path: Optional[str],
+                 img_exists: Optional[int] = None, ifc_exists: Optional[int] = None):
+    # *_exists vem das colunas da submissão; None = checar no disco
     base = str(request.base_url)
     img_url = None
-    if img_path and os.path.exists(img_path):
+    if img_path and (os.path.exists(img_path) if img_exists is None else img_exists):
         rel_img = os.path.relpath(img_path, _DB_DIR).replace(os.sep, "/")
         img_url = f"{base}files/{rel_img}"
     ifc_url = None
-    if ifc_path and os.path.exists(ifc_path):
+    if ifc_path and (os.path.exists(ifc_path) if ifc_exists is None else ifc_exists):
         rel_ifc = os.path.relpath(ifc_path, _DB_DIR).replace(os.sep, "/")
         ifc_url = f"{base}files/{rel_ifc}"
     return img_url, ifc_url
 
-# ========= Create =========
-@app.post("/teste")
-async def teste_post(
-    request: Request,
-    img: UploadFile = File(...),
-    ifc: UploadFile = File(...),
-    ignore_mep: Optional[str] = Form("true"),
-    caso: Optional[str] = Form(None),
-    desc: Optional[str] = Form(None),
+def _case_payload(request: Request, row):
+    id_, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at = row
+    with metrics.timer("public_urls"):
+        img_url, ifc_url = _public_urls(request, img_path, ifc_path)
+    img_sha256 = (get_case_hashes(id_) or (None,))[0]
+    return {
+        "id": id_,
+        "caso": caso, "descricao": descricao,
+        "progress_pct": progress_pct,
+        "img_path": img_url, "ifc_path": ifc_url,
+        **_rendition_urls(request, img_sha256, has_renditions(img_sha256)),
+        "zona": get_case_zone(id_),
+        "uploaded_at_iso": uploaded_at,
+    }
+
+# ========= Admissão e contrapressão =========
+# Análises aceitas (jobs queued/running, contados no SQLite: vale para o nó
+# todo) têm teto: acima dele a resposta é 429 na hora, com Retry-After, antes
+# de gravar os uploads. Parse de IFC e detecção têm limites de concorrência
+# próprios. Uploads usam um executor só deles; leituras ficam com o event
+# loop e o executor padrão.
+ANALYSIS_QUEUE_MAX = int(os.getenv("ANALYSIS_QUEUE_MAX", "8"))      # 0 = sem limite
+IFC_PARSE_CONCURRENCY = int(os.getenv("IFC_PARSE_CONCURRENCY", "1"))
+DETECT_CONCURRENCY = int(os.getenv("DETECT_CONCURRENCY", "1"))
+UPLOAD_THREADS = int(os.getenv("UPLOAD_THREADS", "4"))
+_SLOT_DIR = os.path.join(_DB_DIR, "slots")
+
+class StageSlots:
+    # Até `limit` donos simultâneos no nó: um arquivo de lock por vaga, e o
+    # flock some junto com um processo que morreu. O semáforo evita que
+    # threads do mesmo processo fiquem girando atrás de vaga.
+    def __init__(self, name: str, limit: int):
+        self.name, self.limit = name, max(1, limit)
+        self._local = threading.BoundedSemaphore(self.limit)
+
+    def _acquire_file(self):
+        os.makedirs(_SLOT_DIR, exist_ok=True)
+        while True:
+            for i in range(self.limit):
+                fd = os.open(os.path.join(_SLOT_DIR, f"{self.name}.{i}.lock"), os.O_RDWR | os.O_CREAT, 0o644)
+                try:
+                    fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    return fd
+                except BlockingIOError:
+                    os.close(fd)
+            time.sleep(0.05)
+
+    @contextmanager
+    def hold(self):
+        t0 = time.perf_counter()
+        with self._local:
+            if fcntl is None:
+                metrics.record_stage(f"{self.name}_wait", time.perf_counter() - t0)
+                yield
+                return
+            fd = self._acquire_file()
+            metrics.record_stage(f"{self.name}_wait", time.perf_counter() - t0)
+            try:
+                yield
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+                os.close(fd)
+
+IFC_SLOTS = StageSlots("ifc", IFC_PARSE_CONCURRENCY)
+DETECT_SLOTS = StageSlots("detect", DETECT_CONCURRENCY)
+_UPLOAD_POOL = ThreadPoolExecutor(max_workers=UPLOAD_THREADS, thread_name_prefix="upload")
+
+# ========= Formulários com upload (multipart em streaming) =========
+# O corpo é lido do stream e cada arquivo vai direto para BlobUpload: hash e
+# limite conferidos enquanto chega, 413 no primeiro pedaço acima do limite e
+# conteúdo novo gravado uma vez só. Parser e gravação rodam no _UPLOAD_POOL.
+FORM_FIELD_MAX_BYTES = 1 << 20   # campos de texto
+FORM_MAX_PARTS = 1000
+
+class UploadForm:
+    # fields: nome → valor; files: nome → [{"sha256", "path", "kind"}], cada
+    # um com uma referência no blob store
+    def __init__(self):
+        self.fields: Dict[str, str] = {}
+        self.files: Dict[str, list] = defaultdict(list)
+
+    def file(self, name: str) -> Optional[dict]:
+        return self.files[name][0] if self.files.get(name) else None
+
+    def paths(self) -> list:
+        return [f["path"] for files in self.files.values() for f in files]
+
+class _UploadFormParser:
+    # Callbacks do python-multipart. kinds: campo de arquivo → "img"/"ifc"/
+    # "video" ou função (nome do arquivo, content-type) → tipo
+    def __init__(self, boundary: bytes, kinds: dict, multiple=()):
+        from python_multipart.multipart import MultipartParser
+        self.kinds, self.multiple = kinds, set(multiple)
+        self.form = UploadForm()
+        self._parts = 0
+        self._header = [b"", b""]
+        self._headers = {}
+        self._name, self._blob, self._data = None, None, None
+        self._parser = MultipartParser(boundary, {
+            "on_part_begin": self._on_part_begin, "on_part_data": self._on_part_data,
+            "on_part_end": self._on_part_end, "on_header_field": self._on_header_field,
+            "on_header_value": self._on_header_value, "on_header_end": self._on_header_end,
+            "on_headers_finished": self._on_headers_finished,
+        })
+
+    def write(self, chunk: bytes):
+        from python_multipart.exceptions import MultipartParseError
+        try:
+            self._parser.write(chunk)
+        except MultipartParseError as e:
+            raise HTTPException(400, f"Formulário multipart inválido: {e}")
+
+    def finish(self):
+        from python_multipart.exceptions import MultipartParseError
+        try:
+            self._parser.finalize()
+        except MultipartParseError as e:
+            raise HTTPException(400, f"Formulário multipart inválido: {e}")
+        if self._blob is not None or self._data is not None:
+            raise HTTPException(400, "Formulário multipart incompleto")
+        return self.form
+
+    def abort(self):
+        # Falha no meio: descarta o arquivo pela metade e solta os já gravados
+        if self._blob is not None:
+            self._blob.discard()
+            self._blob = None
+        release_upload_blobs(self.form.paths())
+        self.form.files.clear()
+
+    def _on_part_begin(self):
+        self._parts += 1
+        if self._parts > FORM_MAX_PARTS:
+            raise HTTPException(413, f"Formulário com mais de {FORM_MAX_PARTS} partes")
+        self._headers = {}
+
+    def _on_header_field(self, data, start, end):
+        self._header[0] += data[start:end]
+
+    def _on_header_value(self, data, start, end):
+        self._header[1] += data[start:end]
+
+    def _on_header_end(self):
+        self._headers[self._header[0].lower()] = self._header[1]
+        self._header = [b"", b""]
+
+    def _on_headers_finished(self):
+        from python_multipart.multipart import parse_options_header
+        _, options = parse_options_header(self._headers.get(b"content-disposition", b""))
+        if b"name" not in options:
+            raise HTTPException(400, "Parte do formulário sem nome")
+        self._name = options[b"name"].decode("utf-8", "replace")
+        filename = options.get(b"filename")
+        if filename is None:
+            self._data = bytearray()
+            return
+        filename = filename.decode("utf-8", "replace")
+        if not filename:
+            return   # campo de arquivo sem nada escolhido
+        kind = self.kinds.get(self._name)
+        if kind is None:
+            raise HTTPException(422, f"Campo de arquivo inesperado: {self._name}")
+        if self.form.files.get(self._name) and self._name not in self.multiple:
+            raise HTTPException(422, f"Envie um só arquivo em {self._name}")
+        if callable(kind):
+            kind = kind(filename, self._headers.get(b"content-type", b"").decode("latin-1"))
+        self._blob = BlobUpload(kind, filename)
+
+    def _on_part_data(self, data, start, end):
+        if self._blob is not None:
+            self._blob.write(data[start:end])
+        elif self._data is not None:
+            self._data += data[start:end]
+            if len(self._data) > FORM_FIELD_MAX_BYTES:
+                raise HTTPException(413, f"Campo {self._name} excede {FORM_FIELD_MAX_BYTES >> 10} KB")
+
+    def _on_part_end(self):
+        if self._blob is not None:
+            blob, self._blob = self._blob, None
+            sha, path = blob.commit()
+            self.form.files[self._name].append({"sha256": sha, "path": path, "kind": blob.kind})
+        elif self._data is not None:
+            self.form.fields[self._name] = self._data.decode("utf-8", "replace")
+            self._data = None
+
+def form_max_bytes(*kinds: str) -> int:
+    # Content-Length máximo de um formulário com um arquivo de cada tipo
+    return (sum(UPLOAD_MAX_MB[k] for k in kinds) + 1) << 20
+
+async def read_upload_form(request: Request, kinds: dict, multiple=(), max_bytes: Optional[int] = None):
+    # max_bytes: Content-Length acima disso é recusado antes de ler o corpo
+    from python_multipart.multipart import parse_options_header
+    length = request.headers.get("content-length", "")
+    if max_bytes is not None and length.isdigit() and int(length) > max_bytes:
+        raise HTTPException(413, f"Envio excede o limite de {max_bytes >> 20} MB")
+    content_type, params = parse_options_header(request.headers.get("content-type", ""))
+    if content_type == b"application/x-www-form-urlencoded":
+        # Só campos de texto (ex.: PUT renomeando o caso)
+        form, body = UploadForm(), bytearray()
+        async for chunk in request.stream():
+            body += chunk
+            if len(body) > FORM_FIELD_MAX_BYTES:
+                raise HTTPException(413, f"Formulário excede {FORM_FIELD_MAX_BYTES >> 10} KB")
+        form.fields.update(parse_qsl(body.decode("utf-8", "replace"), keep_blank_values=True))
+        return form
+    if content_type != b"multipart/form-data" or not params.get(b"boundary"):
+        raise HTTPException(415, "Envie o formulário como multipart/form-data")
+
+    parser = _UploadFormParser(params[b"boundary"], kinds, multiple)
+    loop = asyncio.get_running_loop()
+    # Com o contexto da requisição: a etapa "upload" entra no Server-Timing
+    ctx = contextvars.copy_context()
+    buf = bytearray()
+    try:
+        async for chunk in request.stream():
+            buf += chunk
+            if len(buf) >= _UPLOAD_CHUNK:
+                await loop.run_in_executor(_UPLOAD_POOL, ctx.run, parser.write, bytes(buf))
+                buf.clear()
+        if buf:
+            await loop.run_in_executor(_UPLOAD_POOL, ctx.run, parser.write, bytes(buf))
+        return await loop.run_in_executor(_UPLOAD_POOL, ctx.run, parser.finish)
+    except BaseException:
+        await loop.run_in_executor(_UPLOAD_POOL, parser.abort)
+        raise
+
+def analysis_backlog(conn) -> int:
+    return conn.execute("SELECT COUNT(*) FROM jobs WHERE status IN ('queued','running')").fetchone()[0]
+
+def _analysis_busy(conn, backlog: int) -> HTTPException:
+    # Retry-After: duração média dos últimos jobs × posições até abrir vaga
+    avg = conn.execute("""
+        SELECT AVG((julianday(updated_at) - julianday(created_at)) * 86400) FROM (
+            SELECT created_at, updated_at FROM jobs WHERE status='done' ORDER BY updated_at DESC LIMIT 20)
+    """).fetchone()[0] or 30.0
+    wait = avg * (backlog - ANALYSIS_QUEUE_MAX + 1) / max(ANALYSIS_WORKERS, 1)
+    return HTTPException(429, "Fila de análise cheia; tente novamente mais tarde",
+                         headers={"Retry-After": str(int(min(600, max(1, wait))))})
+
+def check_analysis_capacity():
+    # Checagem barata na entrada; create_job refaz a conta na transação que cria o job
+    if _WARMUP["status"] == "error":
+        raise HTTPException(503, "Análise indisponível: falha ao carregar o modelo",
+                            headers={"Retry-After": "60"})
+    if ANALYSIS_QUEUE_MAX <= 0:
+        return
+    with _db.read() as conn:
+        backlog = analysis_backlog(conn)
+        if backlog >= ANALYSIS_QUEUE_MAX:
+            raise _analysis_busy(conn, backlog)
+
+# ========= Métricas e perfil =========
+# Tempo por etapa (pimetro_stage_seconds), por rota HTTP e por job, mais
+# contadores de cache, cargas de modelo, linhas lidas e bytes enviados; ver
+# metrics.py. GET /metrics soma os retratos de todos os processos do nó.
+# Toda resposta leva Server-Timing com as etapas da requisição (e do job que
+# ela esperou). Perfil por requisição: amostragem (PROFILE_SAMPLE_RATE) ou
+# cabeçalho X-Profile igual a PROFILE_TOKEN; o .prof vai para db/profiles.
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_TOKEN = os.getenv("PROFILE_TOKEN") or None
+_PROFILE_DIR = os.path.join(_DB_DIR, "profiles")
+_PROFILE_LOCK = threading.Lock()   # um perfil por vez: o cProfile é um só por thread
+metrics.configure(os.path.join(_DB_DIR, "metrics"))
+
+for _name, _kind, _text in (
+    ("pimetro_stage_seconds", "histogram", "Duração de cada etapa (upload, IFC, modelo, detecção, score, gravação)"),
+    ("pimetro_http_request_seconds", "histogram", "Duração das requisições HTTP por rota"),
+    ("pimetro_job_seconds", "histogram", "Duração dos jobs de análise, da fila ao fim"),
+    ("pimetro_cache_total", "counter", "Consultas aos caches (blob, ifc_weights, detections, vocab) por resultado"),
+    ("pimetro_model_loads_total", "counter", "Modelos carregados no processo"),
+    ("pimetro_db_rows_total", "counter", "Linhas lidas do SQLite por consulta"),
+    ("pimetro_upload_bytes_total", "counter", "Bytes recebidos em uploads por tipo"),
+    ("pimetro_lenient_pass_total", "counter", "Passadas lenient por decisão (run, shared, skipped)"),
 ):
-    form = await request.form()
-    ignore_mep_bool = str(ignore_mep or form.get("ignore_mep") or "true").lower() in {"1","true","on","yes"}
-    caso = caso or form.get("caso") or form.get("case") or ""
-    desc = desc or form.get("desc") or form.get("description") or ""
-
-    # temp
-    with NamedTemporaryFile(delete=False, suffix=os.path.splitext(img.filename)[1]) as tf_img:
-        shutil.copyfileobj(img.file, tf_img)
-        tmp_img_path = tf_img.name
-    with NamedTemporaryFile(delete=False, suffix=os.path.splitext(ifc.filename)[1]) as tf_ifc:
-        shutil.copyfileobj(ifc.file, tf_ifc)
-        tmp_ifc_path = tf_ifc.name
-
-    case_dir = os.path.join(_DB_DIR, f"case_{slugify(caso)}")
-    os.makedirs(case_dir, exist_ok=True)
-    final_img = os.path.join(case_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(img.filename)}")
-    final_ifc = os.path.join(case_dir, os.path.basename(ifc.filename))
+    metrics.describe(_name, _kind, _text)
+
+def _start_profile(scope):
+    token = dict(scope.get("headers") or ()).get(b"x-profile")
+    wanted = ((PROFILE_TOKEN and token and token.decode(errors="ignore") == PROFILE_TOKEN)
+              or (PROFILE_SAMPLE_RATE > 0 and random.random() < PROFILE_SAMPLE_RATE))
+    if not wanted or not _PROFILE_LOCK.acquire(blocking=False):
+        return None
+    profiler = cProfile.Profile()
+    profiler.enable()
+    return profiler
+
+def _profile_name(method: str, route: str) -> str:
+    slug = route.strip("/").replace("/", "_").replace("{", "").replace("}", "") or "raiz"
+    return f"{datetime.now(timezone.utc).strftime('%Y%m%dT%H%M%S%f')}-{method}-{slug}.prof"
+
+def _finish_profile(profiler, name: str):
+    profiler.disable()
+    _PROFILE_LOCK.release()
+    os.makedirs(_PROFILE_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(_PROFILE_DIR, name))
+
+def _route_of(scope) -> str:
+    # Modelo da rota (/casos/{id}), não o caminho: rótulos com cardinalidade fixa
+    route = scope.get("route")
+    if route is not None:
+        return route.path
+    return "/files" if scope["path"].startswith("/files/") else "<sem rota>"
+
+class _Instrumentation:
+    # Middleware ASGI: as etapas cronometradas durante a requisição (mesmo
+    # contexto, inclusive nas threads de upload) entram no Server-Timing
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            return await self.app(scope, receive, send)
+        token, timings = metrics.start_timings()
+        profiler = _start_profile(scope)
+        t0 = time.perf_counter()
+        status, profile_name = [500], [None]
+
+        async def send_timed(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                headers = message.setdefault("headers", [])
+                if isinstance(headers, tuple):
+                    headers = message["headers"] = list(headers)
+                headers.append((b"server-timing", metrics.server_timing(
+                    [*timings, ("app", time.perf_counter() - t0)]).encode("latin-1")))
+                headers.append((b"timing-allow-origin", b"*"))
+                if profiler is not None:
+                    profile_name[0] = _profile_name(scope["method"], _route_of(scope))
+                    headers.append((b"x-profile-file", profile_name[0].encode()))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_timed)
+        finally:
+            metrics.stop_timings(token)
+            route = _route_of(scope)
+            metrics.observe("pimetro_http_request_seconds", time.perf_counter() - t0,
+                            method=scope["method"], route=route, status=str(status[0]))
+            if profiler is not None:
+                _finish_profile(profiler, profile_name[0] or _profile_name(scope["method"], route))
+
+app.add_middleware(_Instrumentation)
+
+def _metrics_gauges():
+    with _db.read() as conn:
+        backlog = analysis_backlog(conn)
+    return [
+        ("pimetro_analysis_backlog", "Análises na fila ou rodando no nó", [({}, backlog)]),
+        ("pimetro_model_ready", "1 quando o modelo deste worker está aquecido",
+         [({}, int(_WARMUP["status"] == "ready"))]),
+        ("pimetro_startup_seconds", "Boot deste worker: import do main, app aceitando requisições, modelo pronto",
+         [({"phase": k[:-2]}, v) for k, v in _STARTUP.items() if k.endswith("_s") and v is not None]),
+    ]
 
+@app.get("/metrics")
+async def metrics_endpoint():
+    text = await asyncio.to_thread(lambda: metrics.render(_metrics_gauges()))
+    return Response(text, media_type="text/plain; version=0.0.4; charset=utf-8")
+
+# ========= Jobs de análise =========
+# Parse do IFC e detecção rodam fora do event loop: num pool de processos
+# (ANALYSIS_WORKERS) ou, com 0, numa thread do próprio processo. O estado
+# do job fica no SQLite; pendentes são reenfileirados no próximo start.
+ANALYSIS_WORKERS = int(os.getenv("ANALYSIS_WORKERS", "1"))
+_POOL = None
+_POOL_LOCK = threading.Lock()
+
+def get_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            if ANALYSIS_WORKERS > 0:
+                # spawn: cada worker importa este módulo e aquece o próprio modelo
+                _POOL = ProcessPoolExecutor(max_workers=ANALYSIS_WORKERS,
+                                            mp_context=multiprocessing.get_context("spawn"),
+                                            initializer=None if MODEL_WARMUP == "lazy" else warmup_models)
+            else:
+                _POOL = ThreadPoolExecutor(max_workers=1, thread_name_prefix="analysis")
+        return _POOL
+
+def _reset_pool(pool):
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is pool:
+            _POOL = None
+    pool.shutdown(wait=False, cancel_futures=True)
+
+def _worker_status():
+    return dict(_WARMUP)
+
+def warmup_workers():
+    _WARMUP.update(status="loading", started_at=datetime.now(timezone.utc).isoformat())
+    t0 = time.perf_counter()
     try:
-        shutil.move(tmp_img_path, final_img)
-        shutil.move(tmp_ifc_path, final_ifc)
-
-        # IFC
-        weights_by_cat, totals_by_cat = build_ifc_weights(final_ifc, ignore_mep=ignore_mep_bool)
-        if not weights_by_cat:
-            save_submission(caso, desc, 0.0, final_img, final_ifc)
-            img_url, ifc_url = _public_urls(request, final_img, final_ifc)
-            return JSONResponse({
-                "progress_pct": 0.0,
-                "message": "Nenhum elemento do IFC mapeado às categorias.",
-                "weights_by_cat": {}, "totals_by_cat": {}, "ratios": {}, "counts": {},
-                "img_path": img_url, "ifc_path": ifc_url, "caso": caso, "desc": desc
-            })
-
-        # YOLO dual
-        counts_strict, counts_lenient, generic_hits = detect_photo_dual(
-            YOLO_WEIGHTS, final_img, YOLO_CLASSES, conf_strict=0.22, conf_lenient=0.03, imgsz=1920
-        )
-        progress_pct, ratios = compute_progress_soft(
-            weights_by_cat, totals_by_cat, counts_strict, counts_lenient,
-            beta_lenient=0.70, eps_fallback=0.12, generic_hits=generic_hits
-        )
-        ratios = apply_rail_prior(ratios, counts_strict, counts_lenient, boost=0.08)
-        progress_pct = round(progress_pct, 1)
-
-        save_submission(caso, desc, float(progress_pct), final_img, final_ifc)
-        img_url, ifc_url = _public_urls(request, final_img, final_ifc)
-
-        return JSONResponse({
-            "progress_pct": progress_pct,
-            "weights_by_cat": weights_by_cat,
-            "totals_by_cat": totals_by_cat,
-            "ratios": ratios,
-            "img_path": img_url, "ifc_path": ifc_url,
-            "caso": caso, "desc": desc
-        })
+        pool = get_pool()
+        statuses = [f.result() for f in [pool.submit(_worker_status) for _ in range(ANALYSIS_WORKERS)]]
+        errors = [st["error"] for st in statuses if st["status"] != "ready"]
+        if errors:
+            logger.error("Worker de análise sem modelo: %s", errors[0])
+            _WARMUP.update(status="error", error=errors[0], finished_at=datetime.now(timezone.utc).isoformat())
+        else:
+            _WARMUP.update(status="ready", finished_at=datetime.now(timezone.utc).isoformat())
+            _STARTUP["model_s"] = round(time.perf_counter() - t0, 3)
+            logger.info("%d worker(s) de análise prontos em %.2fs", ANALYSIS_WORKERS, _STARTUP["model_s"])
+    except Exception as e:
+        logger.exception("Falha ao aquecer os workers de análise")
+        _WARMUP.update(status="error", error=str(e), finished_at=datetime.now(timezone.utc).isoformat())
+
+def _finish_create_job(job_id: str, params: dict, result: dict):
+    # Linha da submissão e conclusão do job na mesma transação: um job
+    # retomado após queda nunca grava a submissão duas vezes
+    now = datetime.now(timezone.utc).isoformat()
+    with _db.transaction() as conn:
+        cur = conn.execute(SUBMISSION_INSERT, _submission_values(
+            params["caso"], params["desc"], float(result["progress_pct"]),
+            params["img_path"], params["ifc_path"], now, params.get("ifc_sha256"),
+            params.get("img_sha256"), params["ignore_mep"], has_renditions(params.get("img_sha256")),
+            result.get("lenient_pass"), params.get("combine"),
+            result.get("model_version"), result.get("mapping_version"), result.get("zone")))
+        record_measurement(conn, cur.lastrowid, "create", result.get("ratios"))
+        if params.get("media"):
+            # Mídia sem nenhuma vista mantida (toda duplicada) não fica no caso
+            _insert_views(conn, cur.lastrowid, result["views"])
+            used = {params["img_path"], *(v["media_path"] for v in result["views"])}
+            release_blobs(conn, [m["path"] for m in params["media"] if m["path"] not in used])
+        conn.execute("""
+            UPDATE jobs SET status='done', stage='done', result=?, submission_id=?, updated_at=? WHERE id=?
+        """, (json.dumps(result), cur.lastrowid, now, job_id))
+
+# Blobs enviados com o job que não chegaram a uma submissão
+_JOB_UPLOAD_KEYS = {"create": ("img_path", "ifc_path"), "update": ("new_img_path", "new_ifc_path"),
+                    "create_views": ("ifc_path",)}
+
+def _job_upload_paths(kind: str, params: dict):
+    return [params.get(k) for k in _JOB_UPLOAD_KEYS.get(kind, ())] + [m["path"] for m in params.get("media", ())]
+
+def _fail_job(job_id: str, error: str):
+    # Erro e liberação dos uploads na mesma transação: só a primeira falha
+    # registrada solta as referências
+    with _db.transaction() as conn:
+        row = conn.execute("SELECT kind, status, params FROM jobs WHERE id=?", (job_id,)).fetchone()
+        if not row or row[1] not in ("queued", "running"):
+            return
+        kind, _, params = row
+        conn.execute("UPDATE jobs SET status='error', stage='failed', error=?, updated_at=? WHERE id=?",
+                     (error, datetime.now(timezone.utc).isoformat(), job_id))
+        params = json.loads(params)
+        release_blobs(conn, _job_upload_paths(kind, params))
+
+def run_job(job_id: str):
+    job = get_job(job_id)
+    if not job or job["status"] not in ("queued", "running"):
+        return job and job["status"]
+    # Etapas medidas neste processo ficam no job: a requisição que esperou
+    # por ele as devolve no Server-Timing
+    token, timings = metrics.start_timings()
+    queued = max(0.0, time.time() - datetime.fromisoformat(job["created_at"]).timestamp())
+    metrics.record_stage("queue", queued)
+    t0 = time.perf_counter()
+    try:
+        status = _run_job(job_id, job)
     finally:
-        for p in (tmp_img_path, tmp_ifc_path):
-            try: os.remove(p)
-            except: pass
+        metrics.stop_timings(token)
+    metrics.observe("pimetro_job_seconds", queued + time.perf_counter() - t0, kind=job["kind"], status=status)
+    with _db.transaction() as conn:
+        conn.execute("UPDATE jobs SET timings=? WHERE id=?", (json.dumps(timings), job_id))
+    return status
+
+def _run_job(job_id: str, job: dict):
+    params = json.loads(job["params"])
+    on_stage = lambda stage: set_job(job_id, stage=stage)
+    set_job(job_id, status="running", stage="starting")
+    try:
+        if job["kind"] == "create":
+            result = run_analysis(params["img_path"], params["ifc_path"], params["ignore_mep"], on_stage,
+                                  ifc_sha256=params.get("ifc_sha256"), img_sha256=params.get("img_sha256"),
+                                  zone=params.get("zone"))
+            on_stage("saving")
+            with metrics.timer("save"):
+                _finish_create_job(job_id, params, result)
+        elif job["kind"] == "create_views":
+            result = run_views_analysis(params["media"], params["ifc_path"], params["ignore_mep"], on_stage,
+                                        ifc_sha256=params.get("ifc_sha256"), combine=params["combine"],
+                                        zone=params.get("zone"))
+            on_stage("saving")
+            with metrics.timer("save"):
+                _finish_create_job(job_id, params, result)
+        elif job["kind"] == "update":
+            row = get_case_row(params["id"])
+            if not row:
+                raise RuntimeError("Caso não encontrado")
+            _, _, _, _, old_img, old_ifc, _ = row
+            # Arquivo não reenviado: o hash guardado acerta os caches (pesos IFC, detecções)
+            old_img_sha256, old_ifc_sha256, _ = get_case_hashes(params["id"])
+            ifc_sha256 = params.get("ifc_sha256") if params["new_ifc_path"] else old_ifc_sha256
+            img_sha256 = params.get("img_sha256") if params["new_img_path"] else old_img_sha256
+            if ifc_sha256 is None and old_ifc and os.path.exists(old_ifc):
+                ifc_sha256 = file_sha256(old_ifc)
+            if img_sha256 is None and old_img and os.path.exists(old_img):
+                img_sha256 = file_sha256(old_img)
+            # Zona nova ("" = modelo inteiro) ou a já gravada
+            zone = params.get("zone")
+            zone = get_case_zone(params["id"]) if zone is None else zone
+            if params.get("zone"):
+                # Zona pedida e inexistente falha o job (não cai no "mantém o progresso")
+                index = zone_index_cached(params["new_ifc_path"] or old_ifc, params["ignore_mep"], ifc_sha256)
+                if index is not None:
+                    index.find(zone)
+            # Caso de várias vistas sem foto nova: reanalisa as mesmas mídias
+            combine, views = (None, []) if params["new_img_path"] else get_case_views(params["id"])
+            result = None
+            try:
+                if views:
+                    result = run_views_analysis(media_of_views(views), params["new_ifc_path"] or old_ifc,
+                                                params["ignore_mep"], on_stage, ifc_sha256=ifc_sha256,
+                                                combine=combine, zone=zone)
+                else:
+                    result = run_analysis(params["new_img_path"] or old_img, params["new_ifc_path"] or old_ifc,
+                                          params["ignore_mep"], on_stage, ifc_sha256=ifc_sha256,
+                                          img_sha256=img_sha256, zone=zone)
+            except Exception:
+                # Em caso de falha no recálculo, mantém o progresso antigo
+                logger.exception("Erro durante o recálculo de progresso para o caso %s", params["id"])
+            on_stage("saving")
+            with metrics.timer("save"):
+                ok = update_case_row(params["id"], params["caso"], params["desc"],
+                                     params["new_img_path"], params["new_ifc_path"],
+                                     result["progress_pct"] if result else None,
+                                     ifc_sha256=ifc_sha256, img_sha256=img_sha256,
+                                     ignore_mep=params["ignore_mep"] if result else None,
+                                     img_renditions=has_renditions(img_sha256),
+                                     lenient_pass=result.get("lenient_pass") if result else None,
+                                     views=(result.get("views") or None) if views and result else None,
+                                     model_version=result.get("model_version") if result else None,
+                                     mapping_version=result.get("mapping_version") if result else None,
+                                     zone=(result.get("zone") or "") if result else None,
+                                     ratios=result.get("ratios") if result else None)
+            if not ok:
+                raise RuntimeError("Falha ao atualizar")
+            set_job(job_id, status="done", stage="done", result=json.dumps(result or {}),
+                    submission_id=params["id"])
+        else:
+            raise RuntimeError(f"Tipo de job desconhecido: {job['kind']}")
+    except Exception as e:
+        logger.exception("Job %s (%s) falhou", job_id, job["kind"])
+        _fail_job(job_id, str(e))
+        return "error"
+    return "done"
+
+def _on_job_done(job_id: str, pool, fut):
+    exc = fut.exception() if not fut.cancelled() else None
+    if exc is None:
+        return
+    # Worker morreu (OOM, kill): o pool fica inutilizável e é recriado no próximo job
+    if isinstance(exc, BrokenProcessPool):
+        logger.error("Pool de análise quebrado durante o job %s; será recriado", job_id)
+        _reset_pool(pool)
+    else:
+        logger.error("Job %s falhou fora de run_job", job_id, exc_info=exc)
+    _fail_job(job_id, str(exc) or type(exc).__name__)
+
+def submit_job(job_id: str):
+    pool = get_pool()
+    try:
+        fut = pool.submit(run_job, job_id)
+    except BrokenProcessPool:
+        logger.warning("Pool de análise quebrado; recriando para o job %s", job_id)
+        _reset_pool(pool)
+        pool = get_pool()
+        fut = pool.submit(run_job, job_id)
+    fut.add_done_callback(lambda f: _on_job_done(job_id, pool, f))
+    return fut
+
+def _job_status(job: dict) -> dict:
+    return {
+        "job_id": job["id"], "kind": job["kind"],
+        "status": job["status"], "stage": job["stage"],
+        "error": job["error"], "submission_id": job["submission_id"],
+        "created_at": job["created_at"], "updated_at": job["updated_at"],
+    }
+
+def _job_result(request: Request, job: dict):
+    if job["status"] == "error":
+        raise HTTPException(500, job["error"] or "Falha na análise")
+    if job["status"] != "done":
+        raise HTTPException(409, "Análise ainda em andamento")
+    params = json.loads(job["params"])
+    if job["kind"] in ("create", "create_views"):
+        result = json.loads(job["result"])
+        with metrics.timer("public_urls"):
+            img_url, ifc_url = _public_urls(request, params["img_path"], params["ifc_path"])
+        return {**result, "img_path": img_url, "ifc_path": ifc_url,
+                "caso": params["caso"], "desc": params["desc"]}
+    row = get_case_row(job["submission_id"])
+    if not row:
+        raise HTTPException(404, "Caso não encontrado")
+    return _case_payload(request, row)
+
+async def _dispatch_job(request: Request, kind: str, params: dict, modo: Optional[str]):
+    # SQLite sempre numa thread: BEGIN IMMEDIATE pode esperar até busy_timeout
+    # por um lote do reprocessamento, e o event loop não pode parar junto
+    try:
+        job_id = await asyncio.to_thread(create_job, kind, params, ANALYSIS_QUEUE_MAX)
+    except HTTPException:
+        # Fila encheu enquanto os uploads eram gravados
+        await asyncio.to_thread(release_upload_blobs, _job_upload_paths(kind, params))
+        raise
+    fut = submit_job(job_id)
+    if (modo or "").lower() == "job":
+        return JSONResponse({"job_id": job_id, "status": "queued",
+                             "status_url": f"{request.base_url}jobs/{job_id}"}, status_code=202)
+    try:
+        await asyncio.wrap_future(fut)
+    except Exception:
+        pass  # o erro já está registrado no job
+    job = await asyncio.to_thread(get_job, job_id)
+    metrics.add_timings(json.loads(job["timings"] or "[]"))
+    return JSONResponse(await asyncio.to_thread(_job_result, request, job))
+
+def _start_analysis():
+    # Em thread para o servidor já atender leituras enquanto os pesos carregam
+    metrics.prune()
+    if MODEL_WARMUP != "lazy":
+        target = warmup_workers if ANALYSIS_WORKERS > 0 else warmup_models
+        threading.Thread(target=target, name="yolo-warmup", daemon=True).start()
+    for job_id in pending_job_ids():
+        submit_job(job_id)
+    _STARTUP["serving_s"] = round(time.perf_counter() - _IMPORT_T0, 3)
+    logger.info("Worker aceitando requisições em %.2fs (import do main: %.2fs, modelo: %s)",
+                _STARTUP["serving_s"], _STARTUP["import_s"], MODEL_WARMUP)
+
+def _stop_analysis():
+    metrics.flush()
+    if _POOL is not None:
+        _POOL.shutdown(wait=False, cancel_futures=True)
+
+# Handlers que só leem/escrevem no SQLite são `def`: o Starlette os roda no
+# threadpool, e uma espera pelo lock de escrita não trava o event loop
+@app.get("/jobs/{job_id}")
+def job_status(job_id: str):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(404, "Job não encontrado")
+    return _job_status(job)
+
+@app.get("/jobs/{job_id}/result")
+def job_result(job_id: str, request: Request):
+    job = get_job(job_id)
+    if not job:
+        raise HTTPException(404, "Job não encontrado")
+    return _job_result(request, job)
+
+async def with_ifc_indexed(fn):
+    # fn roda numa thread; se pedir um IFC ainda não indexado, o parse vai para
+    # o pool de análise (nunca para o event loop) e fn roda de novo
+    try:
+        return await asyncio.to_thread(fn)
+    except IfcNotIndexed as e:
+        await asyncio.wrap_future(get_pool().submit(_ingest_ifc_task, *e.args))
+    return await asyncio.to_thread(fn)
+
+# ========= Create =========
+def _media_kind(filename: str, content_type: str) -> str:
+    video = os.path.splitext(filename)[1].lower() in VIDEO_EXTS or content_type.startswith("video/")
+    return "video" if video else "img"
+
+async def _reject_form(form: UploadForm, status: int, detail: str):
+    await asyncio.to_thread(release_upload_blobs, form.paths())
+    raise HTTPException(status, detail)
+
+@app.post("/teste")
+async def teste_post(request: Request):
+    # multipart: img e ifc (arquivos); ignore_mep, caso, desc, zona (GlobalId
+    # ou nome do andar/espaço/trecho do IFC) e modo ("job": responde 202 com o
+    # id e processa em segundo plano)
+    await asyncio.to_thread(check_analysis_capacity)
+    # Blob store: hash enquanto o arquivo chega, gravação única por conteúdo
+    form = await read_upload_form(request, {"img": "img", "ifc": "ifc"},
+                                  max_bytes=form_max_bytes("img", "ifc"))
+    img, ifc = form.file("img"), form.file("ifc")
+    if img is None or ifc is None:
+        await _reject_form(form, 422, "Envie a foto (img) e o IFC (ifc)")
+    fields = form.fields
+    ignore_mep_bool = str(fields.get("ignore_mep") or "true").lower() in {"1","true","on","yes"}
+    caso = fields.get("caso") or fields.get("case") or ""
+    desc = fields.get("desc") or fields.get("description") or ""
+
+    return await _dispatch_job(request, "create", {
+        "img_path": img["path"], "ifc_path": ifc["path"],
+        "img_sha256": img["sha256"], "ifc_sha256": ifc["sha256"],
+        "ignore_mep": ignore_mep_bool, "caso": caso, "desc": desc,
+        "zone": (fields.get("zona") or "").strip() or None,
+    }, fields.get("modo"))
+
+@app.post("/teste/vistas")
+async def teste_vistas_post(request: Request):
+    # multipart: midias (repetível; fotos e/ou vídeos MP4 do mesmo trecho) e
+    # ifc; ignore_mep, caso, desc, combinar ("max" ou "soma"), zona e modo
+    await asyncio.to_thread(check_analysis_capacity)
+    form = await read_upload_form(request, {"midias": _media_kind, "ifc": "ifc"}, multiple=("midias",))
+    fields = form.fields
+    combine = (fields.get("combinar") or "max").lower()
+    if combine not in VIEW_COMBINE_MODES:
+        await _reject_form(form, 422, f"combinar deve ser um de: {', '.join(VIEW_COMBINE_MODES)}")
+    ifc = form.file("ifc")
+    if ifc is None or not form.files.get("midias"):
+        await _reject_form(form, 422, "Envie ao menos uma mídia (midias) e o IFC (ifc)")
+    ignore_mep_bool = str(fields.get("ignore_mep") or "true").lower() in {"1","true","on","yes"}
+
+    # Mesmo arquivo enviado duas vezes vira uma mídia só (uma referência por mídia)
+    media, seen, repeated = [], set(), []
+    for m in form.files["midias"]:
+        if m["sha256"] in seen:
+            repeated.append(m["path"])
+            continue
+        seen.add(m["sha256"])
+        media.append({"path": m["path"], "sha256": m["sha256"], "video": m["kind"] == "video"})
+    if repeated:
+        await asyncio.to_thread(release_upload_blobs, repeated)
+
+    return await _dispatch_job(request, "create_views", {
+        "media": media, "img_path": media[0]["path"], "img_sha256": media[0]["sha256"],
+        "ifc_path": ifc["path"], "ifc_sha256": ifc["sha256"], "combine": combine,
+        "ignore_mep": ignore_mep_bool, "caso": fields.get("caso") or "", "desc": fields.get("desc") or "",
+        "zone": (fields.get("zona") or "").strip() or None,
+    }, fields.get("modo"))
 
 # ========= Read list =========
-@app.get("/casos")
-async def list_casos(request: Request):
-    conn = sqlite3.connect(DB_PATH)
-    cur = conn.cursor()
+# Paginação por cursor (uploaded_at, id) em ordem decrescente, servida pelo
+# índice idx_submissions_uploaded_at. ETag/Last-Modified vêm de
+# table_versions: lista inalterada responde 304 sem consultar as linhas.
+CASOS_PAGE_DEFAULT = 50
+CASOS_PAGE_MAX = 500
+CASOS_FIELDS = ("id", "caso", "descricao", "progress_pct", "img_path", "ifc_path", "thumb_url", "preview_url",
+                "data", "uploaded_at_iso")
+
+def _encode_cursor(uploaded_at: str, id_: int) -> str:
+    raw = json.dumps([uploaded_at, id_], separators=(",", ":")).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip("=")
+
+def _decode_cursor(cursor: str):
     try:
-        cur.execute("""
-            SELECT id, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at
-            FROM submissions
-            ORDER BY uploaded_at DESC
-        """)
-        rows = cur.fetchall()
-        cases = []
-        for (id_, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at) in rows:
+        raw = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        uploaded_at, id_ = json.loads(raw)
+        return str(uploaded_at), int(id_)
+    except Exception:
+        raise HTTPException(400, "Cursor inválido")
+
+def _parse_date_param(value: Optional[str], end: bool = False) -> Optional[str]:
+    # Data (AAAA-MM-DD) ou data/hora ISO; sem fuso = UTC. Uma data pura em
+    # `ate` inclui o dia inteiro.
+    if not value:
+        return None
+    try:
+        dt = datetime.fromisoformat(value.replace("Z", "+00:00"))
+    except ValueError:
+        raise HTTPException(422, f"Data inválida: {value}")
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    if end and len(value) == 10:
+        dt += timedelta(days=1)
+    return dt.astimezone(timezone.utc).isoformat()
+
+def submissions_version():
+    with _db.read() as conn:
+        return conn.execute("SELECT version, updated_at FROM table_versions WHERE name='submissions'").fetchone()
+
+def _list_validators(request: Request, version, updated_at: str):
+    # O ETag cobre a versão da tabela e a URL inteira (filtros, cursor e host)
+    etag = '"' + hashlib.sha256(f"{version}|{request.url}".encode()).hexdigest()[:20] + '"'
+    last_modified = datetime.fromisoformat(updated_at).astimezone(timezone.utc)
+    return etag, last_modified
+
+def _not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    inm = request.headers.get("if-none-match")
+    if inm is not None:
+        return etag in {t.strip() for t in inm.split(",")} or inm.strip() == "*"
+    ims = request.headers.get("if-modified-since")
+    if ims:
+        try:
+            return last_modified.replace(microsecond=0) <= parsedate_to_datetime(ims)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def _casos_items(request: Request, rows, fields, want_urls: bool):
+    cases = []
+    for (id_, caso_, descricao, progress_pct, img_path, ifc_path, uploaded_at, img_exists, ifc_exists,
+         img_sha256, img_renditions) in rows:
+        item = {
+            "id": id_,
+            "caso": caso_ or "Sem nome",
+            "descricao": descricao or "Sem descrição",
+            "progress_pct": float(f"{float(progress_pct):.2f}"),
+            "uploaded_at_iso": uploaded_at,
+        }
+        if "data" in fields:
             try:
                 dt = datetime.fromisoformat(uploaded_at.replace("Z","+00:00"))
-                formatted_date = dt.strftime("%d/%m/%Y")
+                item["data"] = dt.strftime("%d/%m/%Y")
             except Exception:
-                formatted_date = uploaded_at
-            img_url, ifc_url = _public_urls(request, img_path, ifc_path)
-            cases.append({
-                "id": id_,
-                "caso": caso or "Sem nome",
-                "descricao": descricao or "Sem descrição",
-                "progress_pct": float(f"{float(progress_pct):.2f}"),
-                "img_path": img_url,
-                "ifc_path": ifc_url,
-                "data": formatted_date,
-                "uploaded_at_iso": uploaded_at,
-            })
-        return {"cases": cases}
-    finally:
-        conn.close()
+                item["data"] = uploaded_at
+        if want_urls:
+            item["img_path"], item["ifc_path"] = _public_urls(request, img_path, ifc_path, img_exists, ifc_exists)
+            item.update(_rendition_urls(request, img_sha256, img_renditions))
+        cases.append({f: item[f] for f in fields})
+    return cases
+
+@app.get("/casos")
+def list_casos(
+    request: Request,
+    limit: int = Query(CASOS_PAGE_DEFAULT, ge=1, le=CASOS_PAGE_MAX),
+    cursor: Optional[str] = None,
+    caso: Optional[str] = None,
+    desde: Optional[str] = None,
+    ate: Optional[str] = None,
+    campos: Optional[str] = None,
+    total: bool = False,
+):
+    fields = CASOS_FIELDS
+    if campos:
+        fields = tuple(f.strip() for f in campos.split(",") if f.strip())
+        unknown = [f for f in fields if f not in CASOS_FIELDS]
+        if unknown:
+            raise HTTPException(422, f"Campos desconhecidos: {', '.join(unknown)}")
+
+    version, updated_at = submissions_version()
+    etag, last_modified = _list_validators(request, version, updated_at)
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache",
+    }
+    if _not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+
+    where, args = [], []
+    if caso:
+        where.append("caso = ?"); args.append(caso)
+    if desde:
+        where.append("uploaded_at >= ?"); args.append(_parse_date_param(desde))
+    if ate:
+        where.append("uploaded_at < ?" if len(ate) == 10 else "uploaded_at <= ?")
+        args.append(_parse_date_param(ate, end=True))
+    filters = list(where), list(args)
+    if cursor:
+        where.append("(uploaded_at, id) < (?, ?)"); args.extend(_decode_cursor(cursor))
+    sql_where = f"WHERE {' AND '.join(where)}" if where else ""
+
+    with metrics.timer("db_read"), _db.read() as conn:
+        rows = conn.execute(f"""
+            SELECT id, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at, img_exists, ifc_exists,
+                   img_sha256, img_renditions
+            FROM submissions
+            {sql_where}
+            ORDER BY uploaded_at DESC, id DESC
+            LIMIT ?
+        """, (*args, limit + 1)).fetchall()
+        count = None
+        if total:
+            f_where, f_args = filters
+            count = conn.execute(
+                f"SELECT COUNT(*) FROM submissions {'WHERE ' + ' AND '.join(f_where) if f_where else ''}",
+                f_args).fetchone()[0]
+
+    metrics.inc("pimetro_db_rows_total", len(rows), query="casos")
+    next_cursor = _encode_cursor(rows[limit - 1][6], rows[limit - 1][0]) if len(rows) > limit else None
+    want_urls = any(f in fields for f in ("img_path", "ifc_path", "thumb_url", "preview_url"))
+    with metrics.timer("serialize"):
+        cases = _casos_items(request, rows[:limit], fields, want_urls)
+
+    body = {"cases": cases, "next_cursor": next_cursor}
+    if count is not None:
+        body["total"] = count
+    return JSONResponse(body, headers=headers)
+
+# ========= Dashboard =========
+# Contagens a partir de submission_buckets: dias inteiros, depois horas
+# inteiras do primeiro dia e só a hora de borda direto da tabela (índice)
+DASHBOARD_SERIE_DIAS = 30
+
+def _count_since(conn, since: datetime) -> int:
+    since = since.astimezone(timezone.utc)
+    iso = since.isoformat()
+    hour_start = since.replace(minute=0, second=0, microsecond=0)
+    next_day = (since + timedelta(days=1)).strftime("%Y-%m-%d")
+    days = conn.execute("SELECT COALESCE(SUM(n), 0) FROM submission_buckets WHERE grain='day' AND bucket > ?",
+                        (iso[:10],)).fetchone()[0]
+    hours = conn.execute("""
+        SELECT COALESCE(SUM(n), 0) FROM submission_buckets
+        WHERE grain='hour' AND bucket > ? AND bucket < ?
+    """, (iso[:13], next_day)).fetchone()[0]
+    edge = conn.execute("SELECT COUNT(*) FROM submissions WHERE uploaded_at >= ? AND uploaded_at < ?",
+                        (iso, (hour_start + timedelta(hours=1)).isoformat())).fetchone()[0]
+    return days + hours + edge
+
+@app.get("/dashboard/stats")
+def dashboard_stats(
+    request: Request,
+    mes_inicio: Optional[str] = None,   # início do mês no fuso do navegador (ISO)
+    recentes_horas: int = Query(10, ge=1, le=24 * 7),
+    recentes_limite: int = Query(20, ge=0, le=200),
+    dias: int = Query(DASHBOARD_SERIE_DIAS, ge=1, le=366),
+):
+    now = datetime.now(timezone.utc)
+    month_start = (datetime.fromisoformat(_parse_date_param(mes_inicio)) if mes_inicio
+                   else now.replace(day=1, hour=0, minute=0, second=0, microsecond=0))
+    recent_since = (now - timedelta(hours=recentes_horas)).isoformat()
+    first_day = (now - timedelta(days=dias - 1)).strftime("%Y-%m-%d")
+
+    with metrics.timer("db_read"), _db.read() as conn:
+        por_caso = conn.execute("""
+            SELECT caso, n, progress_sum FROM submission_buckets
+            WHERE grain='all' ORDER BY n DESC, caso
+        """).fetchall()
+        serie = conn.execute("""
+            SELECT bucket, SUM(n), SUM(progress_sum) FROM submission_buckets
+            WHERE grain='day' AND bucket >= ? GROUP BY bucket ORDER BY bucket
+        """, (first_day,)).fetchall()
+        ultimas_24h = _count_since(conn, now - timedelta(hours=24))
+        este_mes = _count_since(conn, month_start)
+        recentes = conn.execute("""
+            SELECT id, caso, descricao, progress_pct, img_path, uploaded_at, img_exists, img_sha256, img_renditions
+            FROM submissions WHERE uploaded_at >= ?
+            ORDER BY uploaded_at DESC, id DESC LIMIT ?
+        """, (recent_since, recentes_limite)).fetchall()
+    metrics.inc("pimetro_db_rows_total", len(por_caso) + len(serie) + len(recentes), query="dashboard")
+
+    return {
+        "total": sum(n for _, n, _ in por_caso),
+        "este_mes": este_mes,
+        "ultimas_24h": ultimas_24h,
+        "por_caso": [{"caso": caso or "Sem nome", "casos": n, "progresso_medio": round(p / n, 2)}
+                     for caso, n, p in por_caso],
+        "serie_diaria": [{"dia": dia, "casos": n, "progresso_medio": round(p / n, 2)}
+                         for dia, n, p in serie],
+        "recentes": [{
+            "id": id_,
+            "caso": caso or "Sem nome",
+            "descricao": descricao or "Sem descrição",
+            "progress_pct": float(f"{float(progress_pct):.2f}"),
+            "img_path": _public_urls(request, img_path, None, img_exists)[0],
+            "thumb_url": _rendition_urls(request, img_sha256, img_renditions)["thumb_url"],
+            "uploaded_at_iso": uploaded_at,
+        } for id_, caso, descricao, progress_pct, img_path, uploaded_at, img_exists, img_sha256, img_renditions in recentes],
+    }
+
+@app.get("/dashboard/zonas")
+async def dashboard_zonas(caso: str):
+    # Progresso por zona de um caso: média e última submissão de cada zona
+    # (idx_submissions_caso_zone), com nome, hierarquia e peso planejado do
+    # índice de zonas do IFC mais recente do caso
+    def load():
+        with _db.read() as conn:
+            # Coluna solta junto com MAX(): o SQLite a lê da linha do máximo
+            rows = conn.execute("""
+                SELECT zone, COUNT(*), AVG(progress_pct), MAX(uploaded_at), progress_pct, id
+                FROM submissions WHERE caso = ? AND zone IS NOT NULL GROUP BY zone
+            """, (caso,)).fetchall()
+            latest = conn.execute("""
+                SELECT ifc_path, COALESCE(ignore_mep, 1), ifc_sha256 FROM submissions
+                WHERE caso = ? ORDER BY uploaded_at DESC, id DESC LIMIT 1
+            """, (caso,)).fetchone()
+        if not latest:
+            return None
+        return rows, zone_index_cached(latest[0], bool(latest[1]), latest[2], parse=False)
+
+    with metrics.timer("db_read"):
+        data = await with_ifc_indexed(load)
+    if data is None:
+        raise HTTPException(404, "Caso não encontrado")
+    rows, index = data
+    metrics.inc("pimetro_db_rows_total", len(rows), query="dashboard_zonas")
+
+    stats = {zone: (n, avg, at, last, id_) for zone, n, avg, at, last, id_ in rows}
+    def item(zone, summary):
+        n, avg, at, last, id_ = stats.pop(zone, (0, None, None, None, None))
+        return {**summary, "submissoes": n,
+                "progresso_medio": None if avg is None else round(avg, 2),
+                "ultimo_progresso": last, "ultimo_id": id_, "ultima_em": at}
+
+    zonas = [item(index.zones[i][0], index.summary(i)) for i in range(len(index))] if index else []
+    # Zonas de versões anteriores do IFC (fora do índice atual)
+    zonas += [item(zone, {"zona": zone, "nome": None, "tipo": None, "pai": None,
+                          "peso_planejado": None, "elementos": None}) for zone in list(stats)]
+    return {"caso": caso, "zonas": zonas}
+
+# ========= Histórico (séries temporais) =========
+# Curvas de progresso por caso a partir do histórico de medições: baldes de
+# dia ou maiores saem de measurement_daily (uma varredura pela chave (caso,
+# dia)); baldes de hora, direto de measurements pelo índice (caso, observed_at).
+# Só a revisão vigente de cada observação conta.
+HISTORY_BUCKETS = ("hora", "dia", "semana", "mes")
+HISTORY_DEFAULT_DAYS = 90
+HISTORY_POINTS_DEFAULT = 120
+HISTORY_POINTS_MAX = 2000
+HISTORY_MAX_CASOS = 50
+HISTORY_MAX_HOURS = 24 * 31
+
+def _history_bucket(span: timedelta, points: int) -> str:
+    # Menor balde que cabe em `points` pontos por caso
+    if span <= timedelta(hours=points):
+        return "hora"
+    if span.days <= points:
+        return "dia"
+    return "semana" if span.days / 7 <= points else "mes"
+
+def _history_bucket_start(bucket: str, key: str) -> str:
+    # key: "AAAA-MM-DDTHH" (hora) ou "AAAA-MM-DD"
+    if bucket == "hora":
+        return f"{key}:00:00+00:00"
+    if bucket == "semana":
+        day = datetime.fromisoformat(key)
+        return (day - timedelta(days=day.weekday())).strftime("%Y-%m-%d")
+    return f"{key[:7]}-01" if bucket == "mes" else key
+
+@app.get("/dashboard/historico")
+async def dashboard_historico(
+    caso: List[str] = Query(...),         # repetível: ?caso=A&caso=B
+    desde: Optional[str] = None,
+    ate: Optional[str] = None,
+    balde: str = "auto",                  # hora, dia, semana, mes ou auto
+    pontos: int = Query(HISTORY_POINTS_DEFAULT, ge=1, le=HISTORY_POINTS_MAX),
+):
+    casos = list(dict.fromkeys(caso))
+    if len(casos) > HISTORY_MAX_CASOS:
+        raise HTTPException(422, f"No máximo {HISTORY_MAX_CASOS} casos por consulta")
+    if balde != "auto" and balde not in HISTORY_BUCKETS:
+        raise HTTPException(422, f"balde deve ser auto ou um de: {', '.join(HISTORY_BUCKETS)}")
+    # `ate` com data pura inclui o dia inteiro (limite exclusivo); com hora, inclusivo
+    end_exclusive = not ate or len(ate) == 10
+    end = (datetime.fromisoformat(_parse_date_param(ate, end=True)) if ate
+           else datetime.now(timezone.utc) + timedelta(microseconds=1))
+    start = (datetime.fromisoformat(_parse_date_param(desde)) if desde
+             else end - timedelta(days=HISTORY_DEFAULT_DAYS))
+    if start >= end:
+        raise HTTPException(422, "desde deve ser anterior a ate")
+    bucket = _history_bucket(end - start, pontos) if balde == "auto" else balde
+    if bucket == "hora" and end - start > timedelta(hours=HISTORY_MAX_HOURS):
+        raise HTTPException(422, f"Baldes de hora cobrem no máximo {HISTORY_MAX_HOURS // 24} dias")
+
+    marks = ",".join("?" * len(casos))
+    def load():
+        with _db.read() as conn:
+            if bucket == "hora":
+                return conn.execute(f"""
+                    SELECT caso, substr(observed_at, 1, 13), 1, progress_pct, progress_pct, progress_pct,
+                           observed_at, progress_pct
+                    FROM measurements m
+                    WHERE caso IN ({marks}) AND observed_at >= ? AND observed_at {'<' if end_exclusive else '<='} ?
+                      AND NOT EXISTS (SELECT 1 FROM measurements r WHERE r.submission_id = m.submission_id
+                                      AND r.observed_at = m.observed_at AND r.id > m.id)
+                    ORDER BY caso, observed_at
+                """, (*casos, start.isoformat(), end.isoformat())).fetchall()
+            last_day = (end - timedelta(microseconds=1) if end_exclusive else end).strftime("%Y-%m-%d")
+            return conn.execute(f"""
+                SELECT caso, day, n, progress_sum, progress_min, progress_max, last_at, last_progress
+                FROM measurement_daily
+                WHERE caso IN ({marks}) AND day >= ? AND day <= ?
+                ORDER BY caso, day
+            """, (*casos, start.strftime("%Y-%m-%d"), last_day)).fetchall()
+
+    with metrics.timer("db_read"):
+        rows = await asyncio.to_thread(load)
+    metrics.inc("pimetro_db_rows_total", len(rows), query="historico")
+
+    with metrics.timer("serialize"):
+        series = {c: {} for c in casos}
+        for caso_, key, n, total, low, high, last_at, last in rows:
+            points = series[caso_]
+            t = _history_bucket_start(bucket, key)
+            p = points.get(t)
+            if p is None:
+                points[t] = [n, total, low, high, last_at, last]
+                continue
+            p[0] += n
+            p[1] += total
+            p[2], p[3] = min(p[2], low), max(p[3], high)
+            if last_at >= p[4]:
+                p[4], p[5] = last_at, last
+    return {
+        "balde": bucket, "desde": start.isoformat(), "ate": end.isoformat(),
+        "series": [{"caso": c or "Sem nome", "pontos": [
+            {"inicio": t, "medicoes": n, "progresso_medio": round(total / n, 2),
+             "progresso_min": low, "progresso_max": high, "ultimo_progresso": last, "ultima_em": last_at}
+            for t, (n, total, low, high, last_at, last) in points.items()]}
+            for c, points in series.items()],
+    }
 
 # ========= Read single =========
 @app.get("/casos/{id}")
-async def get_caso(id: int, request: Request):
+def get_caso(id: int, request: Request):
     row = get_case_row(id)
     if not row:
         raise HTTPException(404, "Caso não encontrado")
-    id_, caso, descricao, progress_pct, img_path, ifc_path, uploaded_at = row
-    img_url, ifc_url = _public_urls(request, img_path, ifc_path)
+    return _case_payload(request, row)
+
+@app.get("/casos/{id}/historico")
+async def get_caso_historico(id: int):
+    # Todas as medições da submissão, da mais antiga à mais recente, com as
+    # razões por categoria; `vigente` marca a revisão que vale em cada observação
+    def load():
+        with _db.read() as conn:
+            rows = conn.execute("""
+                SELECT id, observed_at, recorded_at, caso, zone, progress_pct, ratios, model_version,
+                       mapping_version, source
+                FROM measurements WHERE submission_id = ? ORDER BY id
+            """, (id,)).fetchall()
+            names = dict(conn.execute("SELECT id, name FROM measurement_categories").fetchall()) if rows else {}
+        return rows, names
+
+    rows, names = await asyncio.to_thread(load)
+    if not rows:
+        raise HTTPException(404, "Caso sem histórico")
+    latest = {r[1]: r[0] for r in rows}
+    return {"id": id, "medicoes": [{
+        "observada_em": observed_at, "registrada_em": recorded_at,
+        "caso": caso or "Sem nome", "zona": zone, "progress_pct": progress_pct,
+        "ratios": _decode_ratios(ratios, names),
+        "model_version": model_version, "mapping_version": mapping_version,
+        "origem": source, "vigente": latest[observed_at] == mid,
+    } for mid, observed_at, recorded_at, caso, zone, progress_pct, ratios, model_version, mapping_version, source
+        in rows]}
+
+# ========= Re-score (sem rodar o YOLO) =========
+class RescoreParams(BaseModel):
+    conf_strict: float = SCORING_DEFAULTS["conf_strict"]
+    conf_lenient: float = SCORING_DEFAULTS["conf_lenient"]
+    beta_lenient: float = SCORING_DEFAULTS["beta_lenient"]
+    eps_fallback: float = SCORING_DEFAULTS["eps_fallback"]
+    rail_boost: float = SCORING_DEFAULTS["rail_boost"]
+    zona: Optional[str] = None           # outra zona do IFC ("" = modelo inteiro); padrão: a gravada
+
+def case_weights_and_detections(id_: int, zone: Optional[str] = None, parse: bool = True):
+    # Pesos do IFC (da zona, se houver), detecções guardadas (uma lista por
+    # vista) e combinação; None se faltar algum. zone None = a gravada no caso.
+    # parse=False: IfcNotIndexed se o IFC ainda precisa ser aberto.
+    row = get_case_row(id_)
+    hashes = get_case_hashes(id_)
+    if not row or not hashes:
+        return None
+    img_sha256, ifc_sha256, ignore_mep = hashes
+    if not img_sha256 or not ifc_sha256:
+        return None
+    cached = get_cached_ifc_weights(ifc_sha256, ignore_mep)
+    if cached is None:
+        ifc_path = row[5]
+        if not ifc_path or not os.path.exists(ifc_path):
+            return None
+        if not parse:
+            raise IfcNotIndexed(ifc_path, bool(ignore_mep), ifc_sha256)
+        cached = build_ifc_weights_cached(ifc_path, ignore_mep, ifc_sha256)
+    classes = vocabulary_for(cached[0])
+    zone = get_case_zone(id_) if zone is None else zone
+    weights_by_cat, totals_by_cat, zone = scoped_weights(*cached, row[5], ignore_mep, ifc_sha256, zone, parse)
+    # Caso de várias vistas: as detecções de cada uma e a combinação gravada
+    combine, views = get_case_views(id_)
+    dets_per_view = []
+    for key in [v["img_sha256"] for v in views] or [img_sha256]:
+        stored = get_detections(key, detector_key(YOLO_WEIGHTS), vocabulary_sha(classes), DETECT_IMGSZ)
+        if stored is None:
+            return None
+        dets_per_view.append(stored[0])
+    return weights_by_cat, totals_by_cat, dets_per_view, classes, combine or "max", zone
+
+@app.post("/casos/{id}/rescore")
+async def rescore_caso(id: int, params: Optional[RescoreParams] = None):
+    t0 = time.perf_counter()
+    params = params or RescoreParams()
+    if min(params.conf_strict, params.conf_lenient) < DETECTION_CONF_FLOOR:
+        raise HTTPException(422, f"Limiares abaixo de {DETECTION_CONF_FLOOR} exigem nova detecção")
+    p = params.model_dump(exclude={"zona"})
+
+    # Leituras do SQLite, cache de pesos e pontuação fora do event loop; um IFC
+    # ainda não indexado (ou zona de um IFC antigo) é aberto no pool de análise
+    def rescore():
+        row = get_case_row(id)
+        if not row:
+            raise HTTPException(404, "Caso não encontrado")
+        try:
+            data = case_weights_and_detections(id, params.zona, parse=False)
+        except ValueError as e:
+            raise HTTPException(422, str(e))
+        if data is None:
+            raise HTTPException(409, "Sem detecções armazenadas para este caso")
+        weights_by_cat, totals_by_cat, dets_per_view, classes, combine, zone = data
+        return row, zone, score_views(weights_by_cat, totals_by_cat, dets_per_view, classes, combine, **p)
+
+    row, zone, (progress_pct, ratios, counts_strict, counts_lenient) = await with_ifc_indexed(rescore)
     return {
-        "id": id_,
-        "caso": caso, "descricao": descricao,
+        "id": id,
         "progress_pct": progress_pct,
-        "img_path": img_url, "ifc_path": ifc_url,
-        "uploaded_at_iso": uploaded_at,
+        "stored_progress_pct": row[3],
+        "ratios": ratios,
+        "counts_strict": counts_strict, "counts_lenient": counts_lenient,
+        "params": p,
+        "zona": zone,
+        "elapsed_ms": round(1000 * (time.perf_counter() - t0), 2),
     }
 
+# ========= Recalibração em lote (admin) =========
+class CalibrationRequest(BaseModel):
+    betas: List[float] = [SCORING_DEFAULTS["beta_lenient"]]
+    eps_fallback: List[float] = [SCORING_DEFAULTS["eps_fallback"]]
+    rail_boosts: List[float] = [SCORING_DEFAULTS["rail_boost"]]
+    conf_strict: float = SCORING_DEFAULTS["conf_strict"]
+    conf_lenient: float = SCORING_DEFAULTS["conf_lenient"]
+    referencias: Dict[int, float] = {}     # id da submissão → progresso medido em campo
+    rail_in_progress: bool = False
+    top: int = 10
+    incluir_matriz: bool = False           # matriz casos × combinações (grades pequenas)
+
+@app.get("/admin/lenient")
+async def admin_lenient():
+    # Quantas análises rodaram, compartilharam ou dispensaram a passada lenient
+    def counts():
+        with _db.read() as conn:
+            return conn.execute("""
+                SELECT COALESCE(lenient_pass, 'unknown'), COUNT(*) FROM submissions GROUP BY 1
+            """).fetchall()
+    rows = await asyncio.to_thread(counts)
+    return {"tolerancia": LENIENT_SKIP_TOLERANCE, "submissoes": dict(rows)}
+
+@app.get("/admin/reprocessamento")
+async def admin_reprocessamento():
+    # Submissões com etiqueta de detector/mapeamento antiga e as últimas
+    # execuções de reprocess.py (o reprocessamento roda fora da API)
+    import reprocess
+    return await asyncio.to_thread(reprocess.status)
+
+@app.post("/admin/calibracao")
+async def admin_calibracao(req: CalibrationRequest):
+    import calibration
+    if min(req.conf_strict, req.conf_lenient) < DETECTION_CONF_FLOOR:
+        raise HTTPException(422, f"Limiares abaixo de {DETECTION_CONF_FLOOR} exigem nova detecção")
+    summary, m, progress = await asyncio.to_thread(
+        calibration.calibrate, req.betas, req.eps_fallback, req.rail_boosts, req.referencias,
+        req.conf_strict, req.conf_lenient, req.rail_in_progress, req.top,
+    )
+    if req.incluir_matriz:
+        if progress.size > 1_000_000:
+            raise HTTPException(413, "Matriz grande demais; use calibration.py --saida")
+        summary["ids"] = m.ids.tolist()
+        summary["progress"] = progress.reshape(len(m), -1).round(3).tolist()
+    return summary
+
 # ========= Update =========
 @app.put("/casos/{id}")
-async def update_caso(
-    id: int,
-    request: Request,
-    img: Optional[UploadFile] = File(None),
-    ifc: Optional[UploadFile] = File(None),
-    ignore_mep: Optional[str] = Form("true"), # Capturar para recalculo
-    caso: Optional[str] = Form(None),
-    desc: Optional[str] = Form(None),
-):
-    form = await request.form()
-    ignore_mep_bool = str(ignore_mep or form.get("ignore_mep") or "true").lower() in {"1","true","on","yes"}
-
-    row = get_case_row(id)
+async def update_caso(id: int, request: Request):
+    # multipart: img e/ou ifc (opcionais; recalculam), ignore_mep, caso, desc,
+    # zona ("" volta ao modelo inteiro) e modo
+    row, stored_zone = await asyncio.to_thread(lambda: (get_case_row(id), get_case_zone(id)))
     if not row:
         raise HTTPException(404, "Caso não encontrado")
-    _, old_caso, _, old_prog, old_img, old_ifc, _ = row
-
-    # Pasta do caso
-    use_name = caso if (caso and caso.strip()) else old_caso or "case"
-    case_dir = os.path.join(_DB_DIR, f"case_{slugify(use_name)}")
-    os.makedirs(case_dir, exist_ok=True)
-
-    new_img_path = None
-    new_ifc_path = None
-    
-    # Flag para recalcular
-    recalculate = False
-    
-    # Salva novos arquivos se enviados, replicando a lógica de /teste para temporários e permanentes
-    if img is not None and img.filename:
-        with NamedTemporaryFile(delete=False, suffix=os.path.splitext(img.filename)[1]) as tf:
-            shutil.copyfileobj(img.file, tf)
-            tmp = tf.name
-        final_img = os.path.join(case_dir, f"{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.path.basename(img.filename)}")
-        shutil.move(tmp, final_img)
-        new_img_path = final_img
-        recalculate = True
-    
-    if ifc is not None and ifc.filename:
-        with NamedTemporaryFile(delete=False, suffix=os.path.splitext(ifc.filename)[1]) as tf:
-            shutil.copyfileobj(ifc.file, tf)
-            tmp = tf.name
-        final_ifc = os.path.join(case_dir, os.path.basename(ifc.filename))
-        shutil.move(tmp, final_ifc)
-        new_ifc_path = final_ifc
-        recalculate = True
-
-    # --- Lógica de Recálculo ---
-    updated_progress_pct = None
-    
+
+    # Novos arquivos vão para o blob store (a referência passa para o job)
+    form = await read_upload_form(request, {"img": "img", "ifc": "ifc"},
+                                  max_bytes=form_max_bytes("img", "ifc"))
+    fields = form.fields
+    ignore_mep_bool = str(fields.get("ignore_mep") or "true").lower() in {"1","true","on","yes"}
+    caso, desc = fields.get("caso"), fields.get("desc")
+    img, ifc = form.file("img"), form.file("ifc")
+
+    # Arquivo novo ou zona diferente da gravada recalcula (a troca de zona
+    # repontua com as detecções guardadas)
+    zona = fields.get("zona")
+    zona = None if zona is None else zona.strip()
+    recalculate = img is not None or ifc is not None or (zona is not None and zona != (stored_zone or ""))
+
     if recalculate:
-        # Determina os caminhos a usar (novo arquivo ou o antigo)
-        calc_img_path = new_img_path if new_img_path else old_img
-        calc_ifc_path = new_ifc_path if new_ifc_path else old_ifc
-        
         try:
-            # 1. Pesos IFC
-            weights_by_cat, totals_by_cat = build_ifc_weights(calc_ifc_path, ignore_mep=ignore_mep_bool)
-            
-            if weights_by_cat:
-                # 2. Detecção YOLO
-                counts_strict, counts_lenient, generic_hits = detect_photo_dual(
-                    YOLO_WEIGHTS, calc_img_path, YOLO_CLASSES, conf_strict=0.22, conf_lenient=0.03, imgsz=1920
-                )
-                
-                # 3. Calcular progresso
-                progress_pct, ratios = compute_progress_soft(
-                    weights_by_cat, totals_by_cat, counts_strict, counts_lenient,
-                    beta_lenient=0.70, eps_fallback=0.12, generic_hits=generic_hits
-                )
-                ratios = apply_rail_prior(ratios, counts_strict, counts_lenient, boost=0.08)
-                updated_progress_pct = round(progress_pct, 1)
+            await asyncio.to_thread(check_analysis_capacity)
+        except HTTPException:
+            await asyncio.to_thread(release_upload_blobs, form.paths())
+            raise
+        # Recálculo no pool; a linha só é atualizada quando o job termina
+        return await _dispatch_job(request, "update", {
+            "id": id, "caso": caso, "desc": desc, "ignore_mep": ignore_mep_bool,
+            "new_img_path": img and img["path"], "new_ifc_path": ifc and ifc["path"],
+            "img_sha256": img and img["sha256"], "ifc_sha256": ifc and ifc["sha256"], "zone": zona,
+        }, fields.get("modo"))
 
-            else:
-                updated_progress_pct = 0.0 # Nenhum elemento mapeado no IFC
-                
-        except Exception as e:
-            # Em caso de falha no recálculo, mantém o progresso antigo
-            print(f"Erro durante o recálculo de progresso para o caso {id}: {e}")
-            # updated_progress_pct = None will default to old_prog in update_case_row if not set
-    
-    # Atualiza o banco de dados
-    ok = update_case_row(id, caso, desc, new_img_path, new_ifc_path, updated_progress_pct)
-    if not ok:
-        raise HTTPException(500, "Falha ao atualizar")
-
-    # Retorna a linha atualizada (agora com o novo progress_pct)
-    row2 = get_case_row(id)
-    _, caso2, desc2, prog2, img2, ifc2, up2 = row2
-    img_url, ifc_url = _public_urls(request, img2, ifc2)
-    return {
-        "id": id,
-        "caso": caso2, "descricao": desc2,
-        "progress_pct": prog2,
-        "img_path": img_url, "ifc_path": ifc_url,
-        "uploaded_at_iso": up2,
-    }
+    # Atualiza o banco de dados e retorna a linha atualizada
+    def update():
+        if not update_case_row(id, caso, desc, None, None):
+            raise HTTPException(500, "Falha ao atualizar")
+        return _case_payload(request, get_case_row(id))
+    return await asyncio.to_thread(update)
 
 # ========= Delete =========
 @app.delete("/casos/{id}")
-async def delete_caso(id: int):
+def delete_caso(id: int):
     deleted = delete_case_row(id)
     if deleted is None:
         raise HTTPException(404, "Caso não encontrado")
-    img_path, ifc_path = deleted
-    # opcional: deletar arquivos no disco
-    for p in (img_path, ifc_path):
-        try:
-            if p and os.path.exists(p):
-                os.remove(p)
-        except:
-            pass
+    # Arquivos saem do disco em delete_case_row, quando nenhuma outra linha os usa
     return {"ok": True, "id": id}
 
 # =====================
 # SEÇÃO: SEED DE CASOS DE TESTE
 # =====================
 @app.post("/seed")
-async def seed_cases():
+def seed_cases():
     os.makedirs(os.path.join(_DB_DIR, "seed"), exist_ok=True)
     img_file = os.path.join(_DB_DIR, "seed", "placeholder.png")
     ifc_file = os.path.join(_DB_DIR, "seed", "placeholder.ifc")
@@ -609,22 +3553,18 @@ async def seed_cases():
         with open(ifc_file, "w", encoding="utf-8") as f:
             f.write("ISO-10303-21;\\nEND-ISO-10303-21;")
 
-    def add(caso, desc, progress, dt):
-        conn = sqlite3.connect(DB_PATH)
-        cur = conn.cursor()
-        cur.execute("""
-            INSERT INTO submissions (caso, descricao, progress_pct, img_path, ifc_path, uploaded_at)
-            VALUES (?, ?, ?, ?, ?, ?)
-        """, (caso, desc, progress, img_file, ifc_file, dt.isoformat()))
-        conn.commit()
-        conn.close()
-
     now = datetime.now(timezone.utc)
-    add("Túnel Leste", "Foto inspeção matinal", 32.4, now - timedelta(hours=2))
-    add("Pátio AMV", "Instalação de trilhos",   57.8, now - timedelta(hours=5))
-    add("Estação Y",  "Laje de plataforma",     12.0, now - timedelta(hours=9))
-    add("Galeria X",  "Revestimento segmentos", 44.0, now - timedelta(hours=18))
-    add("Poço Z",     "Concretagem bloco",      21.6, now - timedelta(days=5))
-    add("Sala Técnica","Bandeja de cabos",      66.0, now - timedelta(days=35))
+    seeds = [
+        ("Túnel Leste", "Foto inspeção matinal", 32.4, now - timedelta(hours=2)),
+        ("Pátio AMV", "Instalação de trilhos",   57.8, now - timedelta(hours=5)),
+        ("Estação Y",  "Laje de plataforma",     12.0, now - timedelta(hours=9)),
+        ("Galeria X",  "Revestimento segmentos", 44.0, now - timedelta(hours=18)),
+        ("Poço Z",     "Concretagem bloco",      21.6, now - timedelta(days=5)),
+        ("Sala Técnica","Bandeja de cabos",      66.0, now - timedelta(days=35)),
+    ]
+    save_submissions([(caso, desc, progress, img_file, ifc_file, dt.isoformat())
+                      for caso, desc, progress, dt in seeds])
 
     return {"ok": True}
+
+_STARTUP["import_s"] = round(time.perf_counter() - _IMPORT_T0, 3)
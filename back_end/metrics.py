@@ -0,0 +1,252 @@
+# Métricas no formato de texto do Prometheus, sem dependências.
+#
+# Cada processo (workers do uvicorn, pool de análise, servidor de inferência)
+# acumula contadores e histogramas em memória e grava um retrato em
+# <dir>/<pid>.json a cada FLUSH_SECONDS; o /metrics de qualquer worker soma
+# os retratos de todos. Etapas cronometradas com `timer` entram no histograma
+# pimetro_stage_seconds e, dentro de uma requisição (ou job), na lista que
+# vira o cabeçalho Server-Timing.
+#
+#   metrics.configure("db/metrics")
+#   metrics.inc("pimetro_cache_total", cache="ifc_weights", result="hit")
+#   with metrics.timer("ifc_open"): ...
+#   metrics.render()   # texto para GET /metrics
+import bisect
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Segundos: de leituras do SQLite (ms) a análises de vídeo (minutos)
+BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0, 300.0)
+FLUSH_SECONDS = float(os.getenv("METRICS_FLUSH_SECONDS", "2"))
+
+_LOCK = threading.Lock()
+_COUNTERS = {}     # (nome, labels) → valor
+_HISTOGRAMS = {}   # (nome, labels) → [contagem por bucket..., +Inf, soma]
+_HELP = {}         # nome → (tipo, descrição)
+_STATE = {"dir": None, "pid": None, "dirty": False}
+_TIMINGS = contextvars.ContextVar("pimetro_timings", default=None)
+
+
+def describe(name, kind, help_text):
+    _HELP[name] = (kind, help_text)
+
+
+def _key(name, labels):
+    return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def inc(name, value=1.0, **labels):
+    key = _key(name, labels)
+    with _LOCK:
+        _COUNTERS[key] = _COUNTERS.get(key, 0.0) + value
+        _STATE["dirty"] = True
+
+
+def observe(name, value, **labels):
+    key = _key(name, labels)
+    i = bisect.bisect_left(BUCKETS, value)
+    with _LOCK:
+        h = _HISTOGRAMS.get(key)
+        if h is None:
+            h = _HISTOGRAMS[key] = [0] * (len(BUCKETS) + 1) + [0.0]
+        h[i] += 1
+        h[-1] += value
+        _STATE["dirty"] = True
+
+
+# ========= Etapas e Server-Timing =========
+def start_timings():
+    # Nova lista de etapas para o contexto atual (requisição ou job)
+    timings = []
+    return _TIMINGS.set(timings), timings
+
+
+def stop_timings(token):
+    _TIMINGS.reset(token)
+
+
+def add_timings(items):
+    # Etapas medidas em outro processo (job no pool) entram na requisição que esperou por ele
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings.extend((str(stage), float(dt)) for stage, dt in items)
+
+
+def record_stage(stage, seconds, **labels):
+    observe("pimetro_stage_seconds", seconds, stage=stage, **labels)
+    timings = _TIMINGS.get()
+    if timings is not None:
+        timings.append((stage, seconds))
+
+
+@contextmanager
+def timer(stage, **labels):
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        record_stage(stage, time.perf_counter() - t0, **labels)
+
+
+def server_timing(timings):
+    # Etapas repetidas (vários lotes, várias vistas) somam numa entrada só
+    total = {}
+    for stage, dt in timings:
+        total[stage] = total.get(stage, 0.0) + dt
+    return ", ".join(f"{stage};dur={1000 * dt:.1f}" for stage, dt in total.items())
+
+
+# ========= Retratos por processo =========
+def configure(directory):
+    _STATE["dir"] = directory
+    os.makedirs(directory, exist_ok=True)
+    _ensure_flusher()
+
+
+def _after_fork():
+    # Filho de fork (gunicorn com preload) herda os números do pai, que
+    # continuam no retrato do pai: recomeça do zero, com a própria thread.
+    # O lock é novo: a thread do pai podia estar com ele no momento do fork
+    global _LOCK
+    _LOCK = threading.Lock()
+    _COUNTERS.clear()
+    _HISTOGRAMS.clear()
+    _STATE["dirty"] = False
+    _ensure_flusher()
+
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_after_fork)
+
+
+def _ensure_flusher():
+    # Uma thread por processo (spawn/fork começam sem ela)
+    with _LOCK:
+        if _STATE["dir"] is None or _STATE["pid"] == os.getpid():
+            return
+        _STATE["pid"] = os.getpid()
+    threading.Thread(target=_flush_loop, name="metrics-flush", daemon=True).start()
+
+
+def _flush_loop():
+    while True:
+        time.sleep(FLUSH_SECONDS)
+        flush()
+
+
+def _snapshot():
+    with _LOCK:
+        return {"counters": [[n, l, v] for (n, l), v in _COUNTERS.items()],
+                "histograms": [[n, l, list(h)] for (n, l), h in _HISTOGRAMS.items()]}
+
+
+def flush():
+    if _STATE["dir"] is None or not _STATE["dirty"]:
+        return
+    _STATE["dirty"] = False
+    path = os.path.join(_STATE["dir"], f"{os.getpid()}.json")
+    try:
+        with open(path + ".part", "w", encoding="utf-8") as f:
+            json.dump(_snapshot(), f)
+        os.replace(path + ".part", path)
+    except OSError as e:
+        _STATE["dirty"] = True
+        logging.getLogger("pimetro.metrics").warning("Falha ao gravar métricas em %s: %s", path, e)
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def prune():
+    # Retratos de processos que já saíram (início do servidor): os contadores recomeçam
+    directory = _STATE["dir"]
+    if directory is None:
+        return
+    for name in os.listdir(directory):
+        stem = name.split(".")[0]
+        if stem.isdigit() and int(stem) != os.getpid() and not _pid_alive(int(stem)):
+            try:
+                os.remove(os.path.join(directory, name))
+            except OSError:
+                pass
+
+
+def _collect():
+    # Este processo direto da memória, os demais pelos retratos
+    snapshots = [_snapshot()]
+    directory = _STATE["dir"]
+    if directory is not None:
+        for name in os.listdir(directory):
+            if not name.endswith(".json") or name == f"{os.getpid()}.json":
+                continue
+            try:
+                with open(os.path.join(directory, name), encoding="utf-8") as f:
+                    snapshots.append(json.load(f))
+            except (OSError, ValueError):
+                continue
+    counters, histograms = {}, {}
+    for snap in snapshots:
+        for n, l, v in snap["counters"]:
+            key = (n, tuple(map(tuple, l)))
+            counters[key] = counters.get(key, 0.0) + v
+        for n, l, h in snap["histograms"]:
+            key = (n, tuple(map(tuple, l)))
+            acc = histograms.get(key)
+            histograms[key] = list(h) if acc is None else [a + b for a, b in zip(acc, h)]
+    return counters, histograms
+
+
+def _escape(value):
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(labels, extra=()):
+    items = [*labels, *extra]
+    if not items:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in items) + "}"
+
+
+def _num(v):
+    return repr(float(v)) if isinstance(v, float) and not float(v).is_integer() else str(int(v))
+
+
+def render(extra_gauges=()):
+    # extra_gauges: [(nome, descrição, [(labels dict, valor)])] lidos na hora (ex.: do SQLite)
+    counters, histograms = _collect()
+    lines = []
+    by_name = {}
+    for (n, l), v in counters.items():
+        by_name.setdefault(n, []).append((l, v))
+    for n in sorted(by_name):
+        kind, text = _HELP.get(n, ("counter", n))
+        lines += [f"# HELP {n} {text}", f"# TYPE {n} {kind}"]
+        lines += [f"{n}{_labels(l)} {_num(v)}" for l, v in sorted(by_name[n])]
+    by_name = {}
+    for (n, l), h in histograms.items():
+        by_name.setdefault(n, []).append((l, h))
+    for n in sorted(by_name):
+        lines += [f"# HELP {n} {_HELP.get(n, ('histogram', n))[1]}", f"# TYPE {n} histogram"]
+        for l, h in sorted(by_name[n]):
+            cum = 0
+            for le, k in zip([*(f"{b:g}" for b in BUCKETS), "+Inf"], h[:-1]):
+                cum += k
+                lines.append(f"{n}_bucket{_labels(l, [('le', le)])} {cum}")
+            lines.append(f"{n}_sum{_labels(l)} {h[-1]!r}")
+            lines.append(f"{n}_count{_labels(l)} {cum}")
+    for n, text, samples in extra_gauges:
+        lines += [f"# HELP {n} {text}", f"# TYPE {n} gauge"]
+        lines += [f"{n}{_labels(sorted((k, str(v)) for k, v in l.items()))} {_num(v)}" for l, v in samples]
+    return "\n".join(lines) + "\n"
@@ -0,0 +1,351 @@
+# Reprocessamento do acervo quando os pesos (YOLOWORLD_WEIGHTS, backend,
+# fatiamento) ou o mapeamento (CATEGORY_ALIASES, IFC_TO_CAT) mudam: toda
+# submissão cuja etiqueta (model_version, mapping_version) difere da atual é
+# reanalisada com a foto (ou as vistas) e o IFC guardados.
+#
+#   python reprocess.py --workers 4 [--lote 100] [--caso "Túnel Leste"] [--limite 1000]
+#   python reprocess.py --status
+#   python reprocess.py --indexar [--workers 2]
+#
+# As submissões pendentes são agrupadas por IFC (hash + ignore_mep) e cada
+# lote abre o modelo uma vez. Os lotes vão para um pool de processos e o
+# resultado de cada um é gravado numa única transação (executemany), junto
+# com os contadores da execução em reprocess_runs. A etiqueta gravada é o
+# checkpoint: interrompido (Ctrl-C, queda), o comando retoma a execução
+# pendente e só pega o que ainda está desatualizado.
+#
+# Os workers respeitam os limites do nó (IFC_PARSE_CONCURRENCY,
+# DETECT_CONCURRENCY), compartilhados com a API: para uma passada noturna
+# com vários workers, suba DETECT_CONCURRENCY junto.
+#
+# --indexar só abre os IFCs de submissões com zona que ainda não têm índice
+# de zonas gravado (a API e a recalibração nunca fazem esse parse).
+import argparse
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from datetime import datetime, timezone
+
+import main
+
+BATCH_SIZE = 100   # submissões por lote (mesmo IFC)
+
+
+def _now():
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ========= Seleção =========
+def pending_rows(conn, model_version, mapping_version, run_id=None, caso=None, limit=None):
+    # Desatualizadas, ordenadas por IFC; as que já falharam nesta execução ficam de fora
+    sql = """
+        SELECT id, img_path, ifc_path, img_sha256, ifc_sha256, COALESCE(ignore_mep, 1), views_combine, zone
+        FROM submissions s
+        WHERE (model_version IS NOT ? OR mapping_version IS NOT ?)
+          AND NOT EXISTS (SELECT 1 FROM reprocess_failures f WHERE f.run_id = ? AND f.submission_id = s.id)
+    """
+    args = [model_version, mapping_version, run_id]
+    if caso is not None:
+        sql += " AND caso = ?"
+        args.append(caso)
+    sql += " ORDER BY COALESCE(ifc_sha256, ifc_path), 6, id"
+    if limit:
+        sql += " LIMIT ?"
+        args.append(limit)
+    return conn.execute(sql, args).fetchall()
+
+
+def batches(rows, size=BATCH_SIZE):
+    # Lotes de até `size` submissões que compartilham o IFC
+    batch, key = [], None
+    for row in rows:
+        row_key = (row[4] or row[2], row[5])
+        if batch and (row_key != key or len(batch) >= size):
+            yield batch
+            batch = []
+        key = row_key
+        batch.append(row)
+    if batch:
+        yield batch
+
+
+# ========= Worker =========
+def process_batch(rows):
+    # Roda no pool: [(id, img_path, ifc_path, "ok", resultado) | (id, ..., "error", mensagem)]
+    _, _, ifc_path, _, ifc_sha256, ignore_mep, _, _ = rows[0]
+    ignore_mep = bool(ignore_mep)
+    out = []
+    try:
+        if not ifc_path or not os.path.exists(ifc_path):
+            raise FileNotFoundError(f"IFC ausente: {ifc_path}")
+        ifc_sha256 = ifc_sha256 or main.file_sha256(ifc_path)
+        ifc_weights = main.build_ifc_weights_cached(ifc_path, ignore_mep, ifc_sha256)
+    except Exception as e:
+        return [(r[0], r[1], r[2], "error", str(e) or type(e).__name__) for r in rows]
+
+    for id_, img_path, _, img_sha256, _, _, combine, zone in rows:
+        try:
+            if combine is not None:
+                _, views = main.get_case_views(id_)
+                result = main.run_views_analysis(main.media_of_views(views), ifc_path, ignore_mep,
+                                                 ifc_sha256=ifc_sha256, combine=combine, ifc_weights=ifc_weights,
+                                                 zone=zone)
+            else:
+                if not img_path or not os.path.exists(img_path):
+                    raise FileNotFoundError(f"Foto ausente: {img_path}")
+                img_sha256 = img_sha256 or main.file_sha256(img_path)
+                result = main.run_analysis(img_path, ifc_path, ignore_mep, ifc_sha256=ifc_sha256,
+                                           img_sha256=img_sha256, ifc_weights=ifc_weights, zone=zone)
+            out.append((id_, img_path, ifc_path, "ok", {
+                "progress_pct": result["progress_pct"], "lenient_pass": result.get("lenient_pass"),
+                "img_sha256": img_sha256, "ifc_sha256": ifc_sha256,
+                "img_renditions": main.has_renditions(img_sha256),
+                "views": result.get("views") if combine is not None else None,
+                "model_version": result["model_version"], "mapping_version": result["mapping_version"],
+                "ratios": result.get("ratios"),
+            }))
+        except Exception as e:
+            out.append((id_, img_path, ifc_path, "error", str(e) or type(e).__name__))
+    return out
+
+
+# ========= Gravação =========
+def write_batch(run_id, outcomes):
+    # Uma transação por lote: submissões, vistas, histórico, falhas e contadores
+    # da execução. Caso alterado enquanto o lote rodava (outra foto/IFC) não é
+    # sobrescrito. Cada reanálise é uma revisão da mesma observação no histórico.
+    ok = [(o[0], o[1], o[2], o[4]) for o in outcomes if o[3] == "ok"]
+    failed = [(run_id, o[0], o[4]) for o in outcomes if o[3] == "error"]
+    with main._db.transaction() as conn:
+        cur = conn.executemany("""
+            UPDATE submissions SET
+                progress_pct=?, lenient_pass=COALESCE(?, lenient_pass), img_renditions=?,
+                img_sha256=COALESCE(img_sha256, ?), ifc_sha256=COALESCE(ifc_sha256, ?),
+                model_version=?, mapping_version=?
+            WHERE id=? AND img_path IS ? AND ifc_path IS ?
+        """, [(r["progress_pct"], r["lenient_pass"], int(r["img_renditions"]), r["img_sha256"],
+               r["ifc_sha256"], r["model_version"], r["mapping_version"], id_, img, ifc)
+              for id_, img, ifc, r in ok])
+        updated = cur.rowcount if ok else 0
+        conn.executemany(main._measurement_insert_sql("s.id = ? AND s.img_path IS ? AND s.ifc_path IS ?"),
+                         [(None, main._encode_ratios(conn, r["ratios"]), "reprocess", id_, img, ifc)
+                          for id_, img, ifc, r in ok])
+        for id_, img, ifc, r in ok:
+            if r["views"]:
+                still = conn.execute("SELECT 1 FROM submissions WHERE id=? AND img_path IS ? AND ifc_path IS ?",
+                                     (id_, img, ifc)).fetchone()
+                if still:
+                    main._drop_views(conn, id_, keep={img, ifc, *(v["media_path"] for v in r["views"])})
+                    main._insert_views(conn, id_, r["views"])
+        conn.executemany("INSERT OR REPLACE INTO reprocess_failures (run_id, submission_id, error) VALUES (?, ?, ?)",
+                         failed)
+        conn.execute("""
+            UPDATE reprocess_runs SET done=done+?, failed=failed+?, skipped=skipped+?, updated_at=? WHERE id=?
+        """, (updated, len(failed), len(ok) - updated, _now(), run_id))
+    return updated, len(failed), len(ok) - updated
+
+
+# ========= Índice de zonas =========
+def unindexed_ifcs(conn):
+    # (ifc_path, ignore_mep, ifc_sha256) por IFC de submissão com zona sem ifc_zone_index atual
+    return conn.execute("""
+        SELECT MAX(s.ifc_path), COALESCE(s.ignore_mep, 1), s.ifc_sha256
+        FROM submissions s
+        WHERE s.zone IS NOT NULL AND s.ifc_sha256 IS NOT NULL AND NOT EXISTS (
+            SELECT 1 FROM ifc_zone_index z WHERE z.ifc_sha256 = s.ifc_sha256
+            AND z.ignore_mep = COALESCE(s.ignore_mep, 1) AND z.mapping_version = ?)
+        GROUP BY 3, 2
+    """, (main.MAPPING_VERSION,)).fetchall()
+
+
+def index_zones(workers=1, log=print):
+    with main._db.read() as conn:
+        todo = unindexed_ifcs(conn)
+    missing = [r for r in todo if not r[0] or not os.path.exists(r[0])]
+    todo = [(path, bool(ignore_mep), sha) for path, ignore_mep, sha in todo if path and os.path.exists(path)]
+    log(f"Índice de zonas: {len(todo)} IFCs a abrir, {len(missing)} fora do disco")
+    failed = []
+
+    def done(args, exc):
+        if exc is not None:
+            failed.append(args[0])
+            log(f"  falha em {args[0]}: {exc}")
+
+    if workers <= 0:
+        for args in todo:
+            try:
+                main._ingest_ifc_task(*args)
+                done(args, None)
+            except Exception as e:
+                done(args, e)
+    else:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn")) as pool:
+            futures = {pool.submit(main._ingest_ifc_task, *args): args for args in todo}
+            for fut in futures:
+                done(futures[fut], fut.exception())
+    return {"ifcs": len(todo), "indexed": len(todo) - len(failed), "failed": len(failed),
+            "missing": len(missing)}
+
+
+# ========= Execuções =========
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        return True
+    return True
+
+
+def start_run(model_version, mapping_version, workers):
+    # Retoma a execução pendente das mesmas versões; outra ainda viva → erro
+    with main._db.transaction() as conn:
+        rows = conn.execute("""
+            SELECT id, status, pid, model_version, mapping_version FROM reprocess_runs
+            WHERE status IN ('running', 'interrupted', 'paused') ORDER BY created_at DESC
+        """).fetchall()
+        for id_, run_status, pid, _, _ in rows:
+            # "running" com o processo morto: caiu sem marcar; retoma como interrompida
+            if run_status == "running" and pid and pid != os.getpid() and _pid_alive(pid):
+                raise RuntimeError(f"Reprocessamento {id_} já em andamento (pid {pid})")
+        resumed = next((r[0] for r in rows if (r[3], r[4]) == (model_version, mapping_version)), None)
+        # Execuções de versões antigas não têm mais o que retomar
+        conn.execute("""
+            UPDATE reprocess_runs SET status='superseded', updated_at=?
+            WHERE status IN ('running', 'interrupted', 'paused') AND id IS NOT ?
+        """, (_now(), resumed))
+        if resumed:
+            conn.execute("UPDATE reprocess_runs SET status='running', pid=?, workers=?, error=NULL, updated_at=? "
+                         "WHERE id=?", (os.getpid(), workers, _now(), resumed))
+            return resumed, True
+        run_id = uuid.uuid4().hex
+        conn.execute("""
+            INSERT INTO reprocess_runs (id, status, model_version, mapping_version, total, workers, pid,
+                                        created_at, updated_at)
+            VALUES (?, 'running', ?, ?, 0, ?, ?, ?, ?)
+        """, (run_id, model_version, mapping_version, workers, os.getpid(), _now(), _now()))
+        return run_id, False
+
+
+def finish_run(run_id, state, error=None):
+    with main._db.transaction() as conn:
+        conn.execute("UPDATE reprocess_runs SET status=?, error=?, updated_at=? WHERE id=?",
+                     (state, error, _now(), run_id))
+
+
+def status(limit=10):
+    model_version, mapping_version = main.analysis_versions()
+    with main._db.read() as conn:
+        pending = conn.execute("""
+            SELECT COUNT(*) FROM submissions WHERE model_version IS NOT ? OR mapping_version IS NOT ?
+        """, (model_version, mapping_version)).fetchone()[0]
+        cols = ("id", "status", "model_version", "mapping_version", "total", "done", "failed", "skipped",
+                "workers", "error", "created_at", "updated_at")
+        runs = [dict(zip(cols, r)) for r in conn.execute(f"""
+            SELECT {', '.join(cols)} FROM reprocess_runs ORDER BY created_at DESC LIMIT ?
+        """, (limit,))]
+    return {"model_version": model_version, "mapping_version": mapping_version,
+            "pendentes": pending, "execucoes": runs}
+
+
+def reprocess(workers=1, batch_size=BATCH_SIZE, caso=None, limit=None, log=print):
+    model_version, mapping_version = main.analysis_versions()
+    run_id, resumed = start_run(model_version, mapping_version, workers)
+    with main._db.read() as conn:
+        rows = pending_rows(conn, model_version, mapping_version, run_id, caso, limit)
+    todo = list(batches(rows, batch_size))
+    with main._db.transaction() as conn:
+        # Total da execução = já feito + o que falta agora
+        conn.execute("UPDATE reprocess_runs SET total=done+skipped+failed+? WHERE id=?", (len(rows), run_id))
+    log(f"Reprocessamento {run_id} ({'retomado' if resumed else 'novo'}): {len(rows)} submissões em "
+        f"{len(todo)} lotes, {len({(b[0][4] or b[0][2], b[0][5]) for b in todo})} IFCs, "
+        f"detector {model_version}, mapeamento {mapping_version}")
+
+    t0 = time.perf_counter()
+    totals = [0, 0, 0]
+    seen = 0
+
+    def record(outcomes):
+        nonlocal seen
+        for i, n in enumerate(write_batch(run_id, outcomes)):
+            totals[i] += n
+        seen += len(outcomes)
+        rate = seen / max(time.perf_counter() - t0, 1e-9)
+        eta = (len(rows) - seen) / rate if rate else 0
+        log(f"  {seen}/{len(rows)} — {totals[0]} atualizadas, {totals[1]} falhas, {totals[2]} alteradas no meio; "
+            f"{rate:.2f}/s, faltam ~{eta / 60:.0f} min")
+
+    try:
+        if workers <= 0:
+            for batch in todo:
+                record(process_batch(batch))
+        else:
+            # spawn: cada worker importa o main e aquece o próprio modelo (ou usa INFERENCE_SOCKET)
+            with ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"),
+                                     initializer=main.warmup_models) as pool:
+                pending, queue = set(), iter(todo)
+                # Poucos lotes em voo: memória limitada e checkpoint a cada lote concluído
+                for batch in queue:
+                    pending.add(pool.submit(process_batch, batch))
+                    if len(pending) >= 2 * workers:
+                        break
+                while pending:
+                    finished, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for fut in finished:
+                        record(fut.result())
+                        nxt = next(queue, None)
+                        if nxt is not None:
+                            pending.add(pool.submit(process_batch, nxt))
+    except KeyboardInterrupt:
+        finish_run(run_id, "interrupted", "interrompido")
+        log(f"Interrompido; rode de novo para retomar {run_id}")
+        raise
+    except Exception as e:
+        finish_run(run_id, "interrupted", str(e) or type(e).__name__)
+        raise
+    # Passada limitada (--limite): a próxima continua a mesma execução
+    finish_run(run_id, "paused" if limit and len(rows) >= limit else "done")
+    return {"run_id": run_id, "resumed": resumed, "submissions": len(rows), "batches": len(todo),
+            "updated": totals[0], "failed": totals[1], "skipped": totals[2],
+            "elapsed_s": round(time.perf_counter() - t0, 2)}
+
+
+def main_cli(argv=None):
+    ap = argparse.ArgumentParser(description="Reprocessa as submissões analisadas com outro detector ou mapeamento")
+    ap.add_argument("--workers", type=int, default=max(1, (os.cpu_count() or 2) // 2),
+                    help="processos de análise (0 = neste processo)")
+    ap.add_argument("--lote", type=int, default=BATCH_SIZE, help="submissões por lote (mesmo IFC)")
+    ap.add_argument("--caso", help="só as submissões deste caso")
+    ap.add_argument("--limite", type=int, help="no máximo N submissões nesta passada")
+    ap.add_argument("--status", action="store_true", help="mostra pendentes e execuções e sai")
+    ap.add_argument("--indexar", action="store_true",
+                    help="só grava o índice de zonas dos IFCs de casos com zona que ainda não o têm")
+    args = ap.parse_args(argv)
+
+    if args.status:
+        print(json.dumps(status(), indent=2, ensure_ascii=False))
+        return 0
+    if args.indexar:
+        summary = index_zones(args.workers, log=lambda msg: print(msg, flush=True))
+        print(json.dumps(summary, indent=2, ensure_ascii=False))
+        return 1 if summary["failed"] else 0
+    try:
+        summary = reprocess(args.workers, max(1, args.lote), args.caso, args.limite,
+                            log=lambda msg: print(msg, flush=True))
+    except KeyboardInterrupt:
+        return 130
+    except RuntimeError as e:
+        # Outra execução viva, ou o pool quebrou (worker morto): rodar de novo retoma
+        print(str(e) or type(e).__name__, file=sys.stderr)
+        return 1
+    print(json.dumps(summary, indent=2, ensure_ascii=False))
+    return 1 if summary["failed"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
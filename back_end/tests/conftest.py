@@ -0,0 +1,59 @@
+# main com banco e blobs num PIMETRO_DATA_DIR descartável, detector stub e
+# análises numa thread do próprio processo. Rodar a partir de back_end/:
+#
+#   python -m pytest -q tests
+import os
+import sys
+import tempfile
+import time
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ["PIMETRO_DATA_DIR"] = tempfile.mkdtemp(prefix="pimetro-tests-")
+os.environ["DETECTOR_BACKEND"] = "stub"
+os.environ["ANALYSIS_WORKERS"] = "0"
+os.environ["MODEL_WARMUP"] = "lazy"
+
+from bench.synth import load_main, make_ifc, make_photo  # noqa: E402
+
+
+@pytest.fixture(scope="session")
+def main():
+    return load_main()
+
+
+@pytest.fixture(scope="session")
+def client(main):
+    from fastapi.testclient import TestClient
+    with TestClient(main.app) as c:
+        yield c
+
+
+@pytest.fixture(scope="session")
+def files(tmp_path_factory):
+    # Um IFC com andares e três fotos diferentes, reaproveitados pelos testes
+    work = tmp_path_factory.mktemp("synth")
+    ifc = str(work / "modelo.ifc")
+    make_ifc(ifc, elements=400, qto=0.5, seed=1)
+    photos = []
+    for seed in range(3):
+        photos.append(str(work / f"foto{seed}.jpg"))
+        make_photo(photos[-1], width=640, height=480, seed=seed)
+    return {"ifc": ifc, "photos": photos}
+
+
+def create_case(client, ifc, photo, caso, **form):
+    # POST /teste em modo job; devolve o id da submissão criada
+    with open(photo, "rb") as img, open(ifc, "rb") as model:
+        r = client.post("/teste", files={"img": img, "ifc": model},
+                        data={"caso": caso, "modo": "job", **form})
+    assert r.status_code == 202, r.text
+    job_id = r.json()["job_id"]
+    for _ in range(600):
+        job = client.get(f"/jobs/{job_id}").json()
+        if job["status"] not in ("queued", "running"):
+            break
+        time.sleep(0.05)
+    assert job["status"] == "done", job
+    return job["submission_id"]
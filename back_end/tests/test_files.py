@@ -0,0 +1,17 @@
+from urllib.parse import urlsplit
+
+from conftest import create_case
+
+
+def test_files_serves_case_media_only(main, client, files):
+    id_ = create_case(client, files["ifc"], files["photos"][2], "arquivos")
+    case = client.get(f"/casos/{id_}").json()
+    for url in (case["img_path"], case["ifc_path"], case["thumb_url"]):
+        r = client.get(urlsplit(url).path)
+        assert r.status_code == 200, url
+        assert "immutable" in r.headers["cache-control"]
+
+    # Banco (com WAL), métricas e perfis moram em PIMETRO_DATA_DIR, fora do que é servido
+    for path in ("/files/database.db", "/files/database.db-wal", "/files/blobs/../database.db",
+                 "/files/metrics", "/files/blobs"):
+        assert client.get(path).status_code == 404, path
@@ -0,0 +1,39 @@
+import json
+import os
+import subprocess
+import sys
+import time
+
+BACK_END = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CLIENT = """
+import json, sys
+import main
+result = main.run_analysis(sys.argv[1], sys.argv[2])
+print(json.dumps({"progress_pct": result["progress_pct"],
+                  "heavy": sorted(m for m in ("torch", "ultralytics") if m in sys.modules)}))
+"""
+
+
+def test_client_mode_detection_does_not_import_torch(files, tmp_path):
+    # Com INFERENCE_SOCKET o worker só fala com o servidor: nem ultralytics nem torch
+    sock = str(tmp_path / "infer.sock")
+    env = {**os.environ, "PIMETRO_DATA_DIR": str(tmp_path / "dados"), "DETECTOR_BACKEND": "stub",
+           "INFERENCE_SOCKET": sock}
+    server = subprocess.Popen([sys.executable, "inference_server.py"], cwd=BACK_END, env=env,
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        for _ in range(600):
+            if os.path.exists(sock) or server.poll() is not None:
+                break
+            time.sleep(0.05)
+        assert os.path.exists(sock), "servidor de inferência não subiu"
+        out = subprocess.run([sys.executable, "-c", CLIENT, files["photos"][0], files["ifc"]],
+                             cwd=BACK_END, env=env, capture_output=True, text=True, timeout=300)
+        assert out.returncode == 0, out.stderr
+        client = json.loads(out.stdout.strip().splitlines()[-1])
+    finally:
+        server.terminate()
+        server.wait(timeout=30)
+    assert client["heavy"] == []
+    assert 0 <= client["progress_pct"] <= 100
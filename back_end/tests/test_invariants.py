@@ -0,0 +1,242 @@
+# Equivalências e invariantes da série de otimizações: cada caminho rápido
+# contra a implementação que ele substituiu, nos mesmos dados sintéticos
+# (bench.synth) e com o detector stub.
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from bench.ifc_weights import bench_file
+from bench.synth import make_ifc, make_photo
+from conftest import create_case
+
+
+# ========= Pesos do IFC (passada única x by_type) =========
+@pytest.mark.parametrize("schema", ["IFC2X3", "IFC4", "IFC4X3"])
+@pytest.mark.parametrize("qto", [0.0, 0.5, 1.0])
+def test_single_pass_weights_match_by_type(main, tmp_path, schema, qto):
+    path = str(tmp_path / "pesos.ifc")
+    make_ifc(path, elements=300, qto=qto, seed=7, schema=schema)
+    for ignore_mep in (True, False):
+        result = bench_file(path, repeat=1, ignore_mep=ignore_mep)
+        assert result["identical"], (schema, qto, ignore_mep)
+        assert result["elements"] > 0
+
+
+# ========= Recalibração em lote (score_grid x compute_progress_soft) =========
+BETAS = (0.0, 0.35, 0.7, 1.0)
+EPS = (0.0, 0.12, 0.3)
+
+
+def test_score_grid_matches_compute_progress_soft(main, client, files, tmp_path):
+    import calibration
+
+    ids = []
+    for seed, zona in ((20, None), (21, "Nivel 2")):
+        photo = str(tmp_path / f"{seed}.jpg")
+        make_photo(photo, width=640, height=480, seed=seed)
+        ids.append(create_case(client, files["ifc"], photo, f"calibracao-{seed}", **({"zona": zona} if zona else {})))
+
+    m = calibration.load_cases(ids=ids)
+    assert sorted(m.ids.tolist()) == sorted(ids)
+    grid = calibration.score_grid(m, BETAS, EPS)
+    for row, id_ in enumerate(m.ids.tolist()):
+        weights, totals, (dets,), classes, _, zone = main.case_weights_and_detections(id_)
+        counts_strict, counts_lenient, generic_hits = main.counts_from_detections(dets, classes)
+        for b, beta in enumerate(BETAS):
+            for e, eps in enumerate(EPS):
+                expected, _ = main.compute_progress_soft(weights, totals, counts_strict, counts_lenient,
+                                                         beta_lenient=beta, eps_fallback=eps,
+                                                         generic_hits=generic_hits)
+                assert grid[row, b, e, 0] == pytest.approx(expected, abs=1e-3), (id_, zone, beta, eps)
+        # Nos parâmetros padrão, o mesmo progresso gravado pela análise
+        stored = client.get(f"/casos/{id_}").json()["progress_pct"]
+        default = grid[row, BETAS.index(0.7), EPS.index(0.12), 0]
+        assert stored == pytest.approx(default, abs=0.05 + 1e-3)
+
+
+def test_calibration_skips_unindexed_zones_without_parsing(main, client, files, tmp_path, monkeypatch):
+    import calibration
+    import reprocess
+
+    photo = str(tmp_path / "22.jpg")
+    make_photo(photo, width=640, height=480, seed=22)
+    id_ = create_case(client, files["ifc"], photo, "calibracao-sem-indice", zona="Nivel 1")
+    with main._db.transaction() as conn:
+        conn.execute("DELETE FROM ifc_zone_index")
+    main._ZONE_CACHE.clear()
+
+    parses = []
+    build_ifc_index = main.build_ifc_index
+    monkeypatch.setattr(main, "build_ifc_index", lambda *a, **k: parses.append(a) or build_ifc_index(*a, **k))
+    summary, m, _ = calibration.calibrate([0.7], [0.12])
+    assert parses == [] and id_ in m.unindexed and id_ not in m.ids.tolist()
+    assert summary["unindexed"] == len(m.unindexed) and "reprocess.py --indexar" in summary["hint"]
+
+    # --indexar grava o índice (aqui no próprio processo) e o caso volta à calibração
+    assert reprocess.index_zones(workers=0, log=lambda msg: None)["indexed"] >= 1
+    m = calibration.load_cases()
+    assert id_ in m.ids.tolist() and m.unindexed == []
+
+
+# ========= Forward único (strict e lenient da mesma saída) =========
+def _two_pass_counts(main, boxes, classes):
+    # Contagem das duas passadas antigas: cada forward já filtrado no próprio limiar
+    counts = {}
+    for *_, alias_idx, _ in boxes:
+        canon = main.ALIAS_TO_CANON.get(classes[alias_idx], classes[alias_idx])
+        counts[canon] = counts.get(canon, 0) + 1
+    return counts
+
+
+def test_single_forward_matches_two_pass_pipeline(main, files, monkeypatch):
+    weights, _ = main.build_ifc_weights_cached(files["ifc"], True)
+    classes = main.vocabulary_for(weights)
+    image = main.load_image(files["photos"][0])
+    w, imgsz, floor = main.YOLO_WEIGHTS, main.DETECT_IMGSZ, main.DETECTION_CONF_FLOOR
+    predict = lambda conf, augment, pass_id: main.predict_boxes(w, [image], classes, imgsz, conf, augment, pass_id)[0]
+
+    strict = predict(0.22, False, main.PASS_STRICT)
+    lenient = predict(0.03, True, main.PASS_LENIENT)
+    old_records = predict(floor, False, main.PASS_STRICT) + predict(floor, True, main.PASS_LENIENT)
+
+    forwards = []
+    predict_boxes = main.predict_boxes
+    monkeypatch.setattr(main, "predict_boxes", lambda *a, **k: forwards.append(a[5]) or predict_boxes(*a, **k))
+    dets, lenient_pass = main.detect_photo_raw(w, image, classes)
+    assert lenient_pass == "shared" and forwards == [False]
+
+    # Registros guardados caixa a caixa e contagens nos dois limiares
+    assert dets == old_records
+    counts_strict, counts_lenient, generic_hits = main.counts_from_detections(dets, classes)
+    assert counts_strict == _two_pass_counts(main, strict, classes)
+    old_lenient = _two_pass_counts(main, lenient, classes)
+    assert counts_lenient == old_lenient
+    assert generic_hits == sum(k for c, k in old_lenient.items() if c in main.GENERIC_CUE_CANONS)
+    assert 0 < sum(counts_strict.values()) < sum(counts_lenient.values())
+
+
+# ========= /casos paginado por cursor =========
+def test_cursor_pages_are_stable_under_inserts(main, client):
+    caso = "paginacao-cursor"
+    base = datetime(2024, 3, 1, tzinfo=timezone.utc)
+    # Grupos de três linhas no mesmo instante: o id desempata
+    main.save_submissions([(caso, f"antiga {i}", float(i), None, None, (base + timedelta(minutes=i // 3)).isoformat())
+                           for i in range(30)])
+    expected = [c["id"] for c in client.get("/casos", params={"caso": caso, "limit": 100}).json()["cases"]]
+    assert len(expected) == 30
+
+    seen, cursor, page = [], None, 0
+    while True:
+        params = {"caso": caso, "limit": 7, "campos": "id", **({"cursor": cursor} if cursor else {})}
+        body = client.get("/casos", params=params).json()
+        seen += [c["id"] for c in body["cases"]]
+        cursor = body["next_cursor"]
+        if not cursor:
+            break
+        # Uploads novos entre uma página e outra não deslocam as seguintes
+        page += 1
+        main.save_submissions([(caso, f"nova {page}", 50.0, None, None, datetime.now(timezone.utc).isoformat())])
+    assert seen == expected
+
+    # Validadores mudam com a escrita: um GET condicional antigo deixa de dar 304
+    etag = client.get("/casos", params={"caso": caso}).headers["etag"]
+    assert client.get("/casos", params={"caso": caso}, headers={"If-None-Match": etag}).status_code == 304
+    main.save_submissions([(caso, "depois", 1.0, None, None, datetime.now(timezone.utc).isoformat())])
+    assert client.get("/casos", params={"caso": caso}, headers={"If-None-Match": etag}).status_code == 200
+
+
+# ========= Agregados do dashboard mantidos por trigger =========
+def _buckets(main):
+    with main._db.read() as conn:
+        kept = conn.execute("SELECT grain, bucket, caso, n, progress_sum FROM submission_buckets").fetchall()
+        fresh = []
+        for grain, key in main.BUCKET_GRAINS:
+            fresh += conn.execute(f"""
+                SELECT '{grain}', {key.format(row="submissions")}, COALESCE(caso, ''), COUNT(*),
+                       SUM(COALESCE(progress_pct, 0))
+                FROM submissions GROUP BY 2, 3
+            """).fetchall()
+    as_map = lambda rows: {r[:3]: (r[3], pytest.approx(r[4], abs=1e-6)) for r in rows}
+    return as_map(kept), {r[:3]: (r[3], r[4]) for r in fresh}
+
+
+def test_dashboard_buckets_follow_every_write(main, client):
+    base = datetime(2024, 5, 10, 22, 30, tzinfo=timezone.utc)
+    main.save_submissions([(f"baldes-{i % 2}", "", 10.0 * i, None, None, (base + timedelta(hours=i)).isoformat())
+                           for i in range(6)])
+    with main._db.read() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM submissions WHERE caso LIKE 'baldes-%' ORDER BY id")]
+
+    kept, fresh = _buckets(main)
+    assert kept == fresh
+    # Renomear, mudar progresso e data (troca de dia), apagar e inserir sem caso
+    assert client.put(f"/casos/{ids[0]}", data={"caso": "baldes-renomeado"}).status_code == 200
+    with main._db.transaction() as conn:
+        conn.execute("UPDATE submissions SET progress_pct = 99.5 WHERE id = ?", (ids[1],))
+        conn.execute("UPDATE submissions SET uploaded_at = ? WHERE id = ?",
+                     ((base - timedelta(days=3)).isoformat(), ids[2]))
+    assert client.delete(f"/casos/{ids[3]}").status_code == 200
+    main.save_submissions([(None, "", None, None, None, base.isoformat())])
+    kept, fresh = _buckets(main)
+    assert kept == fresh
+    assert ("all", "", "baldes-renomeado") in fresh and ("day", "2024-05-07", "baldes-0") in fresh
+
+
+# ========= Histórico de medições =========
+def _daily(main, casos):
+    marks = ",".join("?" * len(casos))
+    with main._db.read() as conn:
+        kept = conn.execute(f"""
+            SELECT caso, day, n, progress_sum, progress_min, progress_max, last_at, last_progress
+            FROM measurement_daily WHERE caso IN ({marks}) ORDER BY caso, day
+        """, casos).fetchall()
+        # Mesmos agregados refeitos das revisões vigentes (a de maior id por observação)
+        fresh = conn.execute(f"""
+            WITH cur AS (
+                SELECT * FROM measurements m WHERE caso IN ({marks}) AND NOT EXISTS (
+                    SELECT 1 FROM measurements r WHERE r.submission_id = m.submission_id
+                    AND r.observed_at = m.observed_at AND r.id > m.id))
+            SELECT caso, substr(observed_at, 1, 10) AS day, COUNT(*), SUM(progress_pct), MIN(progress_pct),
+                   MAX(progress_pct), MAX(observed_at),
+                   (SELECT c2.progress_pct FROM cur c2 WHERE c2.caso = cur.caso
+                    AND substr(c2.observed_at, 1, 10) = substr(cur.observed_at, 1, 10)
+                    ORDER BY c2.observed_at DESC, c2.id DESC LIMIT 1)
+            FROM cur GROUP BY 1, 2 ORDER BY 1, 2
+        """, casos).fetchall()
+    return [(*r[:3], pytest.approx(r[3]), *r[4:]) for r in kept], fresh
+
+
+def test_measurements_are_append_only_and_daily_follows_revisions(main, client):
+    import sqlite3
+
+    casos = ["historico-a", "historico-b"]
+    base = datetime(2024, 7, 1, 9, tzinfo=timezone.utc)
+    main.save_submissions([(casos[0], "", p, None, None, (base + timedelta(hours=h)).isoformat())
+                           for p, h in ((10.0, 0), (30.0, 2), (20.0, 26))])
+    with main._db.read() as conn:
+        ids = [r[0] for r in conn.execute("SELECT id FROM submissions WHERE caso = ? ORDER BY id", (casos[0],))]
+    kept, fresh = _daily(main, casos)
+    assert kept == fresh and len(fresh) == 2
+
+    # Revisão (reanálise da mesma foto) troca o valor no dia em vez de somar
+    with main._db.transaction() as conn:
+        conn.execute("UPDATE submissions SET progress_pct = 55.0 WHERE id = ?", (ids[0],))
+        main.record_measurement(conn, ids[0], "reprocess")
+    # Caso renomeado: a observação sai do dia de um caso e entra no do outro
+    assert client.put(f"/casos/{ids[1]}", data={"caso": casos[1]}).status_code == 200
+    kept, fresh = _daily(main, casos)
+    assert kept == fresh
+    assert [r[:3] for r in fresh] == [(casos[0], "2024-07-01", 1), (casos[0], "2024-07-02", 1),
+                                      (casos[1], "2024-07-01", 1)]
+
+    # Nada é reescrito nem apagado, nem com o caso excluído
+    assert client.delete(f"/casos/{ids[2]}").status_code == 200
+    with main._db.transaction() as conn:
+        for sql in ("UPDATE measurements SET progress_pct = 0 WHERE submission_id = ?",
+                    "DELETE FROM measurements WHERE submission_id = ?"):
+            with pytest.raises(sqlite3.IntegrityError):
+                conn.execute(sql, (ids[0],))
+    with main._db.read() as conn:
+        assert conn.execute("SELECT COUNT(*) FROM measurements WHERE submission_id IN (?, ?, ?)",
+                            ids).fetchone()[0] >= 4
+    assert _daily(main, casos)[0] == kept
@@ -0,0 +1,35 @@
+import logging
+
+import pytest
+
+from conftest import create_case
+
+
+@pytest.fixture
+def records(main):
+    class _Collect(logging.Handler):
+        def __init__(self):
+            super().__init__(logging.INFO)
+            self.records = []
+
+        def emit(self, record):
+            self.records.append(record)
+
+    handler = _Collect()
+    main.logger.addHandler(handler)
+    try:
+        yield handler.records
+    finally:
+        main.logger.removeHandler(handler)
+
+
+def test_failed_job_is_logged_with_traceback(main, client, files, records, monkeypatch):
+    def boom(*args, **kwargs):
+        raise RuntimeError("detector caiu")
+
+    monkeypatch.setattr(main, "run_analysis", boom)
+    with pytest.raises(AssertionError):
+        create_case(client, files["ifc"], files["photos"][0], "job-com-falha")
+    failed = [r for r in records if r.levelno >= logging.ERROR]
+    assert failed and failed[0].exc_info and "detector caiu" in str(failed[0].exc_info[1])
+    assert failed[0].process and failed[0].name == "pimetro"
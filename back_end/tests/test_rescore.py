@@ -0,0 +1,44 @@
+import asyncio
+import threading
+
+from conftest import create_case
+
+
+def test_rescore_other_zone_parses_ifc_in_analysis_pool(main, client, files, monkeypatch):
+    id_ = create_case(client, files["ifc"], files["photos"][0], "rescore-zonas")
+    whole = client.post(f"/casos/{id_}/rescore")
+    assert whole.status_code == 200
+
+    # IFC gravado antes do índice de zonas e fora do cache de pesos
+    with main._db.transaction() as conn:
+        conn.execute("DELETE FROM ifc_zone_index")
+        conn.execute("DELETE FROM ifc_weights_cache")
+    main._ZONE_CACHE.clear()
+
+    parses = []
+    build_ifc_index = main.build_ifc_index
+
+    def spy(*args, **kwargs):
+        try:
+            asyncio.get_running_loop()
+            on_loop = True
+        except RuntimeError:
+            on_loop = False
+        parses.append((threading.current_thread().name, on_loop))
+        return build_ifc_index(*args, **kwargs)
+
+    monkeypatch.setattr(main, "build_ifc_index", spy)
+    first = client.post(f"/casos/{id_}/rescore", json={"zona": "Nivel 1"})
+    second = client.post(f"/casos/{id_}/rescore", json={"zona": "Nivel 2"})
+    assert first.status_code == second.status_code == 200
+    assert first.json()["zona"] != second.json()["zona"]
+
+    # Uma abertura só, no pool de análise; a segunda zona sai do índice gravado
+    assert len(parses) == 1
+    thread, on_loop = parses[0]
+    assert thread.startswith("analysis") and not on_loop
+
+
+def test_rescore_unknown_zone_is_422(client, files):
+    id_ = create_case(client, files["ifc"], files["photos"][1], "rescore-zona-inexistente")
+    assert client.post(f"/casos/{id_}/rescore", json={"zona": "Nivel 99"}).status_code == 422
@@ -0,0 +1,83 @@
+import os
+
+from bench.synth import make_photo
+from conftest import create_case
+
+
+def _refcount(main, sha):
+    with main._db.read() as conn:
+        row = conn.execute("SELECT refcount, path FROM blobs WHERE sha256=?", (sha,)).fetchone()
+    return row
+
+
+def _parts(main):
+    return os.listdir(main._PART_DIR) if os.path.isdir(main._PART_DIR) else []
+
+
+def _case_hashes(main, id_):
+    img_sha256, ifc_sha256, _ = main.get_case_hashes(id_)
+    return img_sha256, ifc_sha256
+
+
+def test_blob_refcount_follows_cases_and_unlinks_at_zero(main, client, files, tmp_path):
+    photos = [str(tmp_path / f"{seed}.jpg") for seed in (10, 11)]
+    for seed, photo in zip((10, 11), photos):
+        make_photo(photo, width=320, height=240, seed=seed)
+    a = create_case(client, files["ifc"], photos[0], "blobs-a")
+    b = create_case(client, files["ifc"], photos[1], "blobs-b")
+    img_a, ifc_sha = _case_hashes(main, a)
+    img_b, _ = _case_hashes(main, b)
+    ifc_refs = _refcount(main, ifc_sha)[0]
+    assert ifc_refs >= 2    # o mesmo IFC, gravado uma vez só
+    assert _parts(main) == []
+
+    _, img_path = _refcount(main, img_a)
+    thumb = main.rendition_path(img_a, "thumb")
+    assert os.path.exists(img_path) and os.path.exists(thumb)
+    assert client.delete(f"/casos/{a}").status_code == 200
+    assert _refcount(main, img_a) is None
+    assert not os.path.exists(img_path) and not os.path.exists(thumb)
+    assert _refcount(main, ifc_sha)[0] == ifc_refs - 1
+
+    # Foto de b continua no disco enquanto b existir
+    assert os.path.exists(_refcount(main, img_b)[1])
+
+
+def test_oversized_upload_is_rejected_while_streaming(main, client, files, monkeypatch):
+    monkeypatch.setitem(main.UPLOAD_MAX_MB, "img", 1)
+    with open(files["ifc"], "rb") as f:
+        ifc = f.read()
+    with main._db.read() as conn:
+        blobs = conn.execute("SELECT COUNT(*), SUM(refcount) FROM blobs").fetchone()
+
+    def body(boundary):
+        # Sem Content-Length (chunked): o limite só pode ser conferido no caminho
+        yield (f"--{boundary}\r\nContent-Disposition: form-data; name=\"ifc\"; filename=\"m.ifc\"\r\n\r\n"
+               ).encode() + ifc + b"\r\n"
+        yield f"--{boundary}\r\nContent-Disposition: form-data; name=\"img\"; filename=\"f.jpg\"\r\n\r\n".encode()
+        for _ in range(4):
+            yield b"\0" * (1 << 20)
+        yield f"\r\n--{boundary}--\r\n".encode()
+
+    r = client.post("/teste", content=body("xYz"), headers={"content-type": "multipart/form-data; boundary=xYz"})
+    assert r.status_code == 413
+    # O IFC já gravado perde a referência e o arquivo pela metade some
+    with main._db.read() as conn:
+        assert conn.execute("SELECT COUNT(*), SUM(refcount) FROM blobs").fetchone() == blobs
+    assert _parts(main) == []
+
+    r = client.post("/teste", content=b"x" * 100,
+                    headers={"content-type": "multipart/form-data; boundary=xYz",
+                             "content-length": str(main.form_max_bytes("img", "ifc") + 1)})
+    assert r.status_code == 413
+
+
+def test_put_without_files_only_renames(main, client, files):
+    id_ = create_case(client, files["ifc"], files["photos"][2], "renomear")
+    before = client.get(f"/casos/{id_}").json()
+    # Campo de arquivo vazio (nada escolhido no formulário) não conta como arquivo novo
+    r = client.put(f"/casos/{id_}", data={"caso": "renomeado"}, files={"img": ("", b"")})
+    assert r.status_code == 200, r.text
+    after = r.json()
+    assert after["caso"] == "renomeado" and after["progress_pct"] == before["progress_pct"]
+    assert client.put(f"/casos/{id_}", data={"desc": "só texto"}).json()["descricao"] == "só texto"
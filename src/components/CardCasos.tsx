@@ -10,6 +10,8 @@ type Case = {
   progress_pct: number;
   img_path: string | null;
   ifc_path: string | null;
+  thumb_url?: string | null;
+  preview_url?: string | null;
   data: string;
 }
 
@@ -58,7 +60,8 @@ function CardCasos({ add = false, case: caseData, onChanged }: CardCasosProps) {
         <div className='bg-black h-40 w-full'>
           {caseData?.img_path ? (
             <img 
-              src={caseData.img_path} 
+              src={caseData.thumb_url || caseData.img_path} 
+              loading="lazy" 
               alt={caseData?.caso || "Imagem do caso"} 
               className='h-full w-full object-cover' 
             />
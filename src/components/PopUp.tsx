@@ -8,6 +8,8 @@ type Case = {
   progress_pct: number;
   img_path: string | null;
   ifc_path: string | null;
+  thumb_url?: string | null;
+  preview_url?: string | null;
   data: string;
 }
 
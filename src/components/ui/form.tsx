@@ -8,6 +8,8 @@ type Case = {
   progress_pct: number;
   img_path: string | null;
   ifc_path: string | null;
+  thumb_url?: string | null;
+  preview_url?: string | null;
   data: string;
 };
 
@@ -113,7 +115,7 @@ function Form({ onDone, mode = "create", caseData }: FormProps) {
             )}
             <Upload
               type="image"
-              initialPreview={caseData?.img_path || null}
+              initialPreview={caseData?.preview_url || caseData?.img_path || null}
               initialFileName={basename(caseData?.img_path)}
             />
           </div>
@@ -11,6 +11,8 @@ type Case = {
   progress_pct: number;
   img_path: string | null;
   ifc_path: string | null;
+  thumb_url?: string | null;
+  preview_url?: string | null;
   data: string;
 }
 
@@ -18,7 +20,9 @@ const API = 'http://localhost:8000';
 
 function Casos() {
   const [cases, setCases] = useState<Case[]>([]);
+  const [nextCursor, setNextCursor] = useState<string | null>(null);
   const [loading, setLoading] = useState(true);
+  const [loadingMore, setLoadingMore] = useState(false);
   const [error, setError] = useState<string | null>(null);
 
   const load = useCallback(() => {
@@ -27,6 +31,7 @@ function Casos() {
       .then(res => res.json())
       .then(data => {
         setCases(data.cases || []);
+        setNextCursor(data.next_cursor || null);
         setLoading(false);
       })
       .catch(err => {
@@ -36,6 +41,19 @@ function Casos() {
       });
   }, [])
 
+  const loadMore = useCallback(() => {
+    if (!nextCursor) return;
+    setLoadingMore(true);
+    fetch(`${API}/casos?cursor=${encodeURIComponent(nextCursor)}`)
+      .then(res => res.json())
+      .then(data => {
+        setCases(prev => [...prev, ...(data.cases || [])]);
+        setNextCursor(data.next_cursor || null);
+      })
+      .catch(err => console.error('Erro ao buscar casos:', err))
+      .finally(() => setLoadingMore(false));
+  }, [nextCursor])
+
   useEffect(() => { load(); }, [load]);
 
   tituloPag('Casos')
@@ -59,6 +77,17 @@ function Casos() {
             ))}
           </div>
         )}
+        {!loading && !error && nextCursor && (
+          <div className="flex justify-center py-8">
+            <button
+              onClick={loadMore}
+              disabled={loadingMore}
+              className="px-3 py-2 bg-[#001489] text-white rounded hover:bg-blue-700 disabled:opacity-50"
+            >
+              {loadingMore ? 'Carregando...' : 'Carregar mais'}
+            </button>
+          </div>
+        )}
       </div>
     </div>
   )
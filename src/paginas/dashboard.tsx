@@ -1,4 +1,4 @@
-import { useEffect, useMemo, useState } from 'react';
+import { useEffect, useState } from 'react';
 import Container from '../components/ui/container.tsx';
 import Separador from '../components/ui/separador.tsx';
 import Caso from '../components/Caso.tsx';
@@ -14,25 +14,37 @@ type Case = {
   descricao: string;
   progress_pct: number;
   img_path: string | null;
-  ifc_path: string | null;
-  data: string;
+  thumb_url?: string | null;
   uploaded_at_iso: string;
 };
 
+type Stats = {
+  total: number;
+  este_mes: number;
+  ultimas_24h: number;
+  recentes: Case[];
+};
+
 const API = 'http://localhost:8000';
 
 function Dashboard() {
   tituloPag('Dashboard');
 
-  const [cases, setCases] = useState<Case[]>([]);
+  const [stats, setStats] = useState<Stats | null>(null);
   const [loading, setLoading] = useState(true);
 
   useEffect(() => {
     (async () => {
       try {
-        const res = await fetch(`${API}/casos`);
-        const data = await res.json();
-        setCases(data.cases || []);
+        // Contagens prontas no servidor; o início do mês segue o fuso do navegador
+        const agora = new Date();
+        const params = new URLSearchParams({
+          mes_inicio: new Date(agora.getFullYear(), agora.getMonth(), 1).toISOString(),
+          recentes_horas: '10',
+          recentes_limite: '50',
+        });
+        const res = await fetch(`${API}/dashboard/stats?${params}`);
+        setStats(await res.json());
       } catch (e) {
         console.error(e);
       } finally {
@@ -41,26 +53,7 @@ function Dashboard() {
     })();
   }, []);
 
-  const now = new Date();
-
-  const casesLast10h = useMemo(() => {
-    const cutoff = new Date(now.getTime() - 10 * 60 * 60 * 1000);
-    return (cases || []).filter(c => new Date(c.uploaded_at_iso) >= cutoff);
-  }, [cases]);
-
-  const countLast24h = useMemo(() => {
-    const cutoff = new Date(now.getTime() - 24 * 60 * 60 * 1000);
-    return (cases || []).filter(c => new Date(c.uploaded_at_iso) >= cutoff).length;
-  }, [cases]);
-
-  const countThisMonth = useMemo(() => {
-    return (cases || []).filter(c => {
-      const d = new Date(c.uploaded_at_iso);
-      return d.getMonth() === now.getMonth() && d.getFullYear() === now.getFullYear();
-    }).length;
-  }, [cases]);
-
-  const totalObras = cases.length;
+  const casesLast10h = stats?.recentes ?? [];
 
   return (
     <div className='flex overflow-hidden'>
@@ -69,9 +62,9 @@ function Dashboard() {
         <Separador titulo='Dashboard' />
 
         <div className='flex h-fit justify-center space-x-6'>
-          <Card texto='Obras' icone='hammer' footer='Obras registradas' contador={totalObras} />
-          <Card texto='Este mês' icone='chart-line' footer='Novas obras'     contador={countThisMonth} />
-          <Card texto='Últimas 24h' icone='clock' footer='Obras recentes'  contador={countLast24h} />
+          <Card texto='Obras' icone='hammer' footer='Obras registradas' contador={stats?.total ?? 0} />
+          <Card texto='Este mês' icone='chart-line' footer='Novas obras'     contador={stats?.este_mes ?? 0} />
+          <Card texto='Últimas 24h' icone='clock' footer='Obras recentes'  contador={stats?.ultimas_24h ?? 0} />
         </div>
 
         <Separador />
@@ -87,7 +80,7 @@ function Dashboard() {
                   titulo={c.caso}
                   descricao={c.descricao}
                   progress={c.progress_pct}
-                  img={c.img_path || undefined}
+                  img={c.thumb_url || c.img_path || undefined}
                   dataLabel={new Date(c.uploaded_at_iso)}
                 />
               ))}